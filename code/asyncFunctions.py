@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import random
+import concurrent.futures
+from typing import Callable, Union
+
+from code.cacheFunctions import resultCache, graphKey
+
+# Substrings of Earth Engine/HTTP errors that are worth retrying (rate limits, quota and timeouts)
+RETRYABLE = ('429', 'too many requests', 'quota', 'rate limit', 'timed out', 'timeout', 'deadline exceeded',
+             '503', 'service unavailable', 'connection reset')
+
+def isRetryable(ex: Exception) -> bool:
+    """True for rate limit, quota and timeout errors"""
+    if isinstance(ex, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    message = str(ex).lower()
+    return any(text in message for text in RETRYABLE)
+
+class eeExecutor:
+    """
+    Compute many Earth Engine objects concurrently. Requests are run in threads (the Earth Engine client is
+    blocking) with at most maxInFlight requests at a time, matched to the Earth Engine concurrent request quota.
+    Rate limit (429) and timeout errors are retried with exponential backoff. With a resultCache, objects that were
+    computed before are served from the cache without a request.
+
+    # Example Usuage
+    executor = eeExecutor(maxInFlight = 20)
+    results = executor.run([conformal.evaluate(verbose = False) for conformal in conformals])
+    # or inside a coroutine, the thread pool is shut down on exit
+    async with eeExecutor(maxInFlight = 20) as executor:
+        calibration = await calibrateAsync(conformal, executor, score = 'aps')
+    """
+    def __init__(self, maxInFlight: int = 10, maxRetries: int = 5, initialDelay: float = 1, maxDelay: float = 64,
+                 backoff: float = 2, backend: Callable = None, sleep: Callable = None, cache: resultCache = None):
+        """
+        Args:
+            maxInFlight (int): The maximum number of concurrent requests
+            maxRetries (int): The maximum number of attempts per request
+            initialDelay (float): Seconds to wait before the first retry
+            maxDelay (float): The maximum number of seconds between retries
+            backoff (float): Factor the delay is multiplied by after every retry
+            backend (Callable): Function (object) -> result that performs a request. Defaults to object.getInfo().
+             Can be replaced e.g. by geemap.ee_to_df or a local fake for testing
+            sleep (Callable): Coroutine function used to wait between retries (asyncio.sleep)
+            cache (resultCache): Disk cache of results keyed by the graph hash of the objects. Results of the executor
+             backend are cached as getInfo results, requests with a per call backend are not cached
+        """
+        self.maxInFlight = maxInFlight
+        self.maxRetries = maxRetries
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.backoff = backoff
+        self.backend = backend if backend is not None else (lambda obj: obj.getInfo())
+        self.sleep = sleep if sleep is not None else asyncio.sleep
+        self.logger = logging.getLogger(__name__)
+        self.cache = cache
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0, 'cacheHits': 0}
+        # own thread pool, the default asyncio pool may be smaller than maxInFlight
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = maxInFlight)
+        self._semaphore, self._loop = None, None
+
+    def _limit(self) -> asyncio.Semaphore:
+        """The concurrency limit shared by all requests of the executor. Created inside the running event loop
+        (a semaphore is bound to its loop), again when run() starts a new loop"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore, self._loop = asyncio.Semaphore(self.maxInFlight), loop
+        return self._semaphore
+
+    async def compute(self, obj, backend: Callable = None):
+        """
+        Compute one object. Waits for a free slot when maxInFlight requests of the executor are running.
+
+        Args:
+            obj: The Earth Engine object (or any input of the backend)
+            backend (Callable): Overrides the executor backend for this request
+
+        Returns:
+            The result of the backend e.g. the getInfo result
+        """
+        semaphore = self._limit()
+        # results of other backends (e.g. ee_to_df) are not interchangeable with getInfo results
+        key = graphKey(obj, 'getInfo') if self.cache is not None and backend is None else None
+        if key is not None:
+            hit, result = self.cache.get(key)
+            if hit:
+                self.stats['cacheHits'] += 1
+                return result
+        backend = backend or self.backend
+        delay = self.initialDelay
+        for attempt in range(1, self.maxRetries + 1):
+            async with semaphore:
+                self.stats['requests'] += 1
+                try:
+                    result = await asyncio.get_running_loop().run_in_executor(self.pool, backend, obj)
+                    if key is not None:
+                        self.cache.set(key, result)
+                    return result
+                except Exception as ex:
+                    if attempt == self.maxRetries or not isRetryable(ex):
+                        self.stats['failures'] += 1
+                        raise ex
+                    self.logger.info(f'Retrying in {delay:.1f}s after attempt {attempt} ({ex})')
+                    self.stats['retries'] += 1
+            # back off outside the semaphore so other requests can use the slot, with jitter
+            await self.sleep(delay * (1 + random.random() / 4))
+            delay = min(delay * self.backoff, self.maxDelay)
+
+    async def gather(self, objs: Union[list, dict], backend: Callable = None) -> Union[list, dict]:
+        """
+        Compute many objects concurrently (at most maxInFlight at a time).
+
+        Args:
+            objs (list or dict): The objects to compute
+            backend (Callable): Overrides the executor backend for these requests
+
+        Returns:
+            The results in the same order (list) or with the same keys (dict)
+        """
+        keys = list(objs) if isinstance(objs, dict) else None
+        values = list(objs.values()) if keys is not None else list(objs)
+        results = await asyncio.gather(*[self.compute(obj, backend) for obj in values])
+        return dict(zip(keys, results)) if keys is not None else list(results)
+
+    def run(self, objs: Union[list, dict], backend: Callable = None) -> Union[list, dict]:
+        """Blocking version of gather (for scripts; use gather inside a running event loop e.g. in notebooks)"""
+        return asyncio.run(self.gather(objs, backend))
+
+    def close(self):
+        """Shut down the thread pool (waits for running requests)"""
+        self.pool.shutdown(wait = True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        # shutting down waits for the threads, keep the event loop responsive
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+async def calibrateAsync(conformal, executor: eeExecutor, **kwargs) -> dict:
+    """
+    Awaitable calibrate. The calibration graph is built locally and computed by the executor.
+
+    Args:
+        conformal: conformalFeatureClassifier, conformalImageClassifier, conformalFeatureRegressor or
+         conformalImageRegressor
+        executor (eeExecutor): The executor that computes the result
+        **kwargs: Arguments of the calibrate method of conformal
+
+    Returns:
+        dict of the calibration feature (getInfo result)
+    """
+    return await executor.compute(conformal.calibrate(**kwargs))
+
+async def evaluateAsync(conformal, executor: eeExecutor, **kwargs) -> dict:
+    """
+    Awaitable evaluate (one request instead of the getInfo calls of evaluate(verbose = True)).
+
+    Args:
+        conformal: A calibrated conformal classifier/regressor
+        executor (eeExecutor): The executor that computes the result
+        **kwargs: Arguments of the evaluate method of conformal
+
+    Returns:
+        dict of the evaluation feature (getInfo result)
+    """
+    return await executor.compute(conformal.evaluate(verbose = False, **kwargs))
@@ -0,0 +1,128 @@
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+from typing import Callable
+
+import ee
+
+def graphKey(obj: ee.ComputedObject, namespace: str = '') -> str:
+    """
+    Key of an Earth Engine computation: the sha256 of its serialised expression (computed locally, no server call).
+    Identical graphs give identical keys.
+
+    Args:
+        obj (ee.ComputedObject): The Earth Engine object
+        namespace (str): Distinguishes different fetches of the same object e.g. 'getInfo' and 'ee_to_df'
+
+    Returns:
+        (str) sha256 hex digest
+    """
+    return hashlib.sha256(f'{namespace}:{obj.serialize()}'.encode()).hexdigest()
+
+class resultCache:
+    """
+    A disk-backed (SQLite) cache of fetched Earth Engine results keyed by the hash of the serialised expression.
+    Entries expire after ttl seconds and the least recently used entries are evicted when the cache exceeds maxBytes.
+    Hits, misses and the hit rate are reported by stats().
+
+    # Example Usuage
+    cache = resultCache('results.sqlite', maxBytes = 2e9, ttl = 7 * 24 * 3600)
+    info = cache.fetch(conformal.evaluate(verbose = False))
+    pm = prepareModel(dataset, 'label', image, bandNames, cache = cache)
+    print(cache.stats())
+    """
+    def __init__(self, path: str = os.path.join('~', '.cache', 'geeconformal', 'results.sqlite'),
+                 maxBytes: float = 1e9, ttl: float = None):
+        """
+        Args:
+            path (str): File path of the SQLite database
+            maxBytes (float): The maximum total size of the cached (pickled) results
+            ttl (float): Seconds after which an entry expires. None = no expiry
+        """
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok = True)
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread = False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, '
+                                    'size INTEGER, created REAL, accessed REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS accessed ON results (accessed)')
+
+    def get(self, key: str) -> tuple:
+        """
+        Look up a key.
+
+        Returns:
+            (hit (bool), value)
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT value, created FROM results WHERE key = ?', (key,)).fetchone()
+            now = time.time()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                with self.connection:
+                    self.connection.execute('DELETE FROM results WHERE key = ?', (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return False, None
+            with self.connection:
+                self.connection.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return True, pickle.loads(row[0])
+
+    def set(self, key: str, value):
+        """Store a value and evict the least recently used entries if the cache exceeds maxBytes"""
+        blob = pickle.dumps(value, protocol = pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                                    (key, blob, len(blob), now, now))
+            total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+            for oldKey, size in self.connection.execute('SELECT key, size FROM results ORDER BY accessed').fetchall():
+                if total <= self.maxBytes:
+                    break
+                self.connection.execute('DELETE FROM results WHERE key = ?', (oldKey,))
+                total -= size
+
+    def fetch(self, obj: ee.ComputedObject, compute: Callable = None, namespace: str = 'getInfo'):
+        """
+        Get the result of an Earth Engine object from the cache, or compute and cache it.
+
+        Args:
+            obj (ee.ComputedObject): The Earth Engine object
+            compute (Callable): Function (obj) -> result. Defaults to obj.getInfo()
+            namespace (str): Name of the fetch, part of the key. Use a different namespace for each compute function
+
+        Returns:
+            The (cached) result
+        """
+        key = graphKey(obj, namespace)
+        hit, value = self.get(key)
+        if hit:
+            return value
+        value = compute(obj) if compute is not None else obj.getInfo()
+        self.set(key, value)
+        return value
+
+    def stats(self) -> dict:
+        """Hits, misses, hit rate, number of entries and size (bytes) of the cache"""
+        with self.lock:
+            entries, size = self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hitRate': self.hits / requests if requests else 0.0,
+                'entries': entries, 'bytes': size}
+
+    def clear(self):
+        """Remove all entries"""
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM results')
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,336 @@
+import os
+import json
+import math
+import time
+import hashlib
+
+import numpy as np
+import ee
+
+from code.localConformalFunctions import conformalQuantile
+
+# Scores where higher values are more conforming (the quantile is taken from the lower tail)
+LOWER_SCORES = ('lac',)
+
+def dataHash(data) -> str:
+    """
+    Hash the data a calibration was computed from. Earth Engine objects are hashed from their serialised
+    expression (no server call), arrays from their bytes.
+
+    Args:
+        data (ee.ComputedObject or np.ndarray)
+
+    Returns:
+        (str) sha256 hex digest
+    """
+    if isinstance(data, ee.ComputedObject):
+        content = data.serialize().encode()
+    else:
+        content = np.ascontiguousarray(data).tobytes()
+    return hashlib.sha256(content).hexdigest()
+
+def sketchQuantile(edges: np.ndarray, counts: np.ndarray, alpha: float, lower: bool = False) -> float:
+    """
+    Conservative qHat from a histogram sketch of the calibration scores: the edge of the bin that holds the
+    ceil((n+1)(1-alpha))-th smallest score (largest score if lower=True), on the side that gives the larger sets or
+    intervals. The error is at most one bin width.
+
+    Args:
+        edges (np.ndarray): The bin edges. counts[0] holds the scores <= edges[0], counts[i] the scores in
+         (edges[i-1], edges[i]] and counts[-1] the scores > edges[-1]
+        counts (np.ndarray): The number of scores per bin (len(edges) + 1)
+        alpha (float): The tolerance level between 0-1
+        lower (bool): True for scores where higher values are more conforming (lac)
+
+    Returns:
+        (float) qHat. +-inf if there are too few calibration samples or the order statistic is outside the edges
+    """
+    cumulative = np.cumsum(counts)
+    n = int(cumulative[-1])
+    k = math.ceil((n + 1) * (1 - alpha))
+    if k > n:
+        return -np.inf if lower else np.inf
+    if lower:
+        # the (n-k+1)-th smallest score is above the lower edge of its bin
+        index = int(np.searchsorted(cumulative, n - k + 1))
+        return float(edges[index - 1]) if index > 0 else -np.inf
+    index = int(np.searchsorted(cumulative, k))
+    return float(edges[index]) if index < len(edges) else np.inf
+
+class calibrationArtifact:
+    """
+    A compact record of a conformal calibration that can be saved (json or npz), merged with other calibration
+    batches and applied to a conformal classifier/regressor so that predict can be used without recalibrating.
+    The artifact stores qHat per alpha (per class for mondrian calibrations), the number of calibration samples
+    and optionally a fixed-size histogram sketch of the scores, never the scores themselves.
+
+    # Example Usuage
+    artifact = calibrationArtifact.fromScores(scores, score = 'aps', version = 'dw_2023_batch1',
+                                              edges = np.linspace(0, 1.1, 1101))
+    registry = calibrationRegistry('calibrations')
+    registry.register(artifact)
+    registry.load('dw_2023_batch1').apply(conformalImageClassifier, alpha = 0.1)
+    """
+    def __init__(self, version: str, score: str, alphas: list, qHats: dict, nCal: int, dataHash: str = None,
+                 edges: np.ndarray = None, counts: np.ndarray = None, params: dict = None, created: float = None):
+        """
+        Args:
+            version (str): A user-provided string to identify the calibration
+            score (str): The score function/method e.g. 'lac', 'aps', 'raps', 'residual', 'normalized' or 'cqr'
+            alphas (list): The alpha levels qHat was computed for
+            qHats (dict): alpha: qHat. qHat is a list (band order) for per-class (mondrian) calibrations
+            nCal (int): The number of calibration samples/pixels
+            dataHash (str): Hash of the calibration data (see dataHash)
+            edges (np.ndarray): Bin edges of the optional score sketch (see sketchQuantile). Required to merge
+             artifacts or to compute qHat for additional alpha levels
+            counts (np.ndarray): The number of scores per bin of the sketch (len(edges) + 1)
+            params (dict): Additional parameters of the score function e.g. lam, kReg or sigma
+            created (float): Creation time (seconds since the epoch)
+        """
+        self.version = version
+        self.score = score
+        self.alphas = [float(alpha) for alpha in alphas]
+        self.qHats = {float(alpha): [float(q) for q in qHat] if isinstance(qHat, (list, tuple)) else float(qHat)
+                      for alpha, qHat in qHats.items()}
+        self.nCal = int(nCal)
+        self.dataHash = dataHash
+        self.edges = None if edges is None else np.asarray(edges, dtype = np.float64)
+        self.counts = None if counts is None else np.asarray(counts, dtype = np.int64)
+        self.params = params or {}
+        self.created = created if created is not None else time.time()
+
+    @classmethod
+    def fromScores(cls, scores: np.ndarray, score: str, version: str, alphas: list = (0.1,), data = None,
+                   params: dict = None, edges: np.ndarray = None):
+        """
+        Create an artifact from (local) calibration scores. qHat of every alpha is exact.
+
+        Args:
+            scores (np.ndarray): calibration scores (see localConformalFunctions)
+            data: The data the scores were computed from, used for the data hash. Defaults to the scores
+            edges (np.ndarray): Bin edges of a score sketch e.g. np.linspace(0, 1, 1001) for lac scores. Artifacts
+             with the same edges can be merged. None = no sketch
+
+        Returns:
+            calibrationArtifact
+        """
+        scores = np.asarray(scores, dtype = np.float64)
+        lower = score in LOWER_SCORES
+        qHats = {alpha: conformalQuantile(scores, alpha, lower = lower) for alpha in alphas}
+        counts = None
+        if edges is not None:
+            edges = np.asarray(edges, dtype = np.float64)
+            counts = np.bincount(np.searchsorted(edges, scores, side = 'left'), minlength = len(edges) + 1)
+        return cls(version, score, alphas, qHats, len(scores), dataHash(scores if data is None else data),
+                   edges = edges, counts = counts, params = params)
+
+    @classmethod
+    def fromConformal(cls, conformal, calibration: ee.Feature, nCal: int = 0):
+        """
+        Create an artifact from a conformal classifier/regressor calibrated in Earth Engine (one getInfo call).
+        No sketch is stored, so the artifact can be applied but not merged.
+
+        Args:
+            conformal: A calibrated conformalFeatureClassifier, conformalImageClassifier, conformalFeatureRegressor
+             or conformalImageRegressor
+            calibration (ee.Feature): The feature returned by calibrate
+            nCal (int): The number of calibration samples/pixels, if known
+
+        Returns:
+            calibrationArtifact
+        """
+        info = calibration.getInfo()['properties']
+        score = getattr(conformal, 'score', None) or getattr(conformal, 'method')
+        params = {key: getattr(conformal, key) for key in ('lam', 'kReg', 'sigma') if hasattr(conformal, key)}
+        return cls(getattr(conformal, 'version', info.get('version')), score, [conformal.alpha],
+                   {conformal.alpha: info['qHat']}, nCal, dataHash(conformal.data), params = params)
+
+    def qHat(self, alpha: float = None):
+        """
+        Get qHat for an alpha level. Computed (conservatively) from the sketch if alpha is not in the alpha grid.
+
+        Args:
+            alpha (float): Defaults to the first alpha of the grid
+
+        Returns:
+            (float or list) qHat. +-inf if there were too few calibration samples for alpha
+        """
+        alpha = self.alphas[0] if alpha is None else float(alpha)
+        if alpha in self.qHats:
+            return self.qHats[alpha]
+        if self.counts is None:
+            raise ValueError(f'qHat was not computed for alpha {alpha} and no sketch is stored')
+        return sketchQuantile(self.edges, self.counts, alpha, lower = self.score in LOWER_SCORES)
+
+    def merge(self, other, version: str = None):
+        """
+        Merge with the artifact of another calibration batch. The sketches are added and qHat of every alpha is
+        recomputed from the merged sketch (conservative, see sketchQuantile).
+
+        Args:
+            other (calibrationArtifact): Calibration of the same model and score function with the same sketch edges
+            version (str): version of the merged artifact. Defaults to '{version}+{other.version}'
+
+        Returns:
+            calibrationArtifact
+        """
+        if self.counts is None or other.counts is None:
+            raise ValueError('Only artifacts with a stored sketch can be merged')
+        if (self.score, self.params) != (other.score, other.params):
+            raise ValueError('Only artifacts with the same score function and parameters can be merged')
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Only artifacts with the same sketch edges can be merged')
+        counts = self.counts + other.counts
+        alphas = sorted(set(self.alphas) | set(other.alphas))
+        lower = self.score in LOWER_SCORES
+        qHats = {alpha: sketchQuantile(self.edges, counts, alpha, lower = lower) for alpha in alphas}
+        hash = hashlib.sha256(''.join(sorted([self.dataHash or '', other.dataHash or ''])).encode()).hexdigest()
+        return calibrationArtifact(version or f'{self.version}+{other.version}', self.score, alphas, qHats,
+                                   self.nCal + other.nCal, hash, edges = self.edges, counts = counts,
+                                   params = self.params)
+
+    def apply(self, conformal, alpha: float = None):
+        """
+        Set qHat (and the score function) of a conformal classifier/regressor so that predict can be used
+        without calling calibrate.
+
+        Args:
+            conformal: conformalFeatureClassifier, conformalImageClassifier, conformalFeatureRegressor or
+             conformalImageRegressor
+            alpha (float): Defaults to the first alpha of the grid
+
+        Returns:
+            The conformal object
+        """
+        alpha = self.alphas[0] if alpha is None else float(alpha)
+        qHat = self.qHat(alpha)
+        if not np.all(np.isfinite(qHat)):
+            raise ValueError(f'qHat is not finite for alpha {alpha}: too few calibration samples ({self.nCal}) for '
+                             'this alpha or a sketch that does not cover the scores. Use a larger alpha or more '
+                             'calibration data')
+        conformal.alpha = alpha
+        conformal.qhat = ee.List(qHat) if isinstance(qHat, list) else ee.Number(qHat)
+        if hasattr(conformal, 'score'):
+            conformal.score = self.score
+        else:
+            conformal.method = self.score
+        for key, value in self.params.items():
+            setattr(conformal, key, value)
+        return conformal
+
+    def _metadata(self) -> dict:
+        return {'version': self.version, 'score': self.score, 'alphas': self.alphas,
+                'qHats': {str(alpha): qHat for alpha, qHat in self.qHats.items()}, 'nCal': self.nCal,
+                'dataHash': self.dataHash, 'params': self.params, 'created': self.created}
+
+    def save(self, path: str) -> str:
+        """
+        Save the artifact as json or npz (chosen from the file extension). npz stores the sketch as binary arrays.
+        Paths without a .json or .npz extension are saved as npz with the .npz extension added.
+
+        Returns:
+            (str) the path of the written file
+        """
+        if path.endswith('.json'):
+            content = self._metadata()
+            content['edges'] = None if self.edges is None else self.edges.tolist()
+            content['counts'] = None if self.counts is None else self.counts.tolist()
+            with open(path, 'w') as f:
+                json.dump(content, f)
+            return path
+        path = path if path.endswith('.npz') else path + '.npz'
+        arrays = {} if self.counts is None else {'edges': self.edges, 'counts': self.counts}
+        np.savez(path, metadata = json.dumps(self._metadata()), **arrays)
+        return path
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Load an artifact saved as json or npz. A path without extension is read as path + '.npz' (see save).
+
+        Returns:
+            calibrationArtifact
+        """
+        if path.endswith('.json'):
+            with open(path) as f:
+                content = json.load(f)
+        else:
+            path = path if path.endswith('.npz') else path + '.npz'
+            with np.load(path) as npz:
+                content = json.loads(str(npz['metadata']))
+                content.update({key: npz[key] for key in ('edges', 'counts') if key in npz})
+        qHats = {float(alpha): qHat for alpha, qHat in content.pop('qHats').items()}
+        return cls(qHats = qHats, **content)
+
+class calibrationRegistry:
+    """
+    A local directory of calibration artifacts indexed by version.
+    """
+    def __init__(self, root: str, format: str = 'npz'):
+        """
+        Args:
+            root (str): Directory of the registry. Created if it does not exist
+            format (str): File format of new artifacts, either 'npz' or 'json'
+        """
+        self.root = root
+        self.format = format
+        os.makedirs(root, exist_ok = True)
+        self.indexPath = os.path.join(root, 'index.json')
+        self.index = {}
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath) as f:
+                self.index = json.load(f)
+
+    def _saveIndex(self):
+        tmp = f'{self.indexPath}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f, indent = 1)
+        os.replace(tmp, self.indexPath)
+
+    def versions(self) -> list:
+        """List the registered versions"""
+        return list(self.index)
+
+    def register(self, artifact: calibrationArtifact, overwrite: bool = False) -> str:
+        """
+        Save an artifact in the registry.
+
+        Returns:
+            (str) file path of the artifact
+        """
+        if artifact.version in self.index and not overwrite:
+            raise ValueError(f'version {artifact.version} is already registered. Use overwrite=True to replace it')
+        fileName = hashlib.sha1(artifact.version.encode()).hexdigest()[:16] + f'.{self.format}'
+        artifact.save(os.path.join(self.root, fileName))
+        self.index[artifact.version] = {'file': fileName, 'score': artifact.score, 'nCal': artifact.nCal,
+                                        'dataHash': artifact.dataHash, 'created': artifact.created}
+        self._saveIndex()
+        return os.path.join(self.root, fileName)
+
+    def load(self, version: str) -> calibrationArtifact:
+        """Load a registered artifact"""
+        if version not in self.index:
+            raise KeyError(f'version {version} is not registered')
+        return calibrationArtifact.load(os.path.join(self.root, self.index[version]['file']))
+
+    def find(self, dataHash: str) -> list:
+        """List the versions calibrated on data with the given hash (for reuse)"""
+        return [version for version, entry in self.index.items() if entry['dataHash'] == dataHash]
+
+    def merge(self, versions: list, version: str) -> calibrationArtifact:
+        """
+        Merge several registered calibration batches and register the result.
+
+        Args:
+            versions (list): versions to merge
+            version (str): version of the merged artifact
+
+        Returns:
+            calibrationArtifact
+        """
+        merged = self.load(versions[0])
+        for other in versions[1:]:
+            merged = merged.merge(self.load(other))
+        merged.version = version
+        self.register(merged)
+        return merged
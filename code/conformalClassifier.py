@@ -1,15 +1,27 @@
 import ee
+import pandas as pd
 from geeml.utils import eeprint
 
+from code.scoreFunctions import checkScore, classScoresArray, classScoresImage, setsImage, exactQuantile, \
+    scoreHistogram, histogramQuantile
+from code.splitFunctions import calibrationSplitter, evaluateRepeatedSplits
+from code.diagnosticFunctions import featureDiagnostics, imageDiagnostics
+
 # The conformalFeatureClassifier class contains methods to calibrate, evaluate and perform inference for a feature collection
 class conformalFeatureClassifier(object):
-    def __init__(self, data: ee.FeatureCollection, bands: list, alpha: float, split: float, label: str, version: str):
+    def __init__(self, data: ee.FeatureCollection, bands: list, alpha: float, split: float, label: str, version: str,
+                 splitter: calibrationSplitter = None):
         self.data = data
+        # calibrationSplitter of data e.g. for spatial block or cluster splits. Random per feature by default
+        self.splitter = splitter
         self.bands = bands
         self.alpha = alpha
         self.split = split
         self.label = label
         self.version = version
+        self.score = 'lac'
+        self.lam = 0.01
+        self.kReg = 1
 
     # Calibration
     # Function 1
@@ -24,8 +36,24 @@ class conformalFeatureClassifier(object):
             ee.Feature with 'score' property containing nonconformity score
 
         """
-        score = ee.Number(feature.getNumber(self.clsDict.getString(ee.Algorithms.String(feature.get(self.label)))))
+        if self.score == 'lac':
+            score = ee.Number(feature.getNumber(self.clsDict.getString(ee.Algorithms.String(feature.get(self.label)))))
+        else:
+            score = self._classScores(feature).get([ee.Number(feature.get(self.label)).int()])
         return feature.set('score', ee.Number(score))
+
+    def _classScores(self, feature):
+        """
+        Computes the score of every candidate class (see scoreFunctions)
+
+        Args:
+            feature (ee.Feature): feature with a probability property per class
+
+        Returns:
+            ee.Array with the score of each class
+        """
+        probs = ee.Array(feature.toDictionary(self.bands).values(self.bands))
+        return classScoresArray(probs, len(self.bands), self.score, self.lam, self.kReg)
     
     # Function 2
     def _createClassDictionary(self):
@@ -52,6 +80,9 @@ class conformalFeatureClassifier(object):
             qLevel (ee.Number): The adjusted 
 
         """
+        if self.score != 'lac':
+            # higher scores are less conforming (aps, raps): upper quantile
+            return ee.Number(nCal).add(1).multiply(1 - self.alpha).ceil().divide(nCal).multiply(100).min(100)
         qLevel = ee.Number.expression(**{
             'expression': '100-((ceil((nCal+1)*(1-alpha))/nCal)*100)',
             'vars': {
@@ -61,25 +92,31 @@ class conformalFeatureClassifier(object):
         return qLevel
 
     # Function 4
-    def _calibration_evaluation_split(self, seed: int = 42):
+    def _calibration_evaluation_split(self, seed: int = 42, repeat: int = 0):
         """
-        Split the data into calibration and test set.
+        Split the data into calibration and test set. The split key is assigned once and cached by the splitter
+        (see splitFunctions), repeated splits are range filters on the same key.
         """
-        # split the calibration data into training and validation sets
-        # create a random column
-        self.data = self.data.randomColumn(seed = seed)
-        # split data
-        self.calibration = self.data.filter(ee.Filter.lt('random', self.split))
-        self.test = self.data.filter(ee.Filter.gte('random', self.split))
+        if self.splitter is None:
+            self.splitter = calibrationSplitter(self.data, seed = seed)
+        self.calibration, self.test = self.splitter.split(self.split, repeat = repeat)
 
     # Function 5
     # Combine functions for calibration
-    def calibrate(self):
+    def calibrate(self, score: str = 'lac', lam: float = 0.01, kReg: int = 1, repeat: int = 0):
         """
         Calibrates the conformal classifier model
+
+        Args:
+            score (str): The nonconformity score function, one of 'lac', 'aps' or 'raps' (see scoreFunctions)
+            lam (float): raps penalty per class beyond kReg
+            kReg (int): raps number of classes that are not penalised
+            repeat (int): Index of a repeated calibration/test split (see calibrationSplitter.split)
         """
+        checkScore(score)
+        self.score, self.lam, self.kReg = score, lam, kReg
         # Get calibration data
-        self._calibration_evaluation_split()
+        self._calibration_evaluation_split(repeat = repeat)
         Cal = self.calibration
 
         # Create class dictionary
@@ -91,15 +128,11 @@ class conformalFeatureClassifier(object):
         # Compute adjusted quantile level
         qLevel = self._computeQLevel(Cal.size())
 
-        # Compute qHat threshold based on qLevel
-        qHat = scores.reduceColumns(**{
-        'reducer':ee.Reducer.percentile([qLevel]), 
-        'selectors': ['score']
-            }).values().get(0)
-        
-        self.qhat = qHat
+        # Compute qHat, the exact order statistic corresponding to qLevel (every class is included if there are
+        # too few calibration features)
+        self.qhat = exactQuantile(scores.aggregate_array('score'), self.alpha, lower = self.score == 'lac')
                 
-        return ee.Feature(None, {'version': self.version,'qLevel': qLevel, 'qHat': self.qhat})
+        return ee.Feature(None, {'version': self.version, 'score': self.score, 'qLevel': qLevel, 'qHat': self.qhat})
 
     # Evaluation
     # Function 1
@@ -155,6 +188,16 @@ class conformalFeatureClassifier(object):
         sets = ee.FeatureCollection(uid.map(lambda id: computeSets(id)))
         return sets
        
+    # Function 1b
+    def _computeSetsArray(self, ft):
+        """
+        Compute the set size and coverage of a test feature from its class scores
+        """
+        scores = self._classScores(ft)
+        inSet = scores.gte(self.qhat) if self.score == 'lac' else scores.lte(self.qhat)
+        return ee.Feature(None, {'setSize': inSet.reduce(ee.Reducer.sum(), [0]).get([0]),
+                                 'CorrectSets': inSet.get([ee.Number(ft.get(self.label)).int()])})
+
     # Function 2
     def _computeSetLength(self, ft):
         """
@@ -178,79 +221,185 @@ class conformalFeatureClassifier(object):
 
     # Function 4
     # Combine functions for evaluation of conformal predictor
-    def evaluate(self):
+    def evaluate(self, verbose: bool = True):
         """
         Evaluates the conformal classifier model
+
+        Args:
+            verbose (bool): If True, print the average set size and coverage (two getInfo calls)
         """
         # Get test data - Used to evaluate conformal classifier
         nTest = self.test.size()
 
-        Sets = self._computeSets()
-        
-        # Compute average set size(sum of set lengths/ number of test label pixels)
-        avgSetSize = Sets.map(lambda ft: self._computeSetLength(ft)).aggregate_sum('setSize').divide(nTest)
+        if self.score == 'lac':
+            Sets = self._computeSets()
+
+            # Compute average set size(sum of set lengths/ number of test label pixels)
+            avgSetSize = Sets.map(lambda ft: self._computeSetLength(ft)).aggregate_sum('setSize').divide(nTest)
 
-        # Evaluate Marginal coverage (based on test set): compute coverage (correct sets/total label pixels/)
-        coverage = Sets.map(lambda ft: self._computeCoverage(ft)).aggregate_sum('CorrectSets').divide(nTest)
+            # Evaluate Marginal coverage (based on test set): compute coverage (correct sets/total label pixels/)
+            coverage = Sets.map(lambda ft: self._computeCoverage(ft)).aggregate_sum('CorrectSets').divide(nTest)
+        else:
+            Sets = self.test.map(lambda ft: self._computeSetsArray(ft))
+            avgSetSize = Sets.aggregate_sum('setSize').divide(nTest)
+            coverage = Sets.aggregate_sum('CorrectSets').divide(nTest)
 
-        print('Average set size:', "{:.2f}".format(avgSetSize.getInfo()))
-        print('Empirical (marginal) coverage:', "{:.2f}".format(coverage.getInfo()))
+        if verbose:
+            print('Average set size:', "{:.2f}".format(avgSetSize.getInfo()))
+            print('Empirical (marginal) coverage:', "{:.2f}".format(coverage.getInfo()))
               
         return ee.Feature(None, {'version': self.version, 'Empirical Marginal Coverage': coverage, 'Average Prediction Set Size': avgSetSize})
+
+    # Function 5
+    def evaluateSplits(self, repeats: int = 100, quantiles: list = [5, 50, 95]):
+        """
+        Evaluates the conformal classifier on repeated calibration/test splits (see calibrationSplitter.split) to
+        estimate the variability of coverage and set size. Scores are computed once, every split is evaluated with
+        array operations on the same scores. Uses the score function (and parameters) of the last calibrate call.
+
+        Args:
+            repeats (int): The number of calibration/test splits
+            quantiles (list): Percentiles (0-100) of the coverage and set size distributions to report
+
+        Returns:
+            ee.Feature with per-split lists ('Empirical Marginal Coverage', 'Average Prediction Set Size', 'qHat')
+             and their mean and percentiles ('Coverage Summary', 'Set Size Summary')
+        """
+        if self.splitter is None:
+            self.splitter = calibrationSplitter(self.data)
+        # Compute the scores of all candidate classes once
+        def scores(ft):
+            classScores = self._classScores(ft)
+            return ft.set('classScores', classScores, 'score', classScores.get([ee.Number(ft.get(self.label)).int()]))
+        table = self.splitter.data.map(scores)
+        classScores = ee.Array(table.aggregate_array('classScores'))
+        lower = self.score == 'lac'
+        # Average set size of the test features
+        def setSize(qHat, testMask):
+            inSet = classScores.gte(qHat) if lower else classScores.lte(qHat)
+            sizes = inSet.reduce(ee.Reducer.sum(), [1]).project([0])
+            return sizes.multiply(testMask).reduce(ee.Reducer.sum(), [0]).get([0])\
+                .divide(testMask.reduce(ee.Reducer.sum(), [0]).get([0]).max(1))
+        splits = evaluateRepeatedSplits(ee.Array(table.aggregate_array(self.splitter.column)),
+                                        ee.Array(table.aggregate_array('score')), self.split, self.alpha, repeats,
+                                        setSize, lower)
+        summary = ee.Reducer.percentile(quantiles).combine(ee.Reducer.mean(), None, True)
+        return ee.Feature(None, {'version': self.version, 'score': self.score, 'repeats': repeats,
+                                 'qHat': splits.get('qHat'),
+                                 'Empirical Marginal Coverage': splits.get('coverage'),
+                                 'Average Prediction Set Size': splits.get('size'),
+                                 'Coverage Summary': ee.List(splits.get('coverage')).reduce(summary),
+                                 'Set Size Summary': ee.List(splits.get('size')).reduce(summary)})
+
+    # Function 6
+    def diagnostics(self, strata: list, bins: dict = None) -> pd.DataFrame:
+        """
+        Coverage and average set size of the test features per stratum (conditional coverage) in one grouped
+        reduction, see diagnosticFunctions.featureDiagnostics.
+
+        Args:
+            strata (list): Numeric property names to stratify by e.g. the label (coverage per class), a region id
+             or 'cluster'
+            bins (dict): Bin width of continuous strata e.g. {'cloudFraction': 0.1}
+
+        Returns:
+            pd.DataFrame indexed by (variable, stratum) with the columns n, coverage and setSize
+        """
+        evaluated = self.test.map(lambda ft: ft.set(self._computeSetsArray(ft).toDictionary()))
+        return featureDiagnostics(evaluated, strata, 'CorrectSets', 'setSize', bins)
     
     # Inference
     # Function 1
     # A binary mask is returned for each potential class.
-    def predict(self, image):
+    def predict(self, image, score: str = None):
         """
         Predicts the conformal classifier model
+
+        Args:
+            image (ee.Image): A multiband image with one probability band per class
+            score (str): The score function. Defaults to the score used during calibration
+
+        Returns:
+            ee.Image with a binary band per class (1 = included in set) and a 'setLength' band
         """
-        # create constant image for threshold
-        qHatImage = ee.Image.constant(self.qhat)
-        # get binary mask, 1(included in set)
-        setMasks = ee.ImageCollection(ee.List(self.bands).map(lambda band:
-            ee.Image(image).select([band]).gte(qHatImage).set('class',band).rename('band')))
-        # get length of set per pixel
-        setLength = ee.ImageCollection(setMasks).sum().rename('setLength')
-        sets = ee.Image(setMasks.toBands().addBands(setLength)).rename(ee.List(self.bands).add('setLength')).toInt8().updateMask(1)
-        return sets
+        if score is not None and score != self.score:
+            raise ValueError(f"qHat was calibrated with the '{self.score}' score. Calibrate with score='{score}' first")
+        return setsImage(image, self.bands, ee.Image.constant(self.qhat), self.score, self.lam, self.kReg)
     
     # The conformalImageClassifier class contains methods to calibrate, evaluate and perform inference for a image collection
 class conformalImageClassifier(object):
-    def __init__(self, data: ee.ImageCollection, scale: int, bands: list, alpha: float, split: float, label: str, version: str):
+    def __init__(self, data: ee.ImageCollection, scale: int, bands: list, alpha: float, split: float, label: str, version: str,
+                 splitter: calibrationSplitter = None):
         self.data = data
+        # calibrationSplitter of data e.g. for spatial block or cluster splits. Random per image by default
+        self.splitter = splitter
         self.scale = scale
         self.bands = bands
         self.alpha = alpha
         self.split = split
         self.label = label
         self.version = version
+        self.score = 'lac'
+        self.lam = 0.01
+        self.kReg = 1
 
     # Calibration
     # Function 1
-    def _computeScores(self, image):
+    def _scoreImage(self, image: ee.Image, classScores: bool = False) -> ee.Image:
         """
-        A function to compute nonconformity scores and number of pixels in label image
+        Compute the nonconformity score of every labelled pixel of an image.
 
         Args:
-            image (ee.Image): 
+            image (ee.Image): An image with the class probability bands and the label band
+            classScores (bool): If True, also add the score of every class ('score_0', 'score_1', ...)
 
         Returns:
-            ee.Feature with 'score' property containing nonconformity score
-
+            ee.Image with the bands 'score' (score of the reference class) and 'class' (the label)
         """
+        image = ee.Image(image)
         # Select the label band
         labelImage = image.select(self.label).toInt8()
-        # Get probs for reference class (used for computing nonconformity score)
-        scores = image.select(self.bands).toArray().arrayGet(labelImage)
-        # Get the number of pixels in the label image
-        nPixels = labelImage.reduceRegion(**{'reducer':ee.Reducer.count(),
-                                             'geometry': image.geometry(),
-                                             'scale': self.scale,
-                                             'tileScale': 16,
-                                             'maxPixels': 1e9}).getNumber('label')
-        return scores.rename('score').set('nPixels', nPixels)
-    
+        # Get score of reference class (probability for lac)
+        allScores = classScoresImage(image.select(self.bands).toArray(), len(self.bands), self.score, self.lam,
+                                     self.kReg)
+        bands = allScores.arrayGet(labelImage).rename('score').addBands(labelImage.rename('class'))
+        if classScores:
+            bands = bands.addBands(allScores.arrayFlatten([[f'score_{i}' for i in range(len(self.bands))]]))
+        return bands
+
+    # Function 1b
+    def _computeScores(self, collection: ee.ImageCollection = None, classScores: bool = False) -> ee.FeatureCollection:
+        """
+        Sample the nonconformity score of every labelled pixel. Each image is sampled separately and the samples
+        are pooled, so pixels of overlapping images are all kept. Every pixel becomes a feature: use for small
+        collections (or a coarse scale) only, calibrate uses histograms of the scores instead.
+
+        Args:
+            collection (ee.ImageCollection): The images to sample. Defaults to the calibration images
+            classScores (bool): If True, also sample the score of every class ('score_0', 'score_1', ...) and copy
+             the split key of the image (see calibrationSplitter) to its pixels
+
+        Returns:
+            ee.FeatureCollection with one (null geometry) feature per pixel and the properties 'score' and 'class'
+        """
+        column = self.splitter.column if classScores else None
+        def samplePixels(image):
+            image = ee.Image(image)
+            # every (unmasked) pixel is sampled
+            samples = self._scoreImage(image, classScores).sample(**{
+                'region': image.geometry(),
+                'scale': self.scale,
+                'tileScale': 16,
+                'geometries': False})
+            return samples.map(lambda ft: ft.set(column, image.get(column))) if classScores else samples
+        return ee.ImageCollection(self.calibration if collection is None else collection).map(samplePixels).flatten()
+
+    def _maxScore(self) -> float:
+        """The largest possible score: 1 for lac and aps, 1 + lam * (nClasses - kReg) for raps"""
+        if self.score == 'raps':
+            return 1 + self.lam * max(len(self.bands) - self.kReg, 0)
+        return 1
+
     # Function 2
     def _createClassDictionary(self):
         """ Create dictionary that maps label values to property names (probability of classes)
@@ -276,6 +425,9 @@ class conformalImageClassifier(object):
             qLevel (ee.Number): The adjusted 
 
         """
+        if self.score != 'lac':
+            # higher scores are less conforming (aps, raps): upper quantile
+            return ee.Number(nCal).add(1).multiply(1 - self.alpha).ceil().divide(nCal).multiply(100).min(100)
         qLevel = ee.Number.expression(**{
             'expression': '100-((ceil((nCal+1)*(1-alpha))/nCal)*100)',
             'vars': {
@@ -285,65 +437,84 @@ class conformalImageClassifier(object):
         return qLevel
     
     # Function 4
-    def _computeQHat(self, image, qLevel):
+    def _computeClassQHat(self, nBins: int = 10000):
         """
-        Get nonconformaity score that matches with qLevel
+        Get a qHat per class (Mondrian/class-conditional calibration). The scores of each calibration image are
+        counted in one histogram grouped by reference class (see scoreHistogram), the counts are summed over the
+        images and qHat of a class is the conservative bin edge of the ceil((n_c+1)(1-alpha)) order statistic of its
+        n_c scores (see histogramQuantile).
 
         Args:
-            image (ee.Image): The image to compute QHat for
+            nBins (int): The number of histogram bins of the scores
 
         Returns:
-            qHat (ee.image): input image with qHat value for the image set as a property
-        """
-        qHat = ee.Image(image).reduceRegion(**{'reducer':ee.Reducer.percentile([qLevel]),
-                                                'geometry': image.geometry(),
-                                                'scale': self.scale,
-                                                'tileScale': 16,
-                                                'maxPixels': 1e9}).get('score')
-        return image.set('qHat', qHat)
+            qLevel (ee.List), qHat (ee.List): The adjusted quantile level and qHat of each class (in band order)
+        """
+        nClasses = len(self.bands)
+        lower = self.score == 'lac'
+        # largest possible score: too few (or no) calibration pixels include the class in every set
+        qMax = 1 + self.lam * max(nClasses - self.kReg, 0)
+        counts = scoreHistogram(self.calibration, self._scoreImage, 0, self._maxScore(), self.scale, nBins,
+                                groups = nClasses)
+        qLevel, qHat = [], []
+        for cls in range(nClasses):
+            classCounts = counts.slice(0, cls, cls + 1).project([1])
+            qLevel.append(self._computeQLevel(classCounts.reduce(ee.Reducer.sum(), [0]).get([0]).max(1)))
+            qHat.append(histogramQuantile(classCounts, 0, self._maxScore(), self.alpha, lower = lower,
+                                          bound = 0 if lower else qMax))
+        return ee.List(qLevel), ee.List(qHat)
 
     # Function 5
-    def _calibration_evaluation_split(self, seed: int = 42):
+    def _calibration_evaluation_split(self, seed: int = 42, repeat: int = 0):
         """
-        Split the data into calibration and test set.
+        Split the data into calibration and test set. The split key is assigned once and cached by the splitter
+        (see splitFunctions), repeated splits are range filters on the same key.
         """
-        # split the calibration data into training and validation sets
-        # create a random column
-        self.data = self.data.randomColumn(seed = seed)
-        # split data
-        self.calibration = self.data.filter(ee.Filter.lt('random', self.split))
-        self.test = self.data.filter(ee.Filter.gte('random', self.split))
+        if self.splitter is None:
+            self.splitter = calibrationSplitter(self.data, seed = seed)
+        self.calibration, self.test = self.splitter.split(self.split, repeat = repeat)
 
     # Function 6
     # Combine functions for calibration
-    def calibrate(self):
-        """
-        Calibrates the conformal classifier model
+    def calibrate(self, score: str = 'lac', lam: float = 0.01, kReg: int = 1, mondrian: bool = False, repeat: int = 0,
+                  nBins: int = 10000):
         """
+        Calibrates the conformal classifier model. The scores of the calibration pixels are counted in a histogram
+        (see scoreHistogram) and qHat is the conservative edge of the bin of the conformal order statistic, so qHat
+        is at most one bin width (the largest score / nBins) from the exact order statistic.
+
+        Args:
+            score (str): The nonconformity score function, one of 'lac', 'aps' or 'raps' (see scoreFunctions)
+            lam (float): raps penalty per class beyond kReg
+            kReg (int): raps number of classes that are not penalised
+            mondrian (bool): If True, calibrate a qHat per class (class-conditional coverage). Improves the
+             coverage of rare classes. qHat is then a list with one value per class (band order)
+            repeat (int): Index of a repeated calibration/test split (see calibrationSplitter.split)
+            nBins (int): The number of histogram bins of the scores
+        """
+        checkScore(score)
+        self.score, self.lam, self.kReg = score, lam, kReg
         # Get calibration image data used to calibrate conformal classifier
-        self._calibration_evaluation_split()
+        self._calibration_evaluation_split(repeat = repeat)
 
         # Create class dictionary
         self._createClassDictionary()
 
-        # Compute nonconformaity scores
-        scores = ee.FeatureCollection(ee.ImageCollection(self.calibration).map(lambda img: self._computeScores(img)))
+        if mondrian:
+            qLevel, self.qhat = self._computeClassQHat(nBins)
+            return ee.Feature(None, {'version': self.version, 'score': self.score, 'mondrian': True,
+                                     'qLevel': qLevel, 'qHat': self.qhat})
 
-        # compute total calibration (label) pixels
-        nPixelsCal = scores.aggregate_sum('nPixels')
+        # Count the nonconformity scores of all calibration pixels
+        counts = scoreHistogram(self.calibration, self._scoreImage, 0, self._maxScore(), self.scale, nBins)
 
         # Compute adjusted quantile level
-        qLevel = self._computeQLevel(nPixelsCal)
+        qLevel = self._computeQLevel(counts.reduce(ee.Reducer.sum(), [0]).get([0]))
 
-        # Compute qHat threshold based on qLevel
-        qHat = scores.map(lambda img: self._computeQHat(img, qLevel)).reduceColumns(**{
-        'reducer':ee.Reducer.percentile([qLevel]), 
-        'selectors': ['qHat']
-            }).values().get(0)
-        
-        self.qhat = qHat
+        # qHat is the conformal order statistic of the binned pixel scores
+        self.qhat = histogramQuantile(counts, 0, self._maxScore(), self.alpha, lower = self.score == 'lac')
                 
-        return ee.Feature(None, {'version': self.version,'qLevel': qLevel, 'qHat': self.qhat})
+        return ee.Feature(None, {'version': self.version, 'score': self.score, 'qLevel': qLevel, 'qHat': self.qhat})
     
     # Evaluation
     # Function 1
@@ -360,16 +531,10 @@ class conformalImageClassifier(object):
             The image contains a property called 'sumPixels' that contains the sum of pixels in the image.
 
         """
-        # Create a constant image with qhat at all pixels
-        qHatImage = ee.Image.constant(self.qhat)
-        # Compute binary mask for each candidate class. 1= included in set, 0 = not included in set
-        setMasks = ee.ImageCollection(ee.List(self.bands).map(lambda band: 
-                                                     ee.Image(image).select([band])
-                                                     .gte(qHatImage).set('class',band).rename('band')))
-        # Compute the length of each set/ for each pixel
-        setLength = ee.ImageCollection(setMasks).sum().rename('setLength')
-        # Format output sets
-        sets = ee.Image(setMasks.toBands().addBands(setLength)).rename(ee.List(self.bands).add('setLength')).toInt8().updateMask(1)
+        # Compute binary mask for each candidate class (1= included in set, 0 = not included in set)
+        # and the length of each set/ for each pixel
+        sets = setsImage(image, self.bands, ee.Image.constant(self.qhat), self.score, self.lam, self.kReg)
+        setLength = sets.select('setLength')
         # Sum the lengths of all sets in set length image- used to compute average set size
         sumPixels = setLength.reduceRegion(**{'reducer':ee.Reducer.sum(),
                                               'geometry': image.geometry(),
@@ -417,9 +582,12 @@ class conformalImageClassifier(object):
     
     # Function 3
     # Combine functions for evaluation of conformal predictor
-    def evaluate(self):
+    def evaluate(self, verbose: bool = True):
         """
         Evaluates the conformal classifier model
+
+        Args:
+            verbose (bool): If True, print the average set size and coverage (two getInfo calls)
         """
         Sets = ee.ImageCollection(self.test.map(lambda image: self._computeSets(image)))
 
@@ -435,24 +603,93 @@ class conformalImageClassifier(object):
         # Compute average set size(sum of set lengths/ number of test label pixels)
         avgSetSize = ee.ImageCollection(Sets).aggregate_sum('sumPixels').divide(nPixelsTest)
 
-        print('Average set size:', "{:.2f}".format(avgSetSize.getInfo()))
-        print('Empirical (marginal) coverage:', "{:.2f}".format(coverage.getInfo()))
+        if verbose:
+            print('Average set size:', "{:.2f}".format(avgSetSize.getInfo()))
+            print('Empirical (marginal) coverage:', "{:.2f}".format(coverage.getInfo()))
               
         return ee.Feature(None, {'version': self.version, 'Empirical Marginal Coverage': coverage, 'Average Prediction Set Size': avgSetSize})
 
+    # Function 3b
+    def evaluateSplits(self, repeats: int = 100, quantiles: list = [5, 50, 95]):
+        """
+        Evaluates the conformal classifier on repeated calibration/test splits of the images (see
+        calibrationSplitter.split) to estimate the variability of coverage and set size. The scores of every
+        labelled pixel are sampled once and every split is evaluated with array operations on the same scores, so
+        the pixels of all images must fit in one array (use a coarser scale for large collections). Coverage and
+        set size are per pixel. Uses the score function (and parameters) of the last calibrate call.
+
+        Args:
+            repeats (int): The number of calibration/test splits
+            quantiles (list): Percentiles (0-100) of the coverage and set size distributions to report
+
+        Returns:
+            ee.Feature with per-split lists ('Empirical Marginal Coverage', 'Average Prediction Set Size', 'qHat')
+             and their mean and percentiles ('Coverage Summary', 'Set Size Summary')
+        """
+        if self.splitter is None:
+            self.splitter = calibrationSplitter(self.data)
+        # Compute the scores of all candidate classes once
+        table = self._computeScores(self.splitter.data, classScores = True)
+        names = [f'score_{i}' for i in range(len(self.bands))]
+        classScores = ee.Array(table.reduceColumns(ee.Reducer.toList(len(names)), names).get('list'))
+        lower = self.score == 'lac'
+        # Average set size of the test pixels
+        def setSize(qHat, testMask):
+            inSet = classScores.gte(qHat) if lower else classScores.lte(qHat)
+            sizes = inSet.reduce(ee.Reducer.sum(), [1]).project([0])
+            return sizes.multiply(testMask).reduce(ee.Reducer.sum(), [0]).get([0])\
+                .divide(testMask.reduce(ee.Reducer.sum(), [0]).get([0]).max(1))
+        splits = evaluateRepeatedSplits(ee.Array(table.aggregate_array(self.splitter.column)),
+                                        ee.Array(table.aggregate_array('score')), self.split, self.alpha, repeats,
+                                        setSize, lower)
+        summary = ee.Reducer.percentile(quantiles).combine(ee.Reducer.mean(), None, True)
+        return ee.Feature(None, {'version': self.version, 'score': self.score, 'repeats': repeats,
+                                 'qHat': splits.get('qHat'),
+                                 'Empirical Marginal Coverage': splits.get('coverage'),
+                                 'Average Prediction Set Size': splits.get('size'),
+                                 'Coverage Summary': ee.List(splits.get('coverage')).reduce(summary),
+                                 'Set Size Summary': ee.List(splits.get('size')).reduce(summary)})
+
+    # Function 4
+    def diagnostics(self, strata: list, properties: list = None, bins: dict = None) -> pd.DataFrame:
+        """
+        Coverage and average set size of the test pixels per stratum (conditional coverage). One grouped
+        reduceRegion per test image, combined in pandas (see diagnosticFunctions.imageDiagnostics).
+
+        Args:
+            strata (list): Band names (e.g. the label for coverage per class, or a region band) or, with properties,
+             image property names to stratify by
+            properties (list): Strata that are image properties e.g. a cloud fraction
+            bins (dict): Bin width of continuous strata e.g. {'CLOUDY_PIXEL_PERCENTAGE': 10}
+
+        Returns:
+            pd.DataFrame indexed by (variable, stratum) with the columns n, coverage and setLength
+        """
+        def evaluated(image):
+            image = ee.Image(image)
+            sets = setsImage(image, self.bands, ee.Image.constant(self.qhat), self.score, self.lam, self.kReg)
+            labelImage = image.select(self.label)
+            covered = sets.select(self.bands).toArray().arrayGet(labelImage.toInt8()).updateMask(labelImage.mask())
+            return image.addBands([covered.rename('CorrectSets'), sets.select('setLength')])
+        return imageDiagnostics(self.test.map(evaluated), strata, self.scale, 'CorrectSets', 'setLength',
+                                properties, bins)
+
     # Inference
     #  Function 1
     #  A binary mask is returned for each candidate class.
-    def predict(self, image):
+    def predict(self, image, score: str = None):
         """
         Predicts the conformal classifier model
+
+        Args:
+            image (ee.Image): A multiband image with one probability band per class
+            score (str): The score function. Defaults to the score used during calibration
+
+        A per-class qHat (mondrian calibration) is applied as a constant image with one band per class.
+
+        Returns:
+            ee.Image with a binary band per class (1 = included in set) and a 'setLength' band
         """
-        # create constant image for threshold
-        qHatImage = ee.Image.constant(self.qhat)
-        # get binary mask, 1(included in set)
-        setMasks = ee.ImageCollection(ee.List(self.bands).map(lambda band:
-            ee.Image(image).select([band]).gte(qHatImage).set('class',band).rename('band')))
-        # get length of set per pixel
-        setLength = ee.ImageCollection(setMasks).sum().rename('setLength')
-        sets = ee.Image(setMasks.toBands().addBands(setLength)).rename(ee.List(self.bands).add('setLength')).toInt8().updateMask(1)
-        return sets
\ No newline at end of file
+        if score is not None and score != self.score:
+            raise ValueError(f"qHat was calibrated with the '{self.score}' score. Calibrate with score='{score}' first")
+        return setsImage(image, self.bands, ee.Image.constant(self.qhat), self.score, self.lam, self.kReg)
\ No newline at end of file
@@ -1,7 +1,12 @@
 import ee
+import pandas as pd
 from typing import Union
 from geeml.utils import eeprint
 
+from code.scoreFunctions import exactQuantile, scoreHistogram, histogramQuantile
+from code.splitFunctions import calibrationSplitter, evaluateRepeatedSplits
+from code.diagnosticFunctions import featureDiagnostics, imageDiagnostics
+
 # steps
 # Calibration
     # compute nonconformity scores
@@ -14,14 +19,115 @@ from geeml.utils import eeprint
     # add and subtract qhat to get upper and lower bound. 
     # compute length
 
+def checkMethod(method: str, sigma: str = None, methods: tuple = ('residual', 'normalized')):
+    """Raise a ValueError for unsupported methods or a missing sigma (difficulty) property/band"""
+    if method not in methods:
+        raise ValueError(f'method should be one of {methods}, not {method}')
+    if method == 'normalized' and sigma is None:
+        raise ValueError("The 'normalized' method requires a sigma property/band name")
+
+def checkOutput(output: str):
+    """Raise a ValueError for unsupported predict outputs"""
+    if output not in ('full', 'compact'):
+        raise ValueError(f"output should be 'full' or 'compact', not {output}")
+
+def compactIntervals(prediction: ee.Image, halfWidth: ee.Image, qHat, widthScale: float = 0.01) -> ee.Image:
+    """
+    Encode prediction intervals as the prediction plus an int16 half-width band (halfWidth * widthScale), or only the
+    prediction with qHat as metadata when the half-width is constant (halfWidth = None). Half-widths are rounded up
+    so the decoded intervals are never narrower than the calibrated ones. See decodeIntervals.
+
+    Args:
+        prediction (ee.Image): The (centre) prediction
+        halfWidth (ee.Image): The per-pixel half-width of the interval, None if it is constant (qHat)
+        qHat (ee.Number): The calibrated threshold
+        widthScale (float): The half-width units of the int16 band e.g. 0.01 for cm when predicting in m. Half-widths
+         above 32767 * widthScale are clipped
+
+    Returns:
+        ee.Image with a 'prediction' band (and an int16 'halfWidth' band) and the properties qHat, intervalEncoding
+         ('constant' or 'band'), halfWidthScale and halfWidthOffset
+    """
+    output = prediction.rename('prediction').set('qHat', qHat)
+    if halfWidth is None:
+        return output.set('intervalEncoding', 'constant')
+    encoded = halfWidth.divide(widthScale).ceil().min(32767).toInt16().rename('halfWidth')
+    return output.addBands(encoded).set({'intervalEncoding': 'band', 'halfWidthScale': widthScale,
+                                         'halfWidthOffset': 0})
+
+def decodeIntervals(image: ee.Image) -> ee.Image:
+    """
+    Decode an image encoded by compactIntervals into float lower, upper and width bands.
+
+    Args:
+        image (ee.Image): Output of predict(..., output = 'compact')
+
+    Returns:
+        ee.Image with the bands prediction, lower, upper and width
+    """
+    image = ee.Image(image)
+    prediction = image.select('prediction')
+    halfWidth = ee.Image(ee.Algorithms.If(image.bandNames().contains('halfWidth'),
+        image.select('halfWidth').multiply(image.getNumber('halfWidthScale')).add(image.getNumber('halfWidthOffset')),
+        ee.Image.constant(image.getNumber('qHat'))))
+    lower = prediction.subtract(halfWidth).rename('lower')
+    upper = prediction.add(halfWidth).rename('upper')
+    return prediction.addBands([lower, upper, upper.subtract(lower).rename('width')])
+
+def compactFeatureIntervals(feature: ee.Feature, prediction: ee.Number, halfWidth: ee.Number, qHat,
+                            widthScale: float = 0.01) -> ee.Feature:
+    """
+    Encode the prediction interval of a feature as compactIntervals does for images: a 'prediction' property plus
+    an int16 'halfWidth' property (halfWidth * widthScale), or only the prediction when the half-width is constant
+    (halfWidth = None), and the same metadata properties. See decodeFeatureIntervals.
+
+    Args:
+        feature (ee.Feature): The feature to add the properties to
+        prediction (ee.Number): The (centre) prediction
+        halfWidth (ee.Number): The half-width of the interval, None if it is constant (qHat)
+        qHat (ee.Number): The calibrated threshold
+        widthScale (float): The half-width units of the int16 property
+
+    Returns:
+        ee.Feature with the properties prediction (and halfWidth), qHat, intervalEncoding ('constant' or 'band'),
+         halfWidthScale and halfWidthOffset
+    """
+    output = feature.set({'prediction': prediction, 'qHat': qHat})
+    if halfWidth is None:
+        return output.set('intervalEncoding', 'constant')
+    encoded = ee.Number(halfWidth).divide(widthScale).ceil().min(32767).int16()
+    return output.set({'halfWidth': encoded, 'intervalEncoding': 'band', 'halfWidthScale': widthScale,
+                       'halfWidthOffset': 0})
+
+def decodeFeatureIntervals(feature: ee.Feature) -> ee.Feature:
+    """
+    Decode a feature encoded by compactFeatureIntervals into float lower, upper and width properties.
+
+    Args:
+        feature (ee.Feature): Output of predict(..., output = 'compact') for a feature
+
+    Returns:
+        ee.Feature with the additional properties lower, upper and width
+    """
+    feature = ee.Feature(feature)
+    prediction = feature.getNumber('prediction')
+    halfWidth = ee.Number(ee.Algorithms.If(ee.String(feature.get('intervalEncoding')).equals('band'),
+        feature.getNumber('halfWidth').multiply(feature.getNumber('halfWidthScale'))
+            .add(feature.getNumber('halfWidthOffset')),
+        feature.getNumber('qHat')))
+    lower = prediction.subtract(halfWidth)
+    upper = prediction.add(halfWidth)
+    return feature.set({'lower': lower, 'upper': upper, 'width': upper.subtract(lower)})
+
 class conformalFeatureRegressor(object):
     """
     A class for calibrating and evaluating a conformal predictor to perform inference for a regression task.
     An input FeatureCollection with properties of the reference (label) and predicted values (bands).
-    The output can be in the form of a FeatureCollection or an ImageCollection. Currently the only method supported
-    is based on the absolute residuals.
+    The output can be in the form of a FeatureCollection or an ImageCollection. Two methods are supported,
+    absolute residuals ('residual') and residuals normalised by a per-sample difficulty estimate ('normalized').
     """
-    def __init__(self, data: ee.FeatureCollection, bands: list, alpha: float, label: str, version: str):
+    def __init__(self, data: ee.FeatureCollection, bands: list, alpha: float, label: str, version: str,
+                 splitter: calibrationSplitter = None):
         """
         Args:
             data (ee.FeatureCollection): A FeatureCollection that contains two compulsory properties;
@@ -32,35 +138,43 @@ class conformalFeatureRegressor(object):
             label (str): A feature-level property name corresponding to the reference/expected value.
             version (str): A user-provided string to indicate details of the experiment or date of the experiment.
               By default a datetime stamp is provided in the format (ddmmyyyyssmmhh)
+            splitter (calibrationSplitter): Splitter of data e.g. for spatial block or cluster splits (see
+              splitFunctions). Random per feature/image by default
         """
         self.data = data
+        self.splitter = splitter
         self.bands = bands
         self.alpha = alpha
         self.label = label
         self.version = version
+        self.method = 'residual'
+        self.sigma = None
     
     # Calibration stage
     # Function 1
-    def _calibration_evaluation_split(self, split: float, seed: int = 42):
+    def _calibration_evaluation_split(self, split: float, seed: int = 42, repeat: int = 0):
         """
-        Split the data into a calibration and test set.
+        Split the data into a calibration and test set. The split key is assigned once per seed and cached by the
+        splitter (see splitFunctions), repeated splits are range filters on the same key.
         """
-
-        # split the calibration data into training and validation sets
-        # add a random column with a uniform distribution
-        self.data = self.data.randomColumn(seed = seed)
-        # split data into calibration and test data
-        self.calibration = self.data.filter(ee.Filter.lt('random', split))
-        self.test = self.data.filter(ee.Filter.gte('random', split))
+        if self.splitter is None:
+            self.splitter = calibrationSplitter(self.data, seed = seed)
+        self.splitter = self.splitter.withSeed(seed)
+        self.calibration, self.test = self.splitter.split(split, repeat = repeat)
 
     # Function 2
-    def calibrate(self, split: float, seed: int = 42):
-        """ Calibrate a conformal regressor on the calibration set based on absolute residual (|y-yhat|)nonconformity scores.
+    def calibrate(self, split: float, seed: int = 42, method: str = 'residual', sigma: str = None, repeat: int = 0):
+        """ Calibrate a conformal regressor on the calibration set based on absolute residual (|y-yhat|) or
+        normalised residual (|y-yhat|/sigma) nonconformity scores.
 
         Args:
             split (float): The proportion of the data used to calibrate a conformal regressor. The remainder is used for
              evaluating the conformal predictor.
             seed (int): The seed used to split the data
+            method (str): Either 'residual' or 'normalized'
+            sigma (str): The 'normalized' method only. A feature-level property (or band) name with a per-sample
+             difficulty estimate e.g. the standard deviation of an ensemble or a kNN residual. Should be > 0.
+            repeat (int): Index of a repeated calibration/test split (see calibrationSplitter.split)
 
         Returns:
             (ee.Feature): ee.Feature that contains two properties qLevel and qHat. Here, qLevel corresponds to
@@ -68,104 +182,156 @@ class conformalFeatureRegressor(object):
               0.9. qHat represents a threshold of the target variable to be estimated.
             
         """ 
+        checkMethod(method, sigma)
         self.split = split
         self.seed = seed
-        # Compute nonconformity scores (|y-yhat|)
+        self.method = method
+        self.sigma = sigma
+        # Compute nonconformity scores (|y-yhat| or |y-yhat|/sigma)
         def nonConformityScores(feature):
-            return feature.set('score', (feature.getNumber(self.bands).subtract(feature.getNumber(self.label)).abs()))
-        # Compute quantile level (qLevel) after finite sample correction
-        def qLevel():
-            self.qlevel = ee.Number(1).subtract(ee.Number(self.alpha))
-            return self.qlevel
-        # Compute qLevel for nonconformity scores (qHat)
-        def qHat(scores):
-            qLevel()
-            return ee.Number(scores.reduce(ee.Reducer.percentile([self.qLevel.multiply(100)])))
-        
+            score = feature.getNumber(self.bands).subtract(feature.getNumber(self.label)).abs()
+            if self.method == 'normalized':
+                score = score.divide(feature.getNumber(self.sigma))
+            return feature.set('score', score)
         # Split data
-        self._calibration_evaluation_split(split = self.split, seed = self.seed)
+        self._calibration_evaluation_split(split = self.split, seed = self.seed, repeat = repeat)
         # Compute nonconformity scores and convert to array
         scores = self.calibration.map(lambda ft: nonConformityScores(ft)).aggregate_array('score')
         
-        # Compute qhat
-        self.qhat = ee.Number(qHat(scores))
+        # Compute quantile level (qLevel) after finite sample correction
+        nCal = scores.size()
+        self.qlevel = nCal.add(1).multiply(1 - self.alpha).ceil().divide(nCal).min(1)
+        # Compute qhat, the exact ceil((n+1)(1-alpha))-th smallest score
+        self.qhat = exactQuantile(scores, self.alpha)
 
-        return ee.Feature(None, {'qLevel': self.qLevel, 'qHat': self.qhat})
+        return ee.Feature(None, {'method': self.method, 'qLevel': self.qlevel, 'qHat': self.qhat})
     
     # Inference Stage
     # Function 1
-    def predict(self, input: Union(ee.Image, ee.Feature)):
+    def predict(self, input: Union[ee.Image, ee.Feature], output: str = 'full', widthScale: float = 0.01):
         """
         Quantify uncertainty for a ee.Feature or ee.Image.
 
         Args:
             input (ee.Image or ee.Feature): If an ee.Image input is provided then a single band image should be provided
-             containing the predictions from a regressor. If a ee.Feature is provided, then a property name matching that
-             of the 'band' argument should be provided.
+             containing the predictions from a regressor (and a sigma band for the 'normalized' method). If a ee.Feature
+             is provided, then a property name matching that of the 'band' argument should be provided.
+            output (str): 'full' adds float lower, upper and width bands/properties. 'compact' returns the prediction
+             and, for the 'normalized' method, a half-width scaled to int16 (see compactIntervals and
+             decodeIntervals, compactFeatureIntervals and decodeFeatureIntervals for features).
+             With the 'residual' method the half-width is qHat for every pixel and only stored as metadata
+            widthScale (float): 'compact' only. The units of the int16 half-width
         
         Returns:
             An ee.Image or ee.Feature (corresponds to the input type) with three additional bands/properties, specifically,
             1) lower, 2) upper and 3) width. lower corresponds to the lower bound of the prediction interval. upper corresponds
             to the upper bound of the prediction interval. While width corresponds to the difference between the upper and lower
-            bound (upper - lower) and represents the prediction width. Owing to the absolute residual method used, all widths
-            should be the same.
+            bound (upper - lower) and represents the prediction width. With the absolute residual method, all widths
+            should be the same. With the 'normalized' method the interval is yhat +- qHat * sigma.
              
         """
-        # Check input type
-        if input.name().getInfo() == 'ee.Image':
-            # Create a constant image for qhat
-            qHatImage = ee.Image.constant(self.qHat)
-            # Compute the lower, upper bound of the prediction interval and the width between the two
-            lower = ee.Image(input).subtract(qHatImage).rename('lower')
-            upper = ee.Image(input).add(qHatImage).rename('upper')
-            width = upper.subtract(lower).rename('width')
-            # Add output bands to final output
-            output = input.addBands([lower, upper, width]) 
-        elif input.name().getInfo() == 'ee.Feature':
-            # Compute the lower, upper bound of the prediction interval and the width between the two
-            lower  = ee.Feature(input).getNumber(self.band).subtract(self.qhat).rename('lower')
-            upper = ee.Feature(input).getNumber(self.band).add(self.qhat).rename('upper')
-            width = upper.subtract(lower).rename('width')
-            # Add output properties to the input feature
-            output = ee.Feature(input).set({'lower': lower, 'upper': upper, 'width': width})
-        return output
+        checkOutput(output)
+        # Dispatch on the (client-side) Python type, no server round trip
+        if isinstance(input, ee.Image):
+            return self._predictImage(input, ee.Image.constant(self.qhat), output, widthScale)
+        if isinstance(input, ee.Feature):
+            return self._predictFeature(input, output, widthScale)
+        raise TypeError(f'input should be an ee.Image or ee.Feature, not {type(input).__name__}')
+
+    # Function 1b
+    def predictCollection(self, collection: Union[ee.ImageCollection, ee.FeatureCollection], output: str = 'full',
+                          widthScale: float = 0.01):
+        """
+        Quantify uncertainty for every image/feature of a collection with one shared qHat constant, so that batch
+        inference over many tiles builds a single graph.
+
+        Args:
+            collection (ee.ImageCollection or ee.FeatureCollection): images/features as described in predict
+            output (str): 'full' or 'compact' (see predict)
+            widthScale (float): 'compact' only. The units of the int16 half-width
+
+        Returns:
+            ee.ImageCollection or ee.FeatureCollection (corresponds to the input type), see predict
+        """
+        checkOutput(output)
+        if isinstance(collection, ee.ImageCollection):
+            qHatImage = ee.Image.constant(self.qhat)
+            return collection.map(lambda image: self._predictImage(ee.Image(image), qHatImage, output, widthScale))
+        if isinstance(collection, ee.FeatureCollection):
+            return collection.map(lambda ft: self._predictFeature(ee.Feature(ft), output, widthScale))
+        raise TypeError(f'collection should be an ee.ImageCollection or ee.FeatureCollection, not {type(collection).__name__}')
+
+    def _predictImage(self, input: ee.Image, qHatImage: ee.Image, output: str, widthScale: float) -> ee.Image:
+        """Prediction intervals of an image (see predict). qHatImage is the constant qHat image"""
+        prediction = input.select(self.bands)
+        if output == 'compact':
+            halfWidth = input.select(self.sigma).multiply(qHatImage) if self.method == 'normalized' else None
+            return compactIntervals(prediction, halfWidth, self.qhat, widthScale)
+        # Scale the constant qhat image by sigma for the normalized method
+        halfWidth = qHatImage
+        if self.method == 'normalized':
+            halfWidth = halfWidth.multiply(input.select(self.sigma))
+        # Compute the lower, upper bound of the prediction interval and the width between the two
+        lower = prediction.subtract(halfWidth).rename('lower')
+        upper = prediction.add(halfWidth).rename('upper')
+        width = upper.subtract(lower).rename('width')
+        # Add output bands to final output
+        return input.addBands([lower, upper, width])
+
+    def _predictFeature(self, input: ee.Feature, output: str, widthScale: float) -> ee.Feature:
+        """Prediction intervals of a feature (see predict)"""
+        prediction = input.getNumber(self.bands)
+        halfWidth = ee.Number(self.qhat)
+        if self.method == 'normalized':
+            halfWidth = halfWidth.multiply(input.getNumber(self.sigma))
+        if output == 'compact':
+            # the (constant) residual half-width is qHat, only the normalized half-width is stored
+            return compactFeatureIntervals(input, prediction, halfWidth if self.method == 'normalized' else None,
+                                           self.qhat, widthScale)
+        # Compute the lower, upper bound of the prediction interval and the width between the two
+        lower = prediction.subtract(halfWidth)
+        upper = prediction.add(halfWidth)
+        width = upper.subtract(lower)
+        # Add output properties to the input feature
+        return input.set({'lower': lower, 'upper': upper, 'width': width})
 
     
     # Evaluation stage
     # Function 1
     def _checkInclusion(self, feature):
         """
-        Checks if the predicted value falls within the upper and lower bounds of the prediction interval
+        Checks if the reference value falls within the upper and lower bounds of the prediction interval
 
         Args: 
-            feature (ee.Feature): A feature with a prediction, lower and upper bound.
+            feature (ee.Feature): A feature with a reference value, lower and upper bound.
             
         Returns:
-            A null feature (no geometry) with a property called 'CorrectSets' and a value of 1, if the predicted
+            A null feature (no geometry) with a property called 'CorrectSets' and a value of 1, if the reference
              value falls within the prediction interval and a zero if not.
 
         """
-        prediction = feature.get(self.band)
-        lower = feature.get('lower')
-        upper = feature.get('upper')
-        result = ee.Algorithms.If(prediction.gte(lower).And(prediction.lte(upper)), # Check if the list contains the string
-          1,                       # If yes, return 1
-          0                        # If no, return 0
-        )
+        label = feature.getNumber(self.label)
+        lower = feature.getNumber('lower')
+        upper = feature.getNumber('upper')
+        # 1 if the interval contains the reference value, 0 if not
+        result = label.gte(lower).And(label.lte(upper))
         return ee.Feature(None,{'CorrectSets':result})
     
     # Function 2
-    def evaluate(self):
+    def evaluate(self, verbose: bool = True):
         """
         Evaluates the conformal classifier model
 
+        Args:
+            verbose (bool): If True, print the average width and coverage (two getInfo calls)
+
         Returns:
             An ee.Feature with three properties, the empirical marginal coverage, Average prediction
              interval width and the version information.
 
         """
         # Compute lower and upper bounds of interval
-        Intervals = self.test.map(lambda input: self.predict(input))
+        Intervals = self.predictCollection(self.test)
         
         # Compute average set size(sum of set lengths/ number of test label pixels)
         avgSetSize = Intervals.aggregate_mean('width')
@@ -173,53 +339,143 @@ class conformalFeatureRegressor(object):
         # Evaluate Marginal coverage (based on test set): compute coverage (correct sets/total label pixels/)
         coverage = Intervals.map(lambda ft: self._checkInclusion(ft)).aggregate_sum('CorrectSets').divide(self.test.size())
 
-        print('Average prediction width:', "{:.2f}".format(avgSetSize.getInfo()))
-        print('Empirical (marginal) coverage:', "{:.2f}".format(coverage.getInfo()))
+        if verbose:
+            print('Average prediction width:', "{:.2f}".format(avgSetSize.getInfo()))
+            print('Empirical (marginal) coverage:', "{:.2f}".format(coverage.getInfo()))
               
         return ee.Feature(None, {'version': self.version, 'Empirical Marginal Coverage': coverage, 'Average Prediction Width': avgSetSize})
+
+    # Function 3
+    def evaluateSplits(self, repeats: int = 100, quantiles: list = [5, 50, 95]):
+        """
+        Evaluates the conformal regressor on repeated calibration/test splits (see calibrationSplitter.split) to
+        estimate the variability of coverage and interval width. Scores are computed once, every split is evaluated
+        with array operations on the same scores. Uses the split, seed and method of the last calibrate call.
+
+        Args:
+            repeats (int): The number of calibration/test splits
+            quantiles (list): Percentiles (0-100) of the coverage and width distributions to report
+
+        Returns:
+            ee.Feature with per-split lists ('Empirical Marginal Coverage', 'Average Prediction Width', 'qHat')
+             and their mean and percentiles ('Coverage Summary', 'Width Summary')
+        """
+        self.splitter = (self.splitter or calibrationSplitter(self.data, seed = self.seed)).withSeed(self.seed)
+        # Compute nonconformity scores once
+        def scores(feature):
+            score = feature.getNumber(self.bands).subtract(feature.getNumber(self.label)).abs()
+            if self.method == 'normalized':
+                score = score.divide(feature.getNumber(self.sigma))
+            return feature.set('score', score)
+        table = self.splitter.data.map(scores)
+        sigma = ee.Array(table.aggregate_array(self.sigma)) if self.method == 'normalized' else None
+        # Average interval width of the test features
+        def width(qHat, testMask):
+            if sigma is None:
+                return qHat.multiply(2)
+            nTest = testMask.reduce(ee.Reducer.sum(), [0]).get([0]).max(1)
+            return sigma.multiply(testMask).reduce(ee.Reducer.sum(), [0]).get([0]).divide(nTest).multiply(qHat).multiply(2)
+        splits = evaluateRepeatedSplits(ee.Array(table.aggregate_array(self.splitter.column)),
+                                        ee.Array(table.aggregate_array('score')), self.split, self.alpha, repeats, width)
+        summary = ee.Reducer.percentile(quantiles).combine(ee.Reducer.mean(), None, True)
+        return ee.Feature(None, {'version': self.version, 'method': self.method, 'repeats': repeats,
+                                 'qHat': splits.get('qHat'),
+                                 'Empirical Marginal Coverage': splits.get('coverage'),
+                                 'Average Prediction Width': splits.get('size'),
+                                 'Coverage Summary': ee.List(splits.get('coverage')).reduce(summary),
+                                 'Width Summary': ee.List(splits.get('size')).reduce(summary)})
+
+    # Function 4
+    def diagnostics(self, strata: list, bins: dict = None) -> pd.DataFrame:
+        """
+        Coverage and average interval width of the test features per stratum (conditional coverage) in one
+        grouped reduction, see diagnosticFunctions.featureDiagnostics.
+
+        Args:
+            strata (list): Numeric property names to stratify by e.g. a region id or 'cluster'
+            bins (dict): Bin width of continuous strata e.g. {'canopyHeight': 5}
+
+        Returns:
+            pd.DataFrame indexed by (variable, stratum) with the columns n, coverage and width
+        """
+        Intervals = self.predictCollection(self.test)
+        evaluated = Intervals.map(lambda ft: ft.set('CorrectSets', self._checkInclusion(ft).get('CorrectSets')))
+        return featureDiagnostics(evaluated, strata, 'CorrectSets', 'width', bins)
     
 class conformalImageRegressor(object):
     """
     A class for calibrating and evaluating a conformal predictor to perform inference for a regression task.
     An input ImageCollection with a band containing the reference (label) and predicted values (bands).
-    The output can be in the form of a FeatureCollection or an ImageCollection. Currently the only method supported
-    is based on the absolute residuals.
+    The output can be in the form of a FeatureCollection or an ImageCollection. Three methods are supported,
+    absolute residuals ('residual'), residuals normalised by a per-pixel difficulty estimate ('normalized') and
+    conformalized quantile regression ('cqr').
     """
-    def __init__(self, data: ee.FeatureCollection, bands: list, alpha: float, label: str, version: str):
+    def __init__(self, data: ee.FeatureCollection, bands: Union[str, list], alpha: float, label: str, version: str,
+                 splitter: calibrationSplitter = None):
         """
         Args:
             data (ee.FeatureCollection): An ImageCollection that contains two compulsory bands;
               1) a reference value and a 2) predcited value.
-            bands (str): A image-level property name corresponding to the predicted values
+            bands (str or list): A image-level property name corresponding to the predicted values. For the 'cqr'
+              method, a list with the lower and upper quantile prediction band names.
             alpha (float): The tolerance level between 0-1 denoting the amount of allowable errors.
               For example, a value of 0.1 corresponds to 10% allowable errors and conversely a (1-alpha) 90% confidence level.
             label (str): A image-level property name corresponding to the reference/expected value.
             version (str): A user-provided string to indicate details of the experiment or date of the experiment.
               By default a datetime stamp is provided in the format (ddmmyyyyssmmhh)
+            splitter (calibrationSplitter): Splitter of data e.g. for spatial block or cluster splits (see
+              splitFunctions). Random per feature/image by default
         """
         self.data = data
+        self.splitter = splitter
         self.bands = bands
         self.alpha = alpha
         self.label = label
         self.version = version
+        self.method = 'residual'
+        self.sigma = None
     
     # Calibration stage
     # Function 1
-    def _calibration_evaluation_split(self, split: float, seed: int = 42):
+    def _calibration_evaluation_split(self, split: float, seed: int = 42, repeat: int = 0):
         """
-        Split the data into a calibration and test set.
+        Split the data into a calibration and test set. The split key is assigned once per seed and cached by the
+        splitter (see splitFunctions), repeated splits are range filters on the same key.
         """
-
-        # split the calibration data into training and validation sets
-        # add a random column with a uniform distribution
-        self.data = self.data.randomColumn(seed = seed)
-        # split data into calibration and test data
-        self.calibration = self.data.filter(ee.Filter.lt('random', split))
-        self.test = self.data.filter(ee.Filter.gte('random', split))
+        if self.splitter is None:
+            self.splitter = calibrationSplitter(self.data, seed = seed)
+        self.splitter = self.splitter.withSeed(seed)
+        self.calibration, self.test = self.splitter.split(split, repeat = repeat)
 
     # Function 2
-    def calibrate(self, image, split: float, scale: int, seed: int = 42):
-        """ Calibrate a conformal regressor on the calibration set based on absolute residual (|y-yhat|) nonconformity scores.
+    def _nonConformityScores(self, image):
+        """
+        Compute nonconformity scores. |y-yhat| for the 'residual' method, |y-yhat|/sigma for 'normalized' and
+        max(lower-y, y-upper) for 'cqr'.
+
+        Args:
+            image (ee.Image): An image with the reference and predicted value band(s)
+
+        Returns:
+            (ee.Image) single band image called 'score'
+        """
+        label = image.select(self.label)
+        if self.method == 'cqr':
+            lower, upper = self.bands
+            return image.select(lower).subtract(label).max(label.subtract(image.select(upper))).rename('score')
+        score = image.select(self.bands).subtract(label).abs()
+        if self.method == 'normalized':
+            score = score.divide(image.select(self.sigma))
+        return score.rename('score')
+
+    # Function 3
+    def calibrate(self, split: float, scale: int, seed: int = 42, method: str = 'residual', sigma: str = None,
+                  repeat: int = 0, nBins: int = 10000):
+        """ Calibrate a conformal regressor on the calibration set based on absolute residual (|y-yhat|), normalised
+        residual (|y-yhat|/sigma) or conformalized quantile regression (max(lower-y, y-upper)) nonconformity scores.
+        The scores of the calibration pixels are counted in a histogram between their smallest and largest value (see
+        scoreHistogram) and qHat is the upper edge of the bin of the conformal order statistic, so qHat is at most
+        one bin width ((largest - smallest score) / nBins) above the exact order statistic.
 
         Args:
             split (float): The proportion of the data used to calibrate a conformal regressor. The remainder is used for
@@ -227,6 +483,12 @@ class conformalImageRegressor(object):
             scale (int): The scale used to apply the reduce functions. Ideally should match native resolution of data or
              coarser if memory limts are reached
             seed (int): The seed used to split the data
+            method (str): One of 'residual', 'normalized' or 'cqr'. 'cqr' requires bands to be the lower and upper
+             quantile prediction band names.
+            sigma (str): The 'normalized' method only. A band name with a per-pixel difficulty estimate e.g. the
+             standard deviation of an ensemble. Should be > 0.
+            repeat (int): Index of a repeated calibration/test split (see calibrationSplitter.split)
+            nBins (int): The number of histogram bins of the scores
 
         Returns:
             (ee.Feature): ee.Feature that contains two properties qLevel and qHat. Here, qLevel corresponds to
@@ -234,39 +496,39 @@ class conformalImageRegressor(object):
               0.9. qHat represents a threshold of the target variable to be estimated.
             
         """ 
+        checkMethod(method, sigma, methods = ('residual', 'normalized', 'cqr'))
+        if method == 'cqr' and (isinstance(self.bands, str) or len(self.bands) != 2):
+            raise ValueError("The 'cqr' method requires bands to be a list of the lower and upper prediction bands")
         self.split = split
         self.scale = scale
         self.seed = seed
+        self.method = method
+        self.sigma = sigma
         
-        # Compute nonconformity scores (|y-yhat|)
-        def nonConformityScores(image):
-            return image.select(self.bands).subtract(image.select(self.label)).abs().rename('score')
-        # Compute quantile level (qLevel) (1-alpha). multiply quantile by 100 to compute percentile 
-        # (quantile not supported in GEE)
-        def computeQLevel():
-            self.qlevel = ee.Number(1).subtract(ee.Number(self.alpha)).multiply(100)
-        # Compute  qHat threshold based on qLevel per image
-        def computeQHat(image):
-            computeQLevel()
-            qHat = ee.Image(image).reduceRegion(**{'reducer':ee.Reducer.percentile([self.qlevel]),
-                                                'geometry': image.geometry(),
-                                                'scale': self.scale,
-                                                'tileScale': 16,
-                                                'maxPixels': 1e9}).get('score')
-            return image.set('qHat', qHat)
-        
-        # Compute aggregate qHat threshold based on qLevel
-        scores = self.test.map(lambda image: nonConformityScores(image))
-        self.qhat = scores.map(lambda img: computeQHat(img)).reduceColumns(**{
-        'reducer':ee.Reducer.percentile([self.qlevel]), 
-        'selectors': ['qHat']
-            }).values().get(0)
+        # Compute quantile level (qLevel) (1-alpha) as a percentile
+        self.qlevel = ee.Number(1).subtract(ee.Number(self.alpha)).multiply(100)
+        # Split data
+        self._calibration_evaluation_split(split = self.split, seed = self.seed, repeat = repeat)
+        # Range of the scores of all calibration pixels (each image separately)
+        def scoreRange(image):
+            image = ee.Image(image)
+            return ee.Feature(None, self._nonConformityScores(image).reduceRegion(**{
+                'reducer': ee.Reducer.minMax(),
+                'geometry': image.geometry(),
+                'scale': self.scale,
+                'tileScale': 16,
+                'maxPixels': 1e13}))
+        ranges = ee.FeatureCollection(self.calibration.map(scoreRange))
+        minScore, maxScore = ranges.aggregate_min('score_min'), ranges.aggregate_max('score_max')
+        # qHat is the conformal order statistic of the binned pixel scores
+        counts = scoreHistogram(self.calibration, self._nonConformityScores, minScore, maxScore, self.scale, nBins)
+        self.qhat = histogramQuantile(counts, minScore, maxScore, self.alpha)
                 
-        return ee.Feature(None, {'version': self.version,'qLevel': self.qlevel, 'qHat': self.qhat})
+        return ee.Feature(None, {'version': self.version, 'method': self.method, 'qLevel': self.qlevel, 'qHat': self.qhat})
     
     # Inference Stage
     # Function 1
-    def predict(self, input: Union(ee.Image, ee.Feature)):
+    def predict(self, input: Union[ee.Image, ee.Feature], output: str = 'full', widthScale: float = 0.01):
         """
         Quantify uncertainty for a ee.Feature or ee.Image.
 
@@ -274,88 +536,155 @@ class conformalImageRegressor(object):
             input (ee.Image or ee.Feature): If an ee.Image input is provided then a dual band image should be provided
              containing the predictions from a regressor and the reference/expected values. If a ee.Feature is provided,
              then a property name matching that of the 'band' argument should be provided.
+            output (str): 'full' adds float lower, upper and width bands/properties. 'compact' returns the prediction
+             (the centre of the interval for 'cqr') and an int16 half-width band for the 'normalized' and 'cqr'
+             methods (see compactIntervals and decodeIntervals, for features compactFeatureIntervals and
+             decodeFeatureIntervals). With the 'residual' method the half-width is qHat for
+             every pixel and only stored as metadata
+            widthScale (float): 'compact' only. The units of the int16 half-width
         
         Returns:
             An ee.Image or ee.Feature (corresponds to the input type) with three additional bands/properties, specifically,
             1) lower, 2) upper and 3) width. lower corresponds to the lower bound of the prediction interval. upper corresponds
             to the upper bound of the prediction interval. While width corresponds to the difference between the upper and lower
-            bound (upper - lower) and represents the prediction width. Owing to the absolute residual method used, all widths
-            should be the same.
+            bound (upper - lower) and represents the prediction width. With the absolute residual method, all widths
+            should be the same. With 'normalized' the interval is yhat +- qHat * sigma and with 'cqr' the quantile
+            predictions are widened (or narrowed) by qHat.
              
         """
-        # Check input type
-        if input.name().getInfo() == 'ee.Image':
-            # Create a constant image for qhat
-            qHatImage = ee.Image.constant(self.qHat)
-            prediction = input.select(self.band)
-            # Compute the lower, upper bound of the prediction interval and the width between the two
-            lower = prediction.subtract(qHatImage).rename('lower')
-            upper = prediction.add(qHatImage).rename('upper')
-            width = upper.subtract(lower).rename('width')
-            # Add output bands to final output
-            output = input.addBands([lower, upper, width]) 
-        elif input.name().getInfo() == 'ee.Feature':
-            # Compute the lower, upper bound of the prediction interval and the width between the two
-            lower  = ee.Feature(input).getNumber(self.band).subtract(self.qhat).rename('lower')
-            upper = ee.Feature(input).getNumber(self.band).add(self.qhat).rename('upper')
-            width = upper.subtract(lower).rename('width')
-            # Add output properties to the input feature
-            output = ee.Feature(input).set({'lower': lower, 'upper': upper, 'width': width})
-        return output
+        checkOutput(output)
+        # Dispatch on the (client-side) Python type, no server round trip
+        if isinstance(input, ee.Image):
+            return self._predictImage(input, ee.Image.constant(self.qhat), output, widthScale)
+        if isinstance(input, ee.Feature):
+            return self._predictFeature(input, output, widthScale)
+        raise TypeError(f'input should be an ee.Image or ee.Feature, not {type(input).__name__}')
+
+    # Function 1b
+    def predictCollection(self, collection: Union[ee.ImageCollection, ee.FeatureCollection], output: str = 'full',
+                          widthScale: float = 0.01):
+        """
+        Quantify uncertainty for every image/feature of a collection with one shared qHat constant, so that batch
+        inference over many tiles builds a single graph.
+
+        Args:
+            collection (ee.ImageCollection or ee.FeatureCollection): images/features as described in predict
+            output (str): 'full' or 'compact' (see predict)
+            widthScale (float): 'compact' only. The units of the int16 half-width
+
+        Returns:
+            ee.ImageCollection or ee.FeatureCollection (corresponds to the input type), see predict
+        """
+        checkOutput(output)
+        if isinstance(collection, ee.ImageCollection):
+            qHatImage = ee.Image.constant(self.qhat)
+            return collection.map(lambda image: self._predictImage(ee.Image(image), qHatImage, output, widthScale))
+        if isinstance(collection, ee.FeatureCollection):
+            return collection.map(lambda ft: self._predictFeature(ee.Feature(ft), output, widthScale))
+        raise TypeError(f'collection should be an ee.ImageCollection or ee.FeatureCollection, not {type(collection).__name__}')
+
+    def _bounds(self) -> tuple:
+        """The lower and upper prediction band/property names"""
+        return tuple(self.bands) if self.method == 'cqr' else (self.bands, self.bands)
+
+    def _predictImage(self, input: ee.Image, qHatImage: ee.Image, output: str, widthScale: float) -> ee.Image:
+        """Prediction intervals of an image (see predict). qHatImage is the constant qHat image"""
+        lowerBand, upperBand = self._bounds()
+        if output == 'compact':
+            if self.method == 'cqr':
+                # symmetric around the centre of the quantile predictions
+                lowerPrediction, upperPrediction = input.select(lowerBand), input.select(upperBand)
+                prediction = lowerPrediction.add(upperPrediction).divide(2)
+                halfWidth = upperPrediction.subtract(lowerPrediction).divide(2).add(qHatImage)
+            else:
+                prediction = input.select(self.bands)
+                halfWidth = input.select(self.sigma).multiply(qHatImage) if self.method == 'normalized' else None
+            return compactIntervals(prediction, halfWidth, self.qhat, widthScale)
+        # Scale the constant qhat image by sigma for the normalized method
+        if self.method == 'normalized':
+            qHatImage = qHatImage.multiply(input.select(self.sigma))
+        # Compute the lower, upper bound of the prediction interval and the width between the two
+        lower = input.select(lowerBand).subtract(qHatImage).rename('lower')
+        upper = input.select(upperBand).add(qHatImage).rename('upper')
+        width = upper.subtract(lower).rename('width')
+        # Add output bands to final output
+        return input.addBands([lower, upper, width])
+
+    def _predictFeature(self, input: ee.Feature, output: str, widthScale: float) -> ee.Feature:
+        """Prediction intervals of a feature (see predict)"""
+        lowerBand, upperBand = self._bounds()
+        halfWidth = ee.Number(self.qhat)
+        if self.method == 'normalized':
+            halfWidth = halfWidth.multiply(input.getNumber(self.sigma))
+        if output == 'compact':
+            if self.method == 'cqr':
+                # symmetric around the centre of the quantile predictions
+                lowerPrediction = input.getNumber(lowerBand)
+                upperPrediction = input.getNumber(upperBand)
+                halfWidth = upperPrediction.subtract(lowerPrediction).divide(2).add(halfWidth)
+                prediction = lowerPrediction.add(upperPrediction).divide(2)
+            else:
+                prediction = input.getNumber(self.bands)
+                halfWidth = halfWidth if self.method == 'normalized' else None
+            return compactFeatureIntervals(input, prediction, halfWidth, self.qhat, widthScale)
+        # Compute the lower, upper bound of the prediction interval and the width between the two
+        lower = input.getNumber(lowerBand).subtract(halfWidth)
+        upper = input.getNumber(upperBand).add(halfWidth)
+        width = upper.subtract(lower)
+        # Add output properties to the input feature
+        return input.set({'lower': lower, 'upper': upper, 'width': width})
 
     
     # Evaluation stage
     # Function 1
     def _checkInclusion(self, image):
         """
-        Checks if the predicted value falls within the upper and lower bounds of the prediction interval
+        Checks if the reference value falls within the upper and lower bounds of the prediction interval
 
         Args: 
             image (ee.Image): A multi-band image with the reference/expected value band and a prediction,
              lower and upper bound band.
             
         Returns:
-            A binary image is returned with a band called 'CorrectSets'. Where, a value of 1, if the predicted
+            A binary image is returned with a band called 'CorrectSets'. Where, a value of 1, if the reference
              value falls within the prediction interval and a zero if not. A 'sumPixels' property is added and
              corresponds to the total number of pixels that contain the expected value within their prediction
              interval. Additionally, a 'nPixels' property is added and corresponds to the number of pixels there
-             in the reference band.
+             in the reference band. The sums are computed in a single (fused) reduction.
 
         """
-        prediction = image.select(self.band)
         label = image.select(self.label)
         lower = image.select('lower')
-        upper = image.selct('upper')
+        upper = image.select('upper')
         width = image.select('width')
-        # Check if the list contains the prediction within the prediction interval. If yes, return 1. If no, return 0.
-        result = prediction.gte(lower).And(prediction.lte(upper)).rename('CorrectSets')
-        # Sum the lengths of all sets in set length image- used to compute average set size and the width.
-        sumPixels = result.addBands(width).reduceRegion(**{'reducer':ee.Reducer.sum(),
+        # Check if the prediction interval contains the reference value. If yes, return 1. If no, return 0.
+        result = label.gte(lower).And(label.lte(upper)).rename('CorrectSets')
+        # Sum the correct sets, widths and reference pixels in one reduction.
+        nPixels = ee.Image(1).updateMask(label.mask()).rename('nPixels')
+        sums = result.addBands([width, nPixels]).updateMask(label.mask()).reduceRegion(**{
+                                              'reducer':ee.Reducer.sum(),
                                               'geometry': image.geometry(),
                                               'scale': self.scale,
                                               'tileScale': 16,
                                               'maxPixels': 1e9})
-        # Compute the number of pixels in test label image
-        nPixels = label.reduceRegion(**{'reducer':ee.Reducer.count(),
-                                             'geometry': image.geometry(),
-                                             'scale': self.scale,
-                                             'tileScale': 16,
-                                             'maxPixels': 1e9}).getNumber(self.label)
-        return result.set('sumPixels', sumPixels.getNumber('CorrectSets')).set('nPixels', nPixels)\
-            .set('width', sumPixels.getNumber('width')).copyProperties(image)
+        return result.set('sumPixels', sums.getNumber('CorrectSets')).set('nPixels', sums.getNumber('nPixels'))\
+            .set('width', sums.getNumber('width')).copyProperties(image)
     
     # Function 2
-    def evaluate(self):
+    def evaluate(self, verbose: bool = True):
         """
         Evaluates the conformal classifier model
 
+        Args:
+            verbose (bool): If True, print the average width and coverage (two getInfo calls)
+
         Returns:
             An ee.Feature with three properties, the empirical marginal coverage, Average prediction
              interval width and the version information.
 
         """
         # Compute lower and upper bounds of interval
-        Intervals = self.test.map(lambda input: self._checkInclusion(self.predict(input)))
+        Intervals = self.predictCollection(self.test).map(lambda image: self._checkInclusion(image))
 
         # Compute the number of pixels in label test set
         nPixelsTest = Intervals.aggregate_sum('nPixels')
@@ -366,7 +695,80 @@ class conformalImageRegressor(object):
         # Evaluate Marginal coverage (based on test set): compute coverage (correct sets/total label pixels/)
         coverage = Intervals.aggregate_sum('sumPixels').divide(nPixelsTest)
 
-        print('Average width of prediction interval:', "{:.2f}".format(avgSetSize.getInfo()))
-        print('Empirical (marginal) coverage:', "{:.2f}".format(coverage.getInfo()))
+        if verbose:
+            print('Average width of prediction interval:', "{:.2f}".format(avgSetSize.getInfo()))
+            print('Empirical (marginal) coverage:', "{:.2f}".format(coverage.getInfo()))
               
-        return ee.Feature(None, {'version': self.version, 'Empirical Marginal Coverage': coverage, 'Average Prediction Width': avgSetSize})
\ No newline at end of file
+        return ee.Feature(None, {'version': self.version, 'Empirical Marginal Coverage': coverage, 'Average Prediction Width': avgSetSize})
+
+    # Function 2b
+    def evaluateSplits(self, repeats: int = 100, quantiles: list = [5, 50, 95]):
+        """
+        Evaluates the conformal regressor on repeated calibration/test splits of the images (see
+        calibrationSplitter.split) to estimate the variability of coverage and interval width. The scores of every
+        labelled pixel are sampled once and every split is evaluated with array operations on the same scores, so
+        the pixels of all images must fit in one array (use a coarser scale for large collections). Coverage and
+        width are per pixel. Uses the split, scale, seed and method of the last calibrate call.
+
+        Args:
+            repeats (int): The number of calibration/test splits
+            quantiles (list): Percentiles (0-100) of the coverage and width distributions to report
+
+        Returns:
+            ee.Feature with per-split lists ('Empirical Marginal Coverage', 'Average Prediction Width', 'qHat')
+             and their mean and percentiles ('Coverage Summary', 'Width Summary')
+        """
+        self.splitter = (self.splitter or calibrationSplitter(self.data, seed = self.seed)).withSeed(self.seed)
+        column = self.splitter.column
+        lowerBand, upperBand = self._bounds()
+        # Compute nonconformity scores once. The width of a pixel is base + 2 * qHat * scale
+        def samplePixels(image):
+            image = ee.Image(image)
+            base = image.select(upperBand).subtract(image.select(lowerBand)) if self.method == 'cqr' else ee.Image(0)
+            scale = image.select(self.sigma) if self.method == 'normalized' else ee.Image(1)
+            bands = self._nonConformityScores(image).addBands(base.rename('base')).addBands(scale.rename('scale'))
+            samples = bands.sample(**{
+                'region': image.geometry(),
+                'scale': self.scale,
+                'tileScale': 16,
+                'geometries': False})
+            return samples.map(lambda ft: ft.set(column, image.get(column)))
+        table = ee.ImageCollection(self.splitter.data).map(samplePixels).flatten()
+        base, scale = ee.Array(table.aggregate_array('base')), ee.Array(table.aggregate_array('scale'))
+        # Average interval width of the test pixels
+        def width(qHat, testMask):
+            nTest = testMask.reduce(ee.Reducer.sum(), [0]).get([0]).max(1)
+            widths = scale.multiply(qHat.multiply(2)).add(base)
+            return widths.multiply(testMask).reduce(ee.Reducer.sum(), [0]).get([0]).divide(nTest)
+        splits = evaluateRepeatedSplits(ee.Array(table.aggregate_array(column)),
+                                        ee.Array(table.aggregate_array('score')), self.split, self.alpha, repeats, width)
+        summary = ee.Reducer.percentile(quantiles).combine(ee.Reducer.mean(), None, True)
+        return ee.Feature(None, {'version': self.version, 'method': self.method, 'repeats': repeats,
+                                 'qHat': splits.get('qHat'),
+                                 'Empirical Marginal Coverage': splits.get('coverage'),
+                                 'Average Prediction Width': splits.get('size'),
+                                 'Coverage Summary': ee.List(splits.get('coverage')).reduce(summary),
+                                 'Width Summary': ee.List(splits.get('size')).reduce(summary)})
+
+    # Function 3
+    def diagnostics(self, strata: list, properties: list = None, bins: dict = None) -> pd.DataFrame:
+        """
+        Coverage and average interval width of the test pixels per stratum (conditional coverage). One grouped
+        reduceRegion per test image, combined in pandas (see diagnosticFunctions.imageDiagnostics).
+
+        Args:
+            strata (list): Band names (e.g. a land cover or region band) or, with properties, image property names
+             to stratify by
+            properties (list): Strata that are image properties e.g. a cloud fraction
+            bins (dict): Bin width of continuous strata e.g. {'CLOUDY_PIXEL_PERCENTAGE': 10}
+
+        Returns:
+            pd.DataFrame indexed by (variable, stratum) with the columns n, coverage and width
+        """
+        def evaluated(image):
+            intervals = self.predict(ee.Image(image))
+            label = intervals.select(self.label)
+            covered = label.gte(intervals.select('lower')).And(label.lte(intervals.select('upper')))
+            return intervals.addBands(covered.rename('CorrectSets'))
+        return imageDiagnostics(self.test.map(evaluated), strata, self.scale, 'CorrectSets', 'width',
+                                properties, bins)
\ No newline at end of file
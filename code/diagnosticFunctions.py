@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+import ee
+
+# Conditional (stratified) coverage diagnostics. Coverage and set size/width are summed per stratum of one or more
+# stratification variables (e.g. the reference class, a region id, binned cloud fraction or the 'cluster' fold)
+# with a single grouped reduction, instead of one filter and reduction per stratum.
+
+def _toFrame(rows: list, size: str) -> pd.DataFrame:
+    """
+    Combine (variable, stratum, covered, size, n) sums (e.g. from several images) into a DataFrame with one row per
+    stratum and the columns n, coverage and size
+    """
+    frame = pd.DataFrame(rows, columns = ['variable', 'stratum', 'covered', size, 'n'])
+    frame = frame.groupby(['variable', 'stratum'], sort = True).sum()
+    frame['coverage'] = frame['covered'] / frame['n']
+    frame[size] = frame[size] / frame['n']
+    frame['n'] = frame['n'].astype(np.int64)
+    return frame[['n', 'coverage', size]]
+
+def _groupedSums(nStrata: int) -> ee.Reducer:
+    """
+    Reducer that sums [covered, size, 1] per group of each of nStrata stratification inputs. Inputs are
+    [covered, size, 1, stratum] repeated nStrata times, the output of stratum i is called 'v{i}groups'
+    """
+    grouped = lambda: ee.Reducer.sum().repeat(3).group(3)
+    reducer = grouped().setOutputs(['v0groups'])
+    for index in range(1, nStrata):
+        reducer = reducer.combine(grouped(), f'v{index}', False)
+    return reducer
+
+def _groupsToRows(result: dict, strata: list) -> list:
+    rows = []
+    for index, variable in enumerate(strata):
+        for group in result.get(f'v{index}groups', []):
+            covered, size, n = group['sum']
+            rows.append((variable, group['group'], covered, size, n))
+    return rows
+
+def _binned(value, width):
+    """Floor a value to bins of the given width (works for ee.Number and ee.Image)"""
+    return value.divide(width).floor().multiply(width)
+
+def featureDiagnostics(features: ee.FeatureCollection, strata: list, covered: str = 'CorrectSets',
+                       size: str = 'setSize', bins: dict = None) -> pd.DataFrame:
+    """
+    Stratified coverage and set size/width of evaluated test features in one grouped reduction (one getInfo call).
+
+    Args:
+        features (ee.FeatureCollection): Test features with a coverage (0/1) property, a set size/width property and
+         the stratification properties
+        strata (list): Numeric property names to stratify by e.g. the label, a region id or 'cluster'
+        covered (str): The coverage property (1 = reference class/value included in the set/interval)
+        size (str): The set size or interval width property
+        bins (dict): Bin width of continuous strata e.g. {'cloudFraction': 0.1}
+
+    Returns:
+        pd.DataFrame indexed by (variable, stratum) with the columns n, coverage and size
+    """
+    bins = bins or {}
+    def prepare(ft):
+        values = {'_one': 1}
+        for variable, width in bins.items():
+            values[variable] = _binned(ft.getNumber(variable), width)
+        return ft.set(values)
+    selectors = []
+    for variable in strata:
+        selectors += [covered, size, '_one', variable]
+    result = features.map(prepare).reduceColumns(_groupedSums(len(strata)), selectors).getInfo()
+    return _toFrame(_groupsToRows(result, strata), size)
+
+def imageDiagnostics(images: ee.ImageCollection, strata: list, scale: float, covered: str = 'CorrectSets',
+                     size: str = 'setSize', properties: list = None, bins: dict = None) -> pd.DataFrame:
+    """
+    Stratified coverage and set size/width of evaluated test images. Sums are computed per image with one grouped
+    reduceRegion and combined in pandas (one getInfo call for the collection).
+
+    Args:
+        images (ee.ImageCollection): Test images with a coverage (0/1) band, a set size/width band and the
+         stratification bands. Pixels masked in the coverage band are ignored
+        strata (list): Band or (with properties) image property names to stratify by
+        scale (float): The scale of the reductions
+        covered (str): The coverage band
+        size (str): The set size or interval width band
+        properties (list): Strata that are image properties (e.g. a region id or cloud fraction) instead of bands
+        bins (dict): Bin width of continuous strata e.g. {'CLOUDY_PIXEL_PERCENTAGE': 10}
+
+    Returns:
+        pd.DataFrame indexed by (variable, stratum) with the columns n, coverage and size
+    """
+    properties, bins = properties or [], bins or {}
+    def groupedSums(image):
+        image = ee.Image(image)
+        base = image.select([covered, size]).addBands(ee.Image(1).rename('_one'))
+        bands = []
+        # band names must be unique, so each variable gets its own copy of the summed bands
+        for index, variable in enumerate(strata):
+            stratum = ee.Image.constant(image.getNumber(variable)) if variable in properties else image.select(variable)
+            if variable in bins:
+                stratum = _binned(stratum, bins[variable])
+            bands += [base.rename([f'covered{index}', f'size{index}', f'one{index}']), stratum.rename(f'stratum{index}')]
+        sums = ee.Image.cat(bands).updateMask(image.select(covered).mask()).reduceRegion(**{
+            'reducer': _groupedSums(len(strata)),
+            'geometry': image.geometry(),
+            'scale': scale,
+            'tileScale': 16,
+            'maxPixels': 1e9})
+        return ee.Feature(None, sums)
+    rows = []
+    for feature in ee.FeatureCollection(images.map(groupedSums)).getInfo()['features']:
+        rows += _groupsToRows(feature['properties'], strata)
+    return _toFrame(rows, size)
+
+def stratifiedCoverage(covered: np.ndarray, size: np.ndarray, strata: dict, sizeName: str = 'setSize') -> pd.DataFrame:
+    """
+    Local (NumPy) equivalent of featureDiagnostics/imageDiagnostics using np.bincount.
+
+    Args:
+        covered (np.ndarray): 1 if the reference class/value is included in the set/interval (n,)
+        size (np.ndarray): set size or interval width (n,)
+        strata (dict): name: stratum of every sample (n,) e.g. {'label': y, 'cluster': folds}
+        sizeName (str): Name of the size column e.g. 'setSize' or 'width'
+
+    Returns:
+        pd.DataFrame indexed by (variable, stratum) with the columns n, coverage and size
+    """
+    covered = np.asarray(covered, dtype = np.float64)
+    size = np.asarray(size, dtype = np.float64)
+    rows = []
+    for variable, values in strata.items():
+        groups, codes = np.unique(np.asarray(values), return_inverse = True)
+        n = np.bincount(codes, minlength = len(groups))
+        sums = np.bincount(codes, covered, len(groups)), np.bincount(codes, size, len(groups))
+        rows += [(variable, group, sums[0][i], sums[1][i], n[i]) for i, group in enumerate(groups)]
+    return _toFrame(rows, sizeName)
@@ -0,0 +1,308 @@
+import os
+import math
+import time
+import logging
+from typing import Callable, Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as rio_copy
+from rasterio.transform import Affine
+from rasterio.windows import Window
+import requests
+import ee
+
+from code.exportFunctions import gridTiles
+
+# Parralel processing
+import concurrent.futures
+
+class tileDownloader:
+    """
+    Download an image as tiles that match the inference patchSize. Tiles are fetched concurrently and written into
+    one tiled GeoTIFF (optionally converted to a COG at the end). Finished tiles are also yielded as they arrive so
+    that prepareModel.inference can start before the download has finished.
+
+    # Example Usuage
+    downloader = tileDownloader(covariates, bounds = [xmin, ymin, xmax, ymax], scale = 10, patchSize = 256,
+                                crs = 'EPSG:32735', outfile = 'covariates.tif')
+    prepareModel.inference(mode = 'predict', infile = downloader, model = clf, confModel = None,
+                           outfile = 'predictions.tif', patchSize = 256)
+    """
+    def __init__(self, image: ee.Image, bounds: list, scale: float, patchSize: int, crs: str = 'EPSG:4326',
+                 outfile: str = None, cog: bool = False, num_workers: int = 8, maxRetries: int = 3,
+                 bandNames: list = None, fetch: Callable = None):
+        """
+        Args:
+            image (ee.Image): The (covariate) image to download. Bands are converted to float32
+            bounds (list): [xmin, ymin, xmax, ymax] of the area of interest in the units of crs
+            scale (float): Pixel size in the units of crs
+            patchSize (int): The height and width (pixels) of each tile. Should match the inference patchSize and
+             be a multiple of 16 (GeoTIFF block size)
+            crs (str): The crs of the download
+            outfile (str): File path of the tiled GeoTIFF the tiles are written to. If None, tiles are only yielded
+            cog (bool): If True, convert outfile to a Cloud Optimized GeoTIFF once all tiles are downloaded
+            num_workers (int): The number of concurrent downloads (and size of the connection pool)
+            maxRetries (int): Maximum number of attempts per tile
+            bandNames (list): Names of the image bands. Requested from the server if not provided
+            fetch (Callable): Function (tile) -> np.ndarray (bands, rows, cols) used instead of the Earth Engine
+             download e.g. for testing
+        """
+        self.image = image
+        self.scale = scale
+        self.patchSize = patchSize
+        self.crs = crs
+        self.outfile = outfile
+        self.cog = cog
+        self.num_workers = num_workers
+        self.maxRetries = maxRetries
+        self.bandNames = bandNames if bandNames is not None else image.bandNames().getInfo()
+        self.fetch = fetch if fetch is not None else self._fetch
+        self.logger = logging.getLogger(__name__)
+
+        # snap the area of interest to the pixel grid
+        xmin, ymin, xmax, ymax = bounds
+        self.width = math.ceil((xmax - xmin) / scale)
+        self.height = math.ceil((ymax - ymin) / scale)
+        self.transform = Affine(scale, 0, xmin, 0, -scale, ymax)
+        snapped = [xmin, ymax - self.height * scale, xmin + self.width * scale, ymax]
+        self.tiles = gridTiles(snapped, patchSize * scale)
+        for tile in self.tiles:
+            colOff, rowOff = tile['col'] * patchSize, tile['row'] * patchSize
+            tile['window'] = Window(colOff, rowOff, min(patchSize, self.width - colOff),
+                                    min(patchSize, self.height - rowOff))
+
+        # share connections between download threads
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = num_workers)
+        self.session.mount('https://', adapter)
+
+    @property
+    def profile(self) -> dict:
+        """rasterio profile of the downloaded (mosaic) image"""
+        return {'driver': 'GTiff', 'dtype': 'float32', 'nodata': np.nan, 'width': self.width,
+                'height': self.height, 'count': len(self.bandNames), 'crs': self.crs, 'transform': self.transform,
+                'tiled': True, 'blockxsize': self.patchSize, 'blockysize': self.patchSize}
+
+    def _fetch(self, tile: dict) -> np.ndarray:
+        """Download a tile from Earth Engine as a GeoTIFF and read it into an array (bands, rows, cols)"""
+        window = tile['window']
+        x0, y0 = self.transform * (window.col_off, window.row_off)
+        url = self.image.toFloat().getDownloadURL({'crs': self.crs,
+                                                   'crs_transform': [self.scale, 0, x0, 0, -self.scale, y0],
+                                                   'dimensions': [int(window.width), int(window.height)],
+                                                   'format': 'GEO_TIFF'})
+        response = self.session.get(url, timeout = 300)
+        response.raise_for_status()
+        with MemoryFile(response.content) as memfile:
+            with memfile.open() as src:
+                return src.read()
+
+    def _matchesOutfile(self) -> bool:
+        """True if outfile exists and has the grid and bands of this download"""
+        if not os.path.exists(self.outfile):
+            return False
+        with rasterio.open(self.outfile) as src:
+            return (src.width, src.height, src.count, src.transform) == \
+                (self.width, self.height, len(self.bandNames), self.transform) and src.crs == self.crs
+
+    def _fetchWithRetries(self, tile: dict) -> np.ndarray:
+        for attempt in range(1, self.maxRetries + 1):
+            try:
+                return self.fetch(tile)
+            except Exception as ex:
+                if attempt == self.maxRetries:
+                    raise ex
+                self.logger.info(f'Retrying tile {tile["id"]} ({ex})')
+                time.sleep(2 ** attempt)
+
+    def download(self, tiles: list = None) -> Iterator:
+        """
+        Download all tiles concurrently.
+
+        Args:
+            tiles (list): The tiles to download (e.g. the tiles missing from a resumed inference run). Defaults to
+             all tiles. When a subset is downloaded and outfile exists with the same grid, the tiles are written
+             into the existing mosaic (the other tiles are kept)
+
+        Returns:
+            Iterator of (window, array) for each tile, in the order the downloads finish.
+            array has shape (bands, rows, cols).
+        """
+        dst = None
+        if self.outfile:
+            update = tiles is not None and self._matchesOutfile()
+            dst = rasterio.open(self.outfile, 'r+') if update else rasterio.open(self.outfile, 'w', **self.profile)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers = self.num_workers) as executor:
+                tiles = self.tiles if tiles is None else tiles
+                futures = {executor.submit(self._fetchWithRetries, tile): tile for tile in tiles}
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        window = futures[future]['window']
+                        array = future.result().astype(np.float32)
+                        if dst is not None:
+                            dst.write(array, window = window)
+                        yield window, array
+                except BaseException as ex:
+                    self.logger.info('Cancelling...')
+                    executor.shutdown(wait = False, cancel_futures = True)
+                    raise ex
+        finally:
+            if dst is not None:
+                dst.close()
+
+        if self.outfile and self.cog:
+            tmp = f'{self.outfile}.tmp.tif'
+            os.replace(self.outfile, tmp)
+            rio_copy(tmp, self.outfile, driver = 'COG')
+            os.remove(tmp)
+
+    def __iter__(self) -> Iterator:
+        return self.download()
+
+class tableDownloader:
+    """
+    Download a (large) FeatureCollection as a table. A random page key is added to the collection once and the
+    collection is requested in pages that are key ranges (filters, so every page costs the same as the first, unlike
+    toList(pageSize, offset) which rescans the skipped features). Ranges are sized for about 80% of pageSize (at most
+    5000, the getInfo element limit) features, a full page is split in two and refetched. The pages are downloaded
+    concurrently and converted with one explicit schema unified over all pages: integer properties stay integers
+    unless a page has floats (Earth Engine numbers are doubles, whole numbers arrive as integers) and properties
+    missing on a feature are null.
+
+    # Example Usuage
+    table = tableDownloader(training, columns = bandNames + ['label']).download()
+    df = table.to_pandas()
+    """
+    def __init__(self, collection: ee.FeatureCollection, pageSize: int = 5000, num_workers: int = 8,
+                 maxRetries: int = 3, columns: list = None, size: int = None, fetch: Callable = None, seed: int = 0):
+        """
+        Args:
+            collection (ee.FeatureCollection): The collection to download. Geometries are dropped
+            pageSize (int): The maximum number of features per request (at most 5000)
+            num_workers (int): The number of concurrent requests
+            maxRetries (int): Maximum number of attempts per page
+            columns (list): The properties to download. Defaults to all properties of all pages
+            size (int): The number of features. Requested from the server if not provided
+            fetch (Callable): Function (start, end, count) -> list of property dicts of at most count features with a
+             page key in [start, end), used instead of the Earth Engine request e.g. for testing
+            seed (int): Seed of the random page key. Rows are ordered by page (key range), in collection order within
+             a page
+        """
+        if pageSize > 5000:
+            raise ValueError('pageSize should be at most 5000 (the getInfo element limit)')
+        self.collection = collection
+        self.pageSize = pageSize
+        self.num_workers = num_workers
+        self.maxRetries = maxRetries
+        self.columns = columns
+        self.size = size if size is not None else collection.size().getInfo()
+        self.fetch = fetch if fetch is not None else self._fetch
+        self.column = 'pageKey'
+        self.keyed = collection.randomColumn(self.column, seed) if collection is not None else None
+        # key ranges of about 80% of pageSize features
+        self.nPages = max(1, math.ceil(self.size / (0.8 * pageSize)))
+        self.logger = logging.getLogger(__name__)
+
+    def _fetch(self, start: float, end: float, count: int) -> list:
+        """Request the properties of at most count features with a page key in [start, end)"""
+        toDictionary = lambda ft: ft.toDictionary(self.columns) if self.columns else ft.toDictionary()
+        page = self.keyed.filter(ee.Filter.And(ee.Filter.gte(self.column, start), ee.Filter.lt(self.column, end)))
+        return page.toList(count).map(lambda ft: toDictionary(ee.Feature(ft))).getInfo()
+
+    def _fetchWithRetries(self, start: float, end: float) -> list:
+        for attempt in range(1, self.maxRetries + 1):
+            try:
+                rows = self.fetch(start, end, self.pageSize)
+                break
+            except Exception as ex:
+                if attempt == self.maxRetries:
+                    raise ex
+                self.logger.info(f'Retrying page [{start}, {end}) ({ex})')
+                time.sleep(2 ** attempt)
+        if len(rows) < self.pageSize:
+            return rows
+        # the page may be truncated at pageSize: split the key range
+        middle = (start + end) / 2
+        return self._fetchWithRetries(start, middle) + self._fetchWithRetries(middle, end)
+
+    @staticmethod
+    def _pageSchema(rows: list) -> pa.Schema:
+        """The schema of a page: every property of any feature (in order of appearance) with its inferred type"""
+        names = dict.fromkeys(name for row in rows for name in row)
+        return pa.schema([pa.field(name, pa.array([row.get(name) for row in rows]).type) for name in names])
+
+    def _schema(self, schemas: list) -> pa.Schema:
+        """
+        One schema for all pages from the schemas of every page. A column keeps its type if the pages agree,
+        integers become float64 only if a page has floats, columns that are null on some pages take the type of the
+        other pages and properties missing from a page are null on that page.
+
+        Args:
+            schemas (list): The pa.Schema of every page (see _pageSchema)
+
+        Returns:
+            pa.Schema
+        """
+        types = {}
+        for schema in schemas:
+            for field in schema:
+                types.setdefault(field.name, set())
+                if not pa.types.is_null(field.type):
+                    types[field.name].add(field.type)
+        fields = []
+        for name, found in types.items():
+            if len(found) > 1 and all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in found):
+                found = {pa.float64()} if any(pa.types.is_floating(t) for t in found) else {pa.int64()}
+            if len(found) > 1:
+                raise TypeError(f'property {name} has different types on different pages: {sorted(map(str, found))}')
+            fields.append(pa.field(name, found.pop() if found else pa.null()))
+        if self.columns:
+            byName = {field.name: field for field in fields}
+            fields = [byName.get(column, pa.field(column, pa.null())) for column in self.columns]
+        return pa.schema(fields)
+
+    def download(self) -> pa.Table:
+        """
+        Download all pages concurrently.
+
+        Returns:
+            pa.Table with one row per feature, ordered by page
+        """
+        if self.size == 0:
+            return pa.table({column: [] for column in self.columns or []})
+        bounds = [page / self.nPages for page in range(self.nPages + 1)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.num_workers) as executor:
+            futures = [executor.submit(self._fetchWithRetries, start, end) for start, end in zip(bounds, bounds[1:])]
+            try:
+                # page order (not arrival order) keeps the rows ordered by key range
+                pages = [future.result() for future in futures]
+                schemas = [self._pageSchema(rows) for rows in pages if rows]
+            except BaseException as ex:
+                self.logger.info('Cancelling...')
+                executor.shutdown(wait = False, cancel_futures = True)
+                raise ex
+        if not schemas:
+            return pa.table({column: [] for column in self.columns or []})
+        # convert every page with the schema unified over all pages
+        schema = self._schema(schemas)
+        table = pa.concat_tables([pa.Table.from_pylist(rows, schema = schema) for rows in pages if rows])
+        return table.drop_columns([self.column]) if self.column in table.column_names else table
+
+def downloadTable(collection: ee.FeatureCollection, **kwargs) -> pd.DataFrame:
+    """
+    Download a FeatureCollection as a pandas dataframe with a tableDownloader (replaces geemap.ee_to_df for
+    collections larger than 5000 features).
+
+    Args:
+        collection (ee.FeatureCollection): The collection to download
+        **kwargs: Arguments of tableDownloader
+
+    Returns:
+        pd.DataFrame
+    """
+    return tableDownloader(collection, **kwargs).download().to_pandas()
@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import math
+import logging
+from typing import Callable
+
+import ee
+
+# Earth Engine task states
+ACTIVE_STATES = ('UNSUBMITTED', 'READY', 'RUNNING', 'CANCEL_REQUESTED')
+FAILED_STATES = ('FAILED', 'CANCELLED', 'UNKNOWN')
+
+def gridTiles(bounds: list, tileSize: float) -> list:
+    """
+    Split a bounding box into a regular grid of tiles.
+
+    Args:
+        bounds (list): [xmin, ymin, xmax, ymax] in the units of the export crs
+        tileSize (float): The width and height of a tile in the units of the export crs
+
+    Returns:
+        list of dicts with the tile id ('r{row}c{col}'), row, col and bounds ([xmin, ymin, xmax, ymax]).
+        Rows start at the top (ymax) of the bounding box. Edge tiles are clipped to the bounding box.
+    """
+    xmin, ymin, xmax, ymax = bounds
+    nCols = math.ceil((xmax - xmin) / tileSize)
+    nRows = math.ceil((ymax - ymin) / tileSize)
+    tiles = []
+    for row in range(nRows):
+        for col in range(nCols):
+            x0 = xmin + col * tileSize
+            y1 = ymax - row * tileSize
+            tiles.append({'id': f'r{row}c{col}', 'row': row, 'col': col,
+                          'bounds': [x0, max(y1 - tileSize, ymin), min(x0 + tileSize, xmax), y1]})
+    return tiles
+
+def aoiTiles(aoi: ee.Geometry, tileSize: float, crs: str = 'EPSG:4326') -> list:
+    """
+    Split the bounding box of an area of interest into a regular grid of tiles (see gridTiles).
+    The bounding box is requested once from the server.
+
+    Args:
+        aoi (ee.Geometry): Area of interest
+        tileSize (float): The width and height of a tile in the units of crs
+        crs (str): The crs of the tile grid
+
+    Returns:
+        list of tiles (dicts)
+    """
+    coords = aoi.bounds(maxError = 1, proj = crs).coordinates().get(0).getInfo()
+    xs = [xy[0] for xy in coords]
+    ys = [xy[1] for xy in coords]
+    return gridTiles([min(xs), min(ys), max(xs), max(ys)], tileSize)
+
+class eeTaskService:
+    """
+    Submits and polls Earth Engine image export tasks for tiles. Any object with the same submit and status
+    methods can be passed to exportScheduler (e.g. a local fake service for testing).
+    """
+    def __init__(self, image: ee.Image, scale: float, crs: str = 'EPSG:4326', destination: str = 'drive',
+                 prefix: str = 'conformal', **exportArgs):
+        """
+        Args:
+            image (ee.Image): The image to export e.g. the output of conformalImageClassifier.predict or
+             conformalImageRegressor.predict
+            scale (float): The export resolution (m)
+            crs (str): The export crs. Tile bounds are interpreted in this crs
+            destination (str): One of 'drive', 'asset' or 'cloud'
+            prefix (str): Prefix of the task description and file names. The tile id is appended
+            exportArgs: Additional arguments passed to the ee.batch.Export.image function e.g. folder (drive),
+             assetFolder (asset) or bucket (cloud)
+        """
+        self.image = image
+        self.scale = scale
+        self.crs = crs
+        self.destination = destination
+        self.prefix = prefix
+        self.exportArgs = exportArgs
+        self.tasks = {}
+
+    def submit(self, tile: dict) -> str:
+        """
+        Start an export task for a tile.
+
+        Returns:
+            (str) The task id
+        """
+        region = ee.Geometry.Rectangle(tile['bounds'], proj = self.crs, geodesic = False)
+        name = f"{self.prefix}_{tile['id']}"
+        exportArgs = dict(self.exportArgs)
+        common = {'image': self.image, 'description': name, 'region': region, 'scale': self.scale,
+                  'crs': self.crs, 'maxPixels': 1e13}
+        if self.destination == 'drive':
+            task = ee.batch.Export.image.toDrive(fileNamePrefix = name, **common, **exportArgs)
+        elif self.destination == 'asset':
+            assetFolder = exportArgs.pop('assetFolder')
+            task = ee.batch.Export.image.toAsset(assetId = f'{assetFolder}/{name}', **common, **exportArgs)
+        elif self.destination == 'cloud':
+            task = ee.batch.Export.image.toCloudStorage(fileNamePrefix = name, **common, **exportArgs)
+        else:
+            raise ValueError(f"destination should be one of 'drive', 'asset' or 'cloud', not {self.destination}")
+        task.start()
+        self.tasks[task.id] = task
+        return task.id
+
+    def status(self, taskIds: list) -> dict:
+        """
+        Get the state of several tasks.
+
+        Returns:
+            (dict) task id: (state, error message)
+        """
+        result = {}
+        # tasks submitted by a previous session are looked up by id
+        unknown = [taskId for taskId in taskIds if taskId not in self.tasks]
+        if unknown:
+            for status in ee.data.getTaskStatus(unknown):
+                result[status['id']] = (status['state'], status.get('error_message'))
+        for taskId in taskIds:
+            if taskId in self.tasks:
+                status = self.tasks[taskId].status()
+                result[taskId] = (status['state'], status.get('error_message'))
+        return result
+
+class exportScheduler:
+    """
+    Exports tiles with a cap on the number of concurrent tasks, polls the tasks with backoff and retries failed tiles.
+    Progress is saved to a local (json) manifest so that an interrupted run resumes where it stopped.
+
+    # Example Usuage
+    sets = conformalImageClassifier.predict(image)
+    tiles = aoiTiles(aoi, tileSize = 20000, crs = 'EPSG:32735')
+    service = eeTaskService(sets, scale = 10, crs = 'EPSG:32735', folder = 'conformal')
+    manifest = exportScheduler(service, tiles, 'sets_manifest.json').run()
+    """
+    def __init__(self, service, tiles: list, manifest: str, maxConcurrent: int = 10, maxRetries: int = 3,
+                 pollInterval: float = 10, maxPollInterval: float = 300, backoff: float = 2,
+                 sleep: Callable = time.sleep):
+        """
+        Args:
+            service: Object with submit(tile) -> task id and status(taskIds) -> {task id: (state, error)} methods
+             e.g. eeTaskService
+            tiles (list): Tiles to export (see gridTiles)
+            manifest (str): File path of the json manifest
+            maxConcurrent (int): Maximum number of submitted tasks that have not finished. Should be below the
+             Earth Engine task quota
+            maxRetries (int): Maximum number of submissions per tile
+            pollInterval (float): Initial number of seconds between polls
+            maxPollInterval (float): Maximum number of seconds between polls
+            backoff (float): Factor the poll interval is multiplied by when no task changed state
+            sleep (Callable): Function used to wait between polls
+        """
+        self.service = service
+        self.tiles = {tile['id']: tile for tile in tiles}
+        self.manifestPath = manifest
+        self.maxConcurrent = maxConcurrent
+        self.maxRetries = maxRetries
+        self.pollInterval = pollInterval
+        self.maxPollInterval = maxPollInterval
+        self.backoff = backoff
+        self.sleep = sleep
+        self.logger = logging.getLogger(__name__)
+        self.manifest = self._loadManifest()
+
+    def _loadManifest(self) -> dict:
+        """Load the manifest of a previous run and add tiles that are not in it"""
+        manifest = {}
+        if os.path.exists(self.manifestPath):
+            with open(self.manifestPath) as f:
+                manifest = json.load(f)
+        for tileId in self.tiles:
+            manifest.setdefault(tileId, {'state': 'PENDING', 'taskId': None, 'attempts': 0, 'error': None})
+        return manifest
+
+    def _saveManifest(self):
+        """Write the manifest to disk (atomically, so an interrupted write does not corrupt it)"""
+        tmp = f'{self.manifestPath}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent = 1)
+        os.replace(tmp, self.manifestPath)
+
+    def _tilesIn(self, state: str) -> list:
+        return [tileId for tileId in self.tiles if self.manifest[tileId]['state'] == state]
+
+    def _fail(self, tileId: str, error: str):
+        """Record a failed attempt. The tile is queued again if it has retries left"""
+        entry = self.manifest[tileId]
+        entry['error'] = error
+        entry['taskId'] = None
+        if entry['attempts'] < self.maxRetries:
+            entry['state'] = 'PENDING'
+        else:
+            entry['state'] = 'FAILED'
+            self.logger.warning(f'Export of tile {tileId} failed after {entry["attempts"]} attempts: {error}')
+
+    def _submit(self, tileId: str):
+        entry = self.manifest[tileId]
+        entry['attempts'] += 1
+        try:
+            entry['taskId'] = self.service.submit(self.tiles[tileId])
+            entry['state'] = 'RUNNING'
+        except Exception as ex:
+            self._fail(tileId, str(ex))
+
+    def _poll(self) -> bool:
+        """
+        Update the state of running tiles.
+
+        Returns:
+            (bool) True if any tile finished
+        """
+        running = self._tilesIn('RUNNING')
+        if not running:
+            return False
+        statuses = self.service.status([self.manifest[tileId]['taskId'] for tileId in running])
+        changed = False
+        for tileId in running:
+            state, error = statuses.get(self.manifest[tileId]['taskId'], ('UNKNOWN', 'task not found'))
+            if state in ACTIVE_STATES:
+                continue
+            changed = True
+            if state == 'COMPLETED':
+                self.manifest[tileId]['state'] = 'COMPLETED'
+                self.manifest[tileId]['error'] = None
+            else:
+                self._fail(tileId, error or state)
+        return changed
+
+    def run(self) -> dict:
+        """
+        Export all tiles that have not been completed.
+
+        Returns:
+            (dict) The manifest, tile id: state, task id, number of attempts and last error
+        """
+        # tiles that failed in a previous run get a fresh set of retries
+        for tileId in self._tilesIn('FAILED'):
+            self.manifest[tileId].update({'state': 'PENDING', 'attempts': 0})
+
+        interval = self.pollInterval
+        while True:
+            # submit pending tiles up to the concurrency cap
+            pending = self._tilesIn('PENDING')
+            nFree = self.maxConcurrent - len(self._tilesIn('RUNNING'))
+            for tileId in pending[:max(nFree, 0)]:
+                self._submit(tileId)
+            self._saveManifest()
+
+            if not self._tilesIn('RUNNING') and not self._tilesIn('PENDING'):
+                break
+
+            self.sleep(interval)
+            if self._poll():
+                interval = self.pollInterval
+            else:
+                interval = min(interval * self.backoff, self.maxPollInterval)
+
+        nFailed = len(self._tilesIn('FAILED'))
+        if nFailed:
+            self.logger.warning(f'{nFailed} of {len(self.tiles)} tiles failed to export')
+        return self.manifest
@@ -0,0 +1,271 @@
+import numpy as np
+import ee
+
+# numba is optional: without it compiledForest falls back to the sklearn predict_proba
+try:
+    import numba
+except ImportError:
+    numba = None
+
+def leafProbabilities(value: np.ndarray) -> np.ndarray:
+    """Leaf class probabilities of a tree_.value array (nodes, nClasses). sklearn >= 1.4 stores fractions, older
+    versions store counts (normalised at predict time)"""
+    total = value.sum(axis = 1)
+    if np.allclose(total[total > 0], 1):
+        return value
+    total[total == 0] = 1
+    return value / total[:, None]
+
+# Compiled inference for fitted scikit-learn decision trees and random forests. The trees are packed into flat
+# node arrays once and whole windows are evaluated in one compiled call (no input validation, joblib dispatch or
+# per tree probability arrays). The traversal and the accumulation of the tree probabilities follow sklearn (tree
+# order, float64 sums divided by the number of trees), so the probabilities are identical to sklearn's
+# single-threaded predict_proba. The compiled loops release the GIL, so windows processed by the threads of
+# prepareModel.inference run in parallel. On one core the gain is only the removed per call overhead: about 1.3x
+# the sklearn throughput on 64x64 windows and about the same (1.0x) on 256x256 windows (50 trees, 30 bands,
+# 6 classes), sklearn's traversal of fully grown trees is not faster to compile.
+
+def _traverse(X, roots, left, right, feature, threshold, missingLeft, values):
+    """Sum the leaf values of all trees for every sample (rows of X)"""
+    out = np.zeros((X.shape[0], values.shape[1]))
+    # one tree at a time for all samples keeps the nodes of the tree in cache
+    for root in roots:
+        for i in range(X.shape[0]):
+            node = root
+            while left[node] != -1:
+                x = X[i, feature[node]]
+                if x <= threshold[node] or (np.isnan(x) and missingLeft[node]):
+                    node = left[node]
+                else:
+                    node = right[node]
+            for k in range(values.shape[1]):
+                out[i, k] += values[node, k]
+    return out
+
+_traverseCompiled = numba.njit(nogil = True, cache = True)(_traverse) if numba is not None else None
+
+class compiledForest:
+    """
+    Compiled inference for a fitted sklearn DecisionTreeClassifier or RandomForestClassifier (single output).
+    Provides predict, predict_proba, classes_ and n_classes_, so it can replace the model in
+    prepareModel.inference. Probabilities are identical to the single-threaded sklearn predict_proba.
+
+    # Example Usuage
+    clf = prepareModel.fittedClassifier
+    model = compiledForest(clf)
+    prepareModel.inference('all', 'covariates.tif', model, confModel, 'predictions.tif', patchSize = 256)
+    """
+    def __init__(self, forest, backend: str = 'auto'):
+        """
+        Args:
+            forest: A fitted sklearn DecisionTreeClassifier or RandomForestClassifier
+            backend (str): 'numba' (compiled traversal, requires numba), 'sklearn' (the predict_proba of forest) or
+             'auto' (numba if installed)
+        """
+        if backend not in ['auto', 'numba', 'sklearn']:
+            raise ValueError("backend should be one of 'auto', 'numba' or 'sklearn'")
+        if backend == 'numba' and numba is None:
+            raise ImportError('the numba backend requires numba (pip install numba)')
+        self.backend = ('numba' if numba is not None else 'sklearn') if backend == 'auto' else backend
+        self.forest = forest
+        if getattr(forest, 'n_outputs_', 1) != 1:
+            raise ValueError('only single output classifiers are supported')
+        estimators = getattr(forest, 'estimators_', [forest])
+        self.classes_ = forest.classes_
+        self.n_classes_ = forest.n_classes_
+        self.n_features_in_ = forest.n_features_in_
+        self.nTrees = len(estimators)
+
+        # pack the trees into flat arrays, child indices are offset to the position of the tree
+        roots, left, right, feature, threshold, missingLeft, values = [], [], [], [], [], [], []
+        offset = 0
+        for estimator in estimators:
+            tree = estimator.tree_
+            isLeaf = tree.children_left == -1
+            roots.append(offset)
+            left.append(np.where(isLeaf, -1, tree.children_left + offset))
+            right.append(np.where(isLeaf, -1, tree.children_right + offset))
+            feature.append(np.where(isLeaf, 0, tree.feature))
+            threshold.append(tree.threshold)
+            missingLeft.append(getattr(tree, 'missing_go_to_left', np.zeros(tree.node_count, bool)).astype(bool))
+            values.append(leafProbabilities(tree.value[:, 0, :self.n_classes_]))
+            offset += tree.node_count
+        self.roots = np.array(roots, dtype = np.intp)
+        self.left = np.concatenate(left).astype(np.intp)
+        self.right = np.concatenate(right).astype(np.intp)
+        self.feature = np.concatenate(feature).astype(np.intp)
+        self.threshold = np.concatenate(threshold).astype(np.float64)
+        self.missingLeft = np.concatenate(missingLeft)
+        self.values = np.ascontiguousarray(np.concatenate(values), dtype = np.float64)
+
+    def predict_proba(self, X) -> np.ndarray:
+        """
+        Class probabilities (average of the tree probabilities).
+
+        Args:
+            X (np.ndarray or pd.DataFrame): samples (n, nFeatures). Converted to float32 as in sklearn
+
+        Returns:
+            np.ndarray (n, nClasses) float64
+        """
+        X = np.ascontiguousarray(X, dtype = np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f'X should have shape (n, {self.n_features_in_})')
+        if self.backend == 'sklearn':
+            return self.forest.predict_proba(X)
+        out = _traverseCompiled(X, self.roots, self.left, self.right, self.feature, self.threshold, self.missingLeft,
+                       self.values)
+        out /= self.nTrees
+        return out
+
+    def predict(self, X) -> np.ndarray:
+        """The class with the highest probability"""
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis = 1), axis = 0)
+
+
+# Conversion of fitted sklearn trees to the text format of ee.Classifier.decisionTree/decisionTreeEnsemble (the
+# format of geemap.ml.tree_to_string), so a locally trained model can classify images server side. The first line is
+# "1) root <n> 9999 9999 (<impurity>)", every other line is a node: "<id>) <feature> <= <threshold> <n> <impurity>
+# <value>" (or ">" for right children), indented by depth, with heap numbering (children of node i are 2i and 2i + 1)
+# and " *" after leaves. Unlike geemap, thresholds are written with repr instead of 6 decimals, so float32 pixel
+# values next to a threshold take the same branch as in sklearn.
+
+def treeToString(tree, featureNames: list, values: np.ndarray) -> str:
+    """
+    Write a fitted sklearn tree as an Earth Engine decision tree string.
+
+    Args:
+        tree: A fitted sklearn DecisionTreeClassifier (or its tree_)
+        featureNames (list): The band name of every feature
+        values (np.ndarray): The output of every node (node_count), e.g. the class or the probability of a class
+
+    Returns:
+        (str) decision tree string
+    """
+    tree = getattr(tree, 'tree_', tree)
+    left, right = tree.children_left, tree.children_right
+    leaf = lambda node: ' *' if left[node] == -1 else ''
+    if left[0] == -1:
+        # a single leaf: the root line holds the value
+        return f'1) root {tree.n_node_samples[0]} {tree.impurity[0]:.4f} {values[0]!r} *\n'
+    lines = [f'1) root {tree.n_node_samples[0]} 9999 9999 ({tree.impurity.sum()})']
+    # depth first with the left (<=) child first, as (node, parent, heap id, depth)
+    stack = [(right[0], 0, 3, 1), (left[0], 0, 2, 1)]
+    while stack:
+        node, parent, nodeId, depth = stack.pop()
+        sign = '<=' if nodeId % 2 == 0 else '>'
+        lines.append(f'{"  " * depth}{nodeId}) {featureNames[tree.feature[parent]]} {sign} '
+                     f'{float(tree.threshold[parent])!r} {tree.n_node_samples[node]} {tree.impurity[node]:.4f} '
+                     f'{values[node]!r}{leaf(node)}')
+        if left[node] != -1:
+            stack += [(right[node], node, 2 * nodeId + 1, depth + 1), (left[node], node, 2 * nodeId, depth + 1)]
+    return '\n'.join(lines) + '\n'
+
+def forestToStrings(forest, featureNames: list, classIndex: int = None, maxDepth: int = 30) -> list:
+    """
+    Write the trees of a fitted sklearn DecisionTreeClassifier or RandomForestClassifier as Earth Engine decision
+    tree strings.
+
+    Args:
+        forest: The fitted classifier
+        featureNames (list): The band name of every feature
+        classIndex (int): If None, leaves output the majority class (for votes). Otherwise leaves output the
+         probability of classes_[classIndex] (one-vs-rest, averaged by a REGRESSION ensemble)
+        maxDepth (int): The maximum tree depth. Heap ids double with every level (2 ** 41 at depth 40) and the string
+         of a fully grown tree is about as large as its number of nodes times 60 bytes
+
+    Returns:
+        list of (str) decision tree strings, one per tree
+    """
+    depth = max(estimator.tree_.max_depth for estimator in getattr(forest, 'estimators_', [forest]))
+    if depth > maxDepth:
+        raise ValueError(f'the trees are {depth} levels deep (maxDepth {maxDepth}). Refit with max_depth <= '
+                         f'{maxDepth} to classify server side')
+    strings = []
+    for estimator in getattr(forest, 'estimators_', [forest]):
+        value = leafProbabilities(estimator.tree_.value[:, 0, :forest.n_classes_])
+        if classIndex is None:
+            values = [forest.classes_[index].item() for index in np.argmax(value, axis = 1)]
+        else:
+            values = [float(probability) for probability in value[:, classIndex]]
+        strings.append(treeToString(estimator, featureNames, values))
+    return strings
+
+def batchStrings(strings: list, maxBytes: float = 1e6) -> list:
+    """
+    Group tree strings (in order) into batches of at most maxBytes, e.g. one decisionTreeEnsemble per batch to stay
+    below the Earth Engine request payload limits.
+
+    Args:
+        strings (list): The tree strings
+        maxBytes (float): The maximum size of the strings of a batch
+
+    Returns:
+        list of lists of strings
+    """
+    batches, size = [], maxBytes
+    for string in strings:
+        length = len(string.encode())
+        if length > maxBytes:
+            raise ValueError(f'a tree ({length} bytes) is larger than maxBytes. Increase maxBytes or limit the tree '
+                             'depth')
+        if size + length > maxBytes:
+            batches.append([])
+            size = 0
+        batches[-1].append(string)
+        size += length
+    return batches
+
+def classifyForest(image: ee.Image, forest, featureNames: list, output: str = 'probability', bandNames: list = None,
+                   maxBytes: float = 1e6, maxTotalBytes: float = 1e7, maxDepth: int = 30) -> ee.Image:
+    """
+    Classify an image server side with a locally fitted sklearn DecisionTreeClassifier or RandomForestClassifier.
+
+    Each class is a separate one-vs-rest regression ensemble: the trees with the probability of that class as leaf
+    value, averaged in REGRESSION mode (as sklearn's predict_proba), so a 'probability' image costs one ensemble per
+    class. Trees are split into ensembles of at most maxBytes (see batchStrings) that are combined with weights
+    proportional to their number of trees. All ensembles of all classes are part of one request, so the total size of
+    the strings is limited to maxTotalBytes.
+
+    Args:
+        image (ee.Image): The image with the featureNames bands
+        forest: The fitted classifier
+        featureNames (list): The bands used to fit forest, in order
+        output (str): 'probability' (one band per class, e.g. the input of conformalImageClassifier.predict) or
+         'classification' (majority vote)
+        bandNames (list): Names of the probability bands. Defaults to the class values
+        maxBytes (float): The maximum size of the trees of one ensemble
+        maxTotalBytes (float): The maximum size of all trees (of all classes) in the request
+        maxDepth (int): The maximum tree depth (see forestToStrings)
+
+    Returns:
+        ee.Image
+    """
+    nTrees = len(getattr(forest, 'estimators_', [forest]))
+    if output == 'classification':
+        classStrings = [forestToStrings(forest, featureNames, maxDepth = maxDepth)]
+    elif output == 'probability':
+        classStrings = [forestToStrings(forest, featureNames, classIndex, maxDepth)
+                        for classIndex in range(forest.n_classes_)]
+    else:
+        raise ValueError("output should be 'probability' or 'classification'")
+    total = sum(len(string.encode()) for strings in classStrings for string in strings)
+    if total > maxTotalBytes:
+        raise ValueError(f'the trees are {total} bytes (maxTotalBytes {maxTotalBytes:.0f}). Use fewer or shallower '
+                         'trees, or export the ensembles as classifier assets')
+
+    if output == 'classification':
+        batches = batchStrings(classStrings[0], maxBytes)
+        if len(batches) > 1:
+            raise ValueError('majority votes of several ensembles are not supported. Increase maxBytes')
+        return image.classify(ee.Classifier.decisionTreeEnsemble(batches[0]))
+
+    bandNames = bandNames or [str(value) for value in forest.classes_]
+    bands = []
+    for classIndex, strings in enumerate(classStrings):
+        probability = ee.Image(0)
+        for batch in batchStrings(strings, maxBytes):
+            classifier = ee.Classifier.decisionTreeEnsemble(batch).setOutputMode('REGRESSION')
+            probability = probability.add(image.classify(classifier).multiply(len(batch) / nTrees))
+        bands.append(probability.rename(bandNames[classIndex]))
+    return ee.Image.cat(bands)
@@ -0,0 +1,148 @@
+import os
+import json
+import zlib
+import pickle
+import hashlib
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+def windowChecksum(array: np.ndarray) -> int:
+    """crc32 of the bytes of a (written) window"""
+    return zlib.crc32(np.ascontiguousarray(array).tobytes())
+
+def fingerprint(obj) -> str:
+    """sha256 of the pickled object (e.g. a fitted model), or of its type name if it cannot be pickled"""
+    try:
+        content = pickle.dumps(obj, protocol = 4)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        content = f'{type(obj).__module__}.{type(obj).__qualname__}'.encode()
+    return hashlib.sha256(content).hexdigest()
+
+def fileIdentity(path: str) -> dict:
+    """Absolute path, modification time and size of a file, changed when the file is rewritten"""
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+class inferenceJournal:
+    """
+    Sidecar journal of a raster inference run (see prepareModel.inference). Windows are identified by their
+    position in the window grid (row_off // patchSize, col_off // patchSize). The journal keeps a bitmap of the
+    windows written to the output and the crc32 of every written window, and is saved atomically (NPZ) so that an
+    interrupted run can be resumed and the output can be checked at the end.
+
+    # Example Usuage
+    journal = inferenceJournal.open('predictions.tif', width, height, patchSize = 256,
+                                    meta = {'mode': 'all', 'input': fileIdentity('covariates.tif'),
+                                            'model': fingerprint(clf)})
+    bad = journal.verify('predictions.tif')
+    """
+    def __init__(self, path: str, gridShape: tuple, meta: dict, done: np.ndarray = None, crc: np.ndarray = None):
+        """
+        Args:
+            path (str): File path of the journal (NPZ)
+            gridShape (tuple): (rows, cols) of the window grid
+            meta (dict): Parameters and identity of the run (e.g. mode, band count, patchSize, the input file, a
+             model fingerprint and the calibration). A journal is only resumed by a run with the same meta
+            done (np.ndarray): bool (rows, cols), True = window written
+            crc (np.ndarray): uint32 (rows, cols) crc32 of the written windows
+        """
+        self.path = path
+        self.gridShape = tuple(gridShape)
+        self.meta = meta
+        self.done = done if done is not None else np.zeros(self.gridShape, bool)
+        self.crc = crc if crc is not None else np.zeros(self.gridShape, np.uint32)
+
+    @classmethod
+    def open(cls, outfile: str, width: int, height: int, patchSize: int, meta: dict = None):
+        """
+        Load the journal of outfile if it exists and belongs to a run with the same parameters, otherwise create a
+        new (empty) journal.
+
+        Args:
+            outfile (str): File path of the output raster. The journal is outfile + '.journal.npz'
+            width, height (int): The size of the output raster (pixels)
+            patchSize (int): The height and width of the windows
+            meta (dict): Parameters of the run (json serialisable)
+
+        Returns:
+            inferenceJournal
+        """
+        path = str(outfile) + '.journal.npz'
+        gridShape = (-(-height // patchSize), -(-width // patchSize))
+        meta = dict(meta or {}, width = width, height = height, patchSize = patchSize)
+        if os.path.exists(path) and os.path.exists(outfile):
+            with np.load(path) as journal:
+                if json.loads(str(journal['meta'])) == json.loads(json.dumps(meta)):
+                    done = np.unpackbits(journal['done'], count = gridShape[0] * gridShape[1]).astype(bool)
+                    return cls(path, gridShape, meta, done.reshape(gridShape), journal['crc'].copy())
+        return cls(path, gridShape, meta)
+
+    @classmethod
+    def read(cls, outfile: str):
+        """
+        Load the journal of outfile whatever run it belongs to (e.g. to inspect it), None if there is no journal.
+
+        Returns:
+            inferenceJournal
+        """
+        path = str(outfile) + '.journal.npz'
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as journal:
+            meta = json.loads(str(journal['meta']))
+            gridShape = journal['crc'].shape
+            done = np.unpackbits(journal['done'], count = gridShape[0] * gridShape[1]).astype(bool)
+            return cls(path, gridShape, meta, done.reshape(gridShape), journal['crc'].copy())
+
+    @property
+    def resumable(self) -> bool:
+        """True if windows of a previous run are recorded"""
+        return bool(self.done.any())
+
+    def index(self, window: Window) -> tuple:
+        """Grid position (row, col) of a window"""
+        patchSize = self.meta['patchSize']
+        return int(window.row_off) // patchSize, int(window.col_off) // patchSize
+
+    def isDone(self, window: Window) -> bool:
+        return bool(self.done[self.index(window)])
+
+    def mark(self, window: Window, array: np.ndarray):
+        """Record a window and the checksum of the array written to it"""
+        index = self.index(window)
+        self.crc[index] = windowChecksum(array)
+        self.done[index] = True
+
+    def save(self):
+        """Save the journal atomically (a crash while saving leaves the previous journal)"""
+        tmp = self.path + '.tmp.npz'
+        np.savez(tmp, done = np.packbits(self.done.ravel()), crc = self.crc, meta = json.dumps(self.meta))
+        os.replace(tmp, self.path)
+
+    def verify(self, outfile: str) -> list:
+        """
+        Check the recorded windows of the output against their checksums. Windows that do not match (e.g. not
+        flushed to disk before a crash) are removed from the journal.
+
+        Args:
+            outfile (str): File path of the output raster
+
+        Returns:
+            list of (row, col) grid positions of the windows that do not match
+        """
+        patchSize = self.meta['patchSize']
+        bad = []
+        with rasterio.open(outfile) as dst:
+            for row, col in zip(*np.nonzero(self.done)):
+                window = Window(col * patchSize, row * patchSize, min(patchSize, dst.width - col * patchSize),
+                                min(patchSize, dst.height - row * patchSize))
+                try:
+                    matches = windowChecksum(dst.read(window = window)) == self.crc[row, col]
+                except rasterio.errors.RasterioIOError:
+                    matches = False
+                if not matches:
+                    bad.append((int(row), int(col)))
+                    self.done[row, col] = False
+        return bad
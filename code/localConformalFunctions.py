@@ -0,0 +1,219 @@
+import math
+import numpy as np
+
+from code.scoreFunctions import checkScore
+
+# Local (NumPy) equivalents of the conformal computations done in Earth Engine. Functions operate on a batch
+# of samples/pixels (e.g. one inference window) at a time.
+
+def classScores(probs: np.ndarray, score: str = 'lac', lam: float = 0.01, kReg: int = 1) -> np.ndarray:
+    """
+    Compute the score of every candidate class (see scoreFunctions for the definitions).
+
+    Args:
+        probs (np.ndarray): class probabilities (n, nClasses)
+        score (str): One of 'lac', 'aps' or 'raps'
+        lam (float): raps penalty per class beyond kReg
+        kReg (int): raps number of classes that are not penalised
+
+    Returns:
+        np.ndarray (n, nClasses) of scores
+    """
+    checkScore(score)
+    if score == 'lac':
+        return probs
+    # sort descending by probability
+    order = np.argsort(-probs, axis = 1)
+    cumulative = np.cumsum(np.take_along_axis(probs, order, axis = 1), axis = 1)
+    # back to class order
+    scores = np.empty_like(cumulative)
+    np.put_along_axis(scores, order, cumulative, axis = 1)
+    if score == 'raps':
+        rank = np.empty_like(order)
+        np.put_along_axis(rank, order, np.arange(1, probs.shape[1] + 1)[None, :], axis = 1)
+        scores += lam * np.maximum(rank - kReg, 0)
+    return scores
+
+def labelScores(probs: np.ndarray, labels: np.ndarray, score: str = 'lac', lam: float = 0.01, kReg: int = 1) -> np.ndarray:
+    """
+    Compute nonconformity scores of the reference class.
+
+    Args:
+        probs (np.ndarray): class probabilities (n, nClasses)
+        labels (np.ndarray): reference class index of each sample (n,)
+
+    Returns:
+        np.ndarray (n,) of scores
+    """
+    scores = classScores(probs, score, lam, kReg)
+    return np.take_along_axis(scores, np.asarray(labels)[:, None], axis = 1)[:, 0]
+
+def conformalQuantile(scores: np.ndarray, alpha: float, lower: bool = False) -> float:
+    """
+    Compute qHat, the finite-sample corrected quantile of the calibration scores i.e. the
+    ceil((n+1)(1-alpha))-th smallest score (or largest score if lower=True). The order statistic is selected with
+    np.partition (O(n)) instead of a full sort.
+
+    Args:
+        scores (np.ndarray): calibration scores
+        alpha (float): The tolerance level between 0-1
+        lower (bool): True for scores where higher values are more conforming (lac)
+
+    Returns:
+        (float) qHat. +-inf if there are too few calibration samples for the requested alpha
+    """
+    n = len(scores)
+    k = math.ceil((n + 1) * (1 - alpha))
+    if k > n:
+        return -np.inf if lower else np.inf
+    index = n - k if lower else k - 1
+    return float(np.partition(np.asarray(scores), index)[index])
+
+def predictionSets(probs: np.ndarray, qHat: float, score: str = 'lac', lam: float = 0.01, kReg: int = 1) -> np.ndarray:
+    """
+    Compute prediction sets.
+
+    Args:
+        probs (np.ndarray): class probabilities (n, nClasses)
+        qHat (float): The calibrated threshold
+
+    Returns:
+        np.ndarray (n, nClasses) of bools, True = included in set
+    """
+    if score == 'lac':
+        return probs >= qHat
+    return classScores(probs, score, lam, kReg) <= qHat
+
+def residualScores(y: np.ndarray, yhat: np.ndarray, sigma: np.ndarray = None) -> np.ndarray:
+    """
+    Compute absolute residual (|y-yhat|) or normalised residual (|y-yhat|/sigma) nonconformity scores.
+
+    Args:
+        y (np.ndarray): reference values
+        yhat (np.ndarray): predicted values
+        sigma (np.ndarray): per-sample difficulty estimate (> 0). If None, absolute residuals are returned
+
+    Returns:
+        np.ndarray of scores
+    """
+    scores = np.abs(np.asarray(y) - np.asarray(yhat))
+    if sigma is not None:
+        scores = scores / np.asarray(sigma)
+    return scores
+
+def predictionIntervals(yhat: np.ndarray, qHat: float, sigma: np.ndarray = None) -> tuple:
+    """
+    Compute prediction intervals yhat +- qHat (or yhat +- qHat * sigma).
+
+    Args:
+        yhat (np.ndarray): predicted values e.g. a window of predictions
+        qHat (float): The calibrated threshold
+        sigma (np.ndarray): per-sample difficulty estimate, same shape as yhat
+
+    Returns:
+        lower (np.ndarray), upper (np.ndarray)
+    """
+    halfWidth = qHat if sigma is None else qHat * np.asarray(sigma)
+    return yhat - halfWidth, yhat + halfWidth
+
+def encodeHalfWidth(halfWidth: np.ndarray, widthScale: float = 0.01) -> np.ndarray:
+    """
+    Local equivalent of conformalRegressor.compactIntervals. Scale half-widths to int16, rounded up so decoded
+    intervals are never narrower than the calibrated ones.
+
+    Args:
+        halfWidth (np.ndarray): interval half-widths e.g. qHat * sigma
+        widthScale (float): The units of the int16 half-width
+
+    Returns:
+        np.ndarray (int16)
+    """
+    return np.minimum(np.ceil(np.asarray(halfWidth) / widthScale), np.iinfo(np.int16).max).astype(np.int16)
+
+def decodeIntervals(prediction: np.ndarray, halfWidth: np.ndarray = None, widthScale: float = 1.0,
+                    widthOffset: float = 0.0, qHat: float = None) -> tuple:
+    """
+    Decode compact regression outputs (e.g. exported by predict(..., output = 'compact')) into interval bounds.
+
+    Args:
+        prediction (np.ndarray): The 'prediction' band/property
+        halfWidth (np.ndarray): The int16 'halfWidth' band/property. None if the half-width is constant (qHat)
+        widthScale (float): The 'halfWidthScale' metadata
+        widthOffset (float): The 'halfWidthOffset' metadata
+        qHat (float): The 'qHat' metadata, used if halfWidth is None
+
+    Returns:
+        lower (np.ndarray), upper (np.ndarray)
+    """
+    if halfWidth is None:
+        return predictionIntervals(prediction, qHat)
+    width = np.asarray(halfWidth, dtype = np.float64) * widthScale + widthOffset
+    return prediction - width, prediction + width
+
+def repeatedSplitCoverage(scores: np.ndarray, alpha: float, split: float = 0.5, repeats: int = 1000, seed: int = 42,
+                          lower: bool = False, classScores: np.ndarray = None, sigma: np.ndarray = None,
+                          quantiles: tuple = (0.05, 0.5, 0.95), chunkSize: int = 50_000_000) -> dict:
+    """
+    Evaluate many random calibration/test partitions of the same (precomputed) scores. Partitions are a
+    (repeats, n) boolean mask over the scores sorted once, and qHat of every partition is read from the running
+    count of the mask, so the cost grows with repeats * n array operations instead of repeats full calibrations.
+
+    Args:
+        scores (np.ndarray): nonconformity score of every sample (n,) e.g. from labelScores or residualScores
+        alpha (float): The tolerance level between 0-1
+        split (float): The proportion of samples used for calibration in each partition
+        repeats (int): The number of partitions
+        seed (int): Seed of the partitions
+        lower (bool): True for scores where higher values are more conforming (lac)
+        classScores (np.ndarray): scores of every candidate class (n, nClasses) from classScores. If provided the
+         average set size of every partition is computed
+        sigma (np.ndarray): regression only. The per-sample difficulty estimate of normalised residual scores
+        quantiles (tuple): Quantiles of the coverage (and set size/width) distribution to report
+        chunkSize (int): Maximum number of (repeat, sample, class) elements held in memory at once
+
+    Returns:
+        dict with the qHat, coverage and setSize (classification) or width (regression) of every partition and a
+        'summary' with their mean and quantiles
+    """
+    scores = np.asarray(scores, dtype = np.float64)
+    n = len(scores)
+    # work on ascending scores (negate lac scores)
+    sign = -1 if lower else 1
+    order = np.argsort(sign * scores, kind = 'stable')
+    ordered = sign * scores[order]
+    # masks are drawn directly in sorted order, so reorder the per-sample inputs once
+    if classScores is not None:
+        classScores = sign * np.asarray(classScores, dtype = np.float64)[order]
+    if sigma is not None:
+        sigma = np.asarray(sigma, dtype = np.float64)[order]
+    rng = np.random.default_rng(seed)
+
+    qHat, coverage, nCal, size = (np.empty(repeats) for _ in range(4))
+    step = max(1, chunkSize // (n * (1 if classScores is None else classScores.shape[1])))
+    for start in range(0, repeats, step):
+        rows = slice(start, min(start + step, repeats))
+        masks = rng.random((rows.stop - start, n)) < split
+        counts = masks.sum(axis = 1)
+        k = np.ceil((counts + 1) * (1 - alpha)).astype(np.int64)
+        # the k-th smallest calibration score is at the first position where the running count reaches k
+        rank = np.cumsum(masks, axis = 1, dtype = np.int32)
+        position = np.argmax(rank >= np.clip(k, 1, np.maximum(counts, 1))[:, None], axis = 1)
+        q = np.where(k > counts, np.inf, ordered[position])
+        testMasks = ~masks
+        nTest = np.maximum(testMasks.sum(axis = 1), 1)
+        coverage[rows] = ((ordered[None, :] <= q[:, None]) & testMasks).sum(axis = 1) / nTest
+        qHat[rows], nCal[rows] = sign * q, counts
+        if classScores is not None:
+            inSet = classScores[None] <= q[:, None, None]
+            size[rows] = (inSet.sum(axis = 2) * testMasks).sum(axis = 1) / nTest
+        elif sigma is not None:
+            size[rows] = 2 * qHat[rows] * (testMasks @ sigma) / nTest
+        else:
+            size[rows] = 2 * qHat[rows]
+
+    result = {'qHat': qHat, 'coverage': coverage, 'nCal': nCal.astype(np.int64),
+              'setSize' if classScores is not None else 'width': size}
+    result['summary'] = {name: dict(mean = float(np.mean(values)),
+                                    **{f'q{quantile:g}': float(np.quantile(values, quantile)) for quantile in quantiles})
+                         for name, values in result.items() if name in ('coverage', 'setSize', 'width')}
+    return result
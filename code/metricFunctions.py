@@ -1,13 +1,17 @@
 import ee
+import numpy as np
+from typing import Union
 # This class is used to calculate average accuracy and confusion matrix for a set of folds
-# The class takes in an multi-band image of classification results, number of classes and number of folds
+# The class takes in an multi-band image of classification results (or a FeatureCollection of fold metrics),
+# number of classes and number of folds
 # A confusion matrix is calculated by summing up the confusion matrixes from each fold
 # The average accuracy is calculated by weighting each fold by the number of samples in each fold
 class prepareMetrics:
     """class to calculate average accuracy and confusion matrix for a set of folds"""
-    def __init__(self, classImage: ee.Image, nClasses: int, nFolds: int):
-        """classImage (ee.Image): multi-band image of classification results. Each band is
-          one classification output from a fold.
+    def __init__(self, classImage: Union[ee.ImageCollection, ee.FeatureCollection], nClasses: int, nFolds: int):
+        """classImage (ee.ImageCollection | ee.FeatureCollection): classification results from
+          prepareModel.kFoldCV (one classified image per fold) or fold metrics from prepareModel.kFoldMetrics
+          (one feature per fold).
            nClasses (int): number of classes
            nFolds (int): number of folds"""
         
@@ -15,53 +19,92 @@ class prepareMetrics:
         self.nClasses = nClasses
         self.nFolds = nFolds
         
-    def averageAccuracy(self) -> ee.Number:
-        """calculate av acc  by  weighting for validation sample size"""
-        acc_arr = self.classImage.aggregate_array('acc')
-        acc_num = self.classImage.aggregate_array('num')
+    def averageAccuracy(self, verbose: bool = False) -> ee.Number:
+        """calculate av acc  by  weighting for validation sample size
+
+        Args:
+            verbose (bool): if True, print the average accuracy (requires a getInfo call)"""
+        acc_arr = ee.Array(self.classImage.aggregate_array('acc'))
+        acc_num = ee.Array(self.classImage.aggregate_array('num'))
         self.acc_raw = self.classImage.aggregate_array('raw')
-        tot = acc_num.reduce(ee.Reducer.sum())
+        tot = acc_num.reduce(ee.Reducer.sum(), [0]).get([0])
 
-        # the weight for each sample
-        weight = acc_num.map(lambda item: ee.Number(item).divide(tot))
-        # final accuracy
-        acc_final = ee.Array(weight).multiply(ee.Array(acc_arr)).reduce(ee.Reducer.sum(),[0])
-        print(f'The average weighted accuracy is {acc_final.getInfo()} across {self.nFolds} folds')
+        # final accuracy (each fold weighted by its number of validation samples)
+        acc_final = acc_arr.multiply(acc_num).reduce(ee.Reducer.sum(), [0]).get([0]).divide(tot)
+        if verbose:
+            print(f'The average weighted accuracy is {acc_final.getInfo()} across {self.nFolds} folds')
         return acc_final
-    
-    def confusionMatrix(self) -> ee.Image:
-        """sum confusion matrices for each fold
 
-        returns ee.Image with accuracy and confusion matrices as properties"""
-        
-        # first create an empty confusion matrix
-        first = ee.Array(ee.List.repeat(0, self.nClasses)).repeat(axis=1,copies= self.nClasses)
-        first = ee.List([first])
-        
+    def metrics(self) -> ee.Dictionary:
+        """sum the confusion matrices of all folds in a single array reduction and compute accuracy metrics.
+        Nothing is computed until the result is requested.
+
+        returns ee.Dictionary with the weighted average accuracy (acc), summed confusion matrix (confusion),
+        producers accuracy (pa), consumers accuracy (ca), kappa and F1 score (f1)"""
         acc_final = self.averageAccuracy()
-        
-        def accumulate(item, lst):
-            """funciton to sum up confusion matrixes"""
-            previous = ee.Array(ee.List(lst).get(-1))
-            added = ee.Array(item).add(previous)
-            return ee.List(lst).add(added)
 
-        # apply function
-        con_matrix = ee.List(self.acc_raw.iterate(accumulate, first)).get(self. nFolds)
+        # stack fold confusion matrices (nFolds x nClasses x nClasses) and sum along the fold axis
+        con_matrix = ee.Array(self.acc_raw).reduce(ee.Reducer.sum(), [0]).project([1, 2])
 
         # create confusion matrix from results and calc accuracies
         con_matrix = ee.ConfusionMatrix(con_matrix)
-        pa = con_matrix.producersAccuracy()
-        ca = con_matrix.consumersAccuracy()
-        
+
+        return ee.Dictionary({
+            'acc': acc_final,
+            'confusion': con_matrix.array(),
+            'pa': con_matrix.producersAccuracy(),
+            'ca': con_matrix.consumersAccuracy(),
+            'kappa': con_matrix.kappa(),
+            'f1': con_matrix.fScore()})
+
+    def confusionMatrix(self) -> Union[ee.Image, ee.Feature]:
+        """sum confusion matrices for each fold
+
+        returns ee.Image (mode of the fold classifications) with accuracy and confusion matrices as properties.
+        If fold metrics (ee.FeatureCollection) were provided, a null geometry ee.Feature is returned instead."""
+
         # summarize result to single image
-        result_final = self.classImage.mode()
+        if isinstance(self.classImage, ee.ImageCollection):
+            result_final = self.classImage.mode()
+        else:
+            # fold metrics only, no classified images to summarise
+            result_final = ee.Feature(None)
 
         # set properties of summary to accuracy metrics
-        result_final = result_final.set(
-          'acc', acc_final,
-          'confusion', con_matrix,
-          'pa', pa,
-          'ca', ca)
-        
-        return result_final
\ No newline at end of file
+        return result_final.set(self.metrics())
+
+
+def foldMetrics(raw: np.ndarray, acc: np.ndarray, num: np.ndarray) -> dict:
+    """Local (NumPy) equivalent of prepareMetrics.metrics for confusion matrices computed outside of GEE
+    (e.g. sklearn.metrics.confusion_matrix). Rows are the actual classes and columns the predicted classes.
+
+    Args:
+        raw (np.ndarray): fold confusion matrices (nFolds x nClasses x nClasses)
+        acc (np.ndarray): accuracy of each fold
+        num (np.ndarray): number of validation samples in each fold
+
+    Returns:
+        dict with the weighted average accuracy (acc), summed confusion matrix (confusion),
+        producers accuracy (pa), consumers accuracy (ca), kappa and F1 score (f1)"""
+    num = np.asarray(num, dtype=np.float64)
+    acc_final = float(np.sum(np.asarray(acc, dtype=np.float64) * num) / num.sum())
+
+    # sum along the fold axis
+    con_matrix = np.asarray(raw, dtype=np.float64).sum(axis=0)
+    total = con_matrix.sum()
+    correct = np.diag(con_matrix)
+    rowSums = con_matrix.sum(axis=1)
+    colSums = con_matrix.sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pa = np.where(rowSums > 0, correct / rowSums, 0.0)
+        ca = np.where(colSums > 0, correct / colSums, 0.0)
+        f1 = np.where(pa + ca > 0, 2 * pa * ca / (pa + ca), 0.0)
+
+    # observed and chance agreement
+    po = correct.sum() / total
+    pe = np.sum(rowSums * colSums) / total**2
+    # chance agreement is 1 with a single class: kappa is undefined, 0 as for pa/ca/f1
+    kappa = float((po - pe) / (1 - pe)) if pe < 1 else 0.0
+
+    return {'acc': acc_final, 'confusion': con_matrix, 'pa': pa, 'ca': ca, 'kappa': kappa, 'f1': f1}
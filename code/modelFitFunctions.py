@@ -1,4 +1,6 @@
 import os
+import json
+import hashlib
 from typing import Union
 from pathlib import Path
 
@@ -6,34 +8,173 @@ import numpy as np
 import pandas as pd
 import rasterio
 from rasterio.plot import reshape_as_image
+from rasterio.enums import MaskFlags
+import pyarrow as pa
+import pyarrow.feather as feather
 import ee
 from sklearn.ensemble import RandomForestClassifier
 
-from geemap import ee_to_df
-
 # from mapie.calibration import MapieCalibrator
 # from mapie.metrics import top_label_ece
 
 from geedim.download import BaseImage
 from geeml.utils import eeprint
 
+from code.downloadFunctions import tileDownloader, downloadTable
+from code.journalFunctions import inferenceJournal, fingerprint, fileIdentity
+from code.cacheFunctions import resultCache, graphKey
+from code.calibrationFunctions import calibrationArtifact
+from code.localConformalFunctions import predictionSets
+
 # Parralel processing
 import concurrent.futures
+import contextlib
 import threading
 import logging
 from tqdm.auto import tqdm
 
+def rasterCache(infile: str, cachefile: str = None) -> np.memmap:
+    """
+    Cache a GeoTIFF as an uncompressed, pixel interleaved (rows, cols, bands) NPY file and memory-map it.
+    Windows can then be sliced from the cache by several threads without a lock or GDAL decoding.
+    An existing cache is reused if it is newer than infile.
+
+    Args:
+        infile (str): File path of the GeoTIFF
+        cachefile (str): File path of the NPY cache. Defaults to infile with a .npy suffix
+
+    Returns:
+        np.memmap (rows, cols, bands) opened read only
+    """
+    cachefile = cachefile or str(Path(infile).with_suffix('.npy'))
+    with rasterio.open(infile) as src:
+        shape = (src.height, src.width, src.count)
+        if not (os.path.exists(cachefile) and os.path.getmtime(cachefile) >= os.path.getmtime(infile)):
+            cache = np.lib.format.open_memmap(cachefile + '.tmp', mode = 'w+', dtype = src.dtypes[0], shape = shape)
+            # copy the raster one block (row) at a time
+            for _, window in src.block_windows(1):
+                rows, cols = window.toslices()
+                cache[rows, cols, :] = np.moveaxis(src.read(window = window), 0, -1)
+            cache.flush()
+            del cache
+            os.replace(cachefile + '.tmp', cachefile)
+
+    cache = np.load(cachefile, mmap_mode = 'r')
+    if cache.shape != shape:
+        raise ValueError(f'{cachefile} does not match {infile}. Delete the cache and try again')
+    return cache
+
+def downcastTable(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Downcast the numeric columns of a table: float64 to float32 (the precision sklearn trees use) and integers to
+    the smallest integer type that holds their range.
+
+    Args:
+        df (pd.DataFrame): The table
+
+    Returns:
+        pd.DataFrame with downcast columns
+    """
+    df = df.copy()
+    for column in df.columns:
+        if pd.api.types.is_float_dtype(df[column]):
+            df[column] = df[column].astype(np.float32)
+        elif pd.api.types.is_integer_dtype(df[column]):
+            df[column] = pd.to_numeric(df[column], downcast = 'integer')
+    return df
+
+def writeTable(df: pd.DataFrame, path: str):
+    """Write a table as an uncompressed Arrow (Feather v2) file, which can be memory-mapped by readTable"""
+    feather.write_feather(df.reset_index(drop = True), path + '.tmp', compression = 'uncompressed')
+    os.replace(path + '.tmp', path)
+
+def readTable(path: str) -> pd.DataFrame:
+    """Read a table written by writeTable. The file is memory-mapped and numeric columns are not copied"""
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(split_blocks = True)
+
 class prepareModel:
     """class to prepare data for model fitting"""
-    def __init__(self, dataset: ee.ImageCollection, responseCol: str, inferenceImage: ee.Image, bandNames: list):
+    def __init__(self, dataset: ee.ImageCollection, responseCol: str, inferenceImage: ee.Image, bandNames: list,
+                 cache: resultCache = None, seed: int = 42, tableDir: str = None, maxDepth: int = None):
         """dataset (ee.ImageCollection): training data
            responseCol (str): name of the response variable
            inferenceImage (ee.Image): image to be classified
-           bandNames (list): list of band names"""
+           bandNames (list): list of band names
+           cache (resultCache): optional disk cache of fetched results (tables, band names, class order)
+           seed (int): seed of the calibration split (see _UQ)
+           tableDir (str): optional directory where the downloaded training, validation and calibration tables are
+            stored (Arrow files, see writeTable) and reloaded from
+           maxDepth (int): maximum depth of the fitted random forest trees. Unlimited by default, use e.g. 30 (the
+            default maxDepth of forestToStrings) to classify images server side with classifyForest"""
         self.dataset = dataset
         self.responseCol = responseCol
         self.inferenceImage = inferenceImage
         self.bandNames = bandNames
+        self.cache = cache
+        self.seed = seed
+        self.tableDir = tableDir
+        self.maxDepth = maxDepth
+        # downloaded tables, fitted models and band names, keyed by the dataset graph, seed and fold
+        self._tables = {}
+        self._models = {}
+        self._bands = (None, None)
+
+    def _fetch(self, obj, compute = None, namespace: str = 'getInfo'):
+        """function to fetch the result of an earth engine object, from the cache if one is provided
+
+        Args:
+            obj (ee.ComputedObject): the object to fetch
+            compute (Callable): function (obj) -> result. Defaults to obj.getInfo()
+            namespace (str): name of the fetch (part of the cache key)
+
+        Returns:
+            the result of compute"""
+        if self.cache is not None:
+            return self.cache.fetch(obj, compute, namespace)
+        return compute(obj) if compute is not None else obj.getInfo()
+
+    def _table(self, collection: ee.FeatureCollection) -> pd.DataFrame:
+        """function to download a feature collection as a pandas dataframe (in concurrent pages, see tableDownloader)"""
+        return self._fetch(collection, downloadTable, 'table')
+
+    def _bandList(self) -> list:
+        """function to get the band names as a python list (fetched once)"""
+        if isinstance(self.bandNames, (list, tuple)):
+            return list(self.bandNames)
+        if self._bands[0] is not self.bandNames:
+            self._bands = (self.bandNames, self._fetch(self.bandNames))
+        return self._bands[1]
+
+    def _splitKey(self, fold: int) -> str:
+        """function to get the key of the data splits: changes with the dataset, the seed and the fold"""
+        return graphKey(self.dataset, f'splits:{self.seed}:{fold}')[:24]
+
+    def _splitTables(self, fold: int = 1) -> dict:
+        """function to download the training, validation and calibration data (see _UQ) once. Tables are
+        downcast (see downcastTable) and, with a tableDir, stored as Arrow files that later sessions memory-map
+
+        Args:
+            fold (int): fold number
+
+        Returns:
+            dict of pandas dataframes with the keys 'training', 'validation' and 'calibration'"""
+        key = self._splitKey(fold)
+        if key in self._tables:
+            return self._tables[key]
+        names = ['training', 'validation', 'calibration']
+        paths = {name: os.path.join(self.tableDir, f'{key}_{name}.arrow') for name in names} if self.tableDir else {}
+        if paths and all(os.path.exists(path) for path in paths.values()):
+            tables = {name: readTable(path) for name, path in paths.items()}
+        else:
+            tables = {name: downcastTable(self._table(split)) for name, split in zip(names, self._UQ(fold = fold))}
+            if paths:
+                os.makedirs(self.tableDir, exist_ok = True)
+                for name, path in paths.items():
+                    writeTable(tables[name], path)
+        self._tables[key] = tables
+        return tables
 
     def _UQ(self, fold:int) -> Union[ee.FeatureCollection, ee.FeatureCollection, ee.FeatureCollection]:
         """function to apply data splitting appropriate when conformal prediction is used.
@@ -52,7 +193,7 @@ class prepareModel:
                 train (ee.FeatureCollection), test (ee.FeatureCollection) """
             
             ## define fraction for training (remainder is for testing)
-            data = self.dataset.randomColumn(seed=42)
+            data = self.dataset.randomColumn(seed=self.seed)
             ## divide into training and testing sets based on the split
             training = data.filter(ee.Filter.lt('random', split))
             validation = data.filter(ee.Filter.gte('random', split))
@@ -72,28 +213,30 @@ class prepareModel:
         Returns:
             ee.FeatureCollection: calibration data"""
         #selected fold is irrelevant here. fold is only used to create train + val datasets
-        _, _, calibration = self._UQ(fold = 1)
-        cal = ee_to_df(calibration)
-        X_cal, y_cal = cal[self.bandNames.getInfo()].values, cal[[self.responseCol]].values.squeeze()
+        cal = self._splitTables(fold = 1)['calibration']
+        X_cal, y_cal = cal[self._bandList()].values, cal[[self.responseCol]].values.squeeze()
         return X_cal, y_cal
     
     @property
     def fittedClassifier(self) -> RandomForestClassifier:
-        """function to fit a random forest model on the combined train and validation data
+        """function to fit a random forest model on the combined train and validation data. The model is fitted
+        once per dataset, seed and fold
         
         Returns:
             scikit learn RandomForest classifer: classified image with accuracy and confusion matrix as properties"""
 
-        training, validation, _ = self._UQ(fold = 1)
-        train = ee_to_df(training)
-        val = ee_to_df(validation)
-        df = pd.concat([train, val])
+        key = self._splitKey(fold = 1)
+        if key in self._models:
+            return self._models[key]
+        tables = self._splitTables(fold = 1)
+        df = pd.concat([tables['training'], tables['validation']])
         #train and apply classifier
-        classifier = RandomForestClassifier(n_estimators=50, max_depth=None, min_samples_split=2,
+        classifier = RandomForestClassifier(n_estimators=50, max_depth=self.maxDepth, min_samples_split=2,
                                              min_samples_leaf=1, max_features=20, bootstrap=True,
                                              oob_score=False, n_jobs=-1, random_state=0, verbose=0,
                                              warm_start=False, class_weight=None)
-        classifier.fit(df[self.bandNames.getInfo()], df[[self.responseCol]])
+        classifier.fit(df[self._bandList()], df[self.responseCol])
+        self._models[key] = classifier
         return classifier
     
     # @property
@@ -106,18 +249,145 @@ class prepareModel:
     #     mapie_reg.fit(X_cal, y_cal)
     #     return mapie_reg
     
-    def inference(self, mode : str, infile: str, model, confModel, outfile : str, patchSize : int, num_workers : int = 4):
+    def _setThresholds(self, confModel, alphas: list) -> tuple:
+        """
+        Get the score function and the qHat of every alpha from a calibrationArtifact or a qHat (lac score).
+
+        Returns:
+            score (str), score parameters (dict) and a list of qHat (float or per class list) per alpha
+        """
+        if isinstance(confModel, calibrationArtifact):
+            params = {key: confModel.params[key] for key in ('lam', 'kReg') if key in confModel.params}
+            return confModel.score, params, [confModel.qHat(alpha) for alpha in alphas]
+        if len(alphas) > 1:
+            raise ValueError('a single qHat cannot be applied to several alphas. Use a calibrationArtifact')
+        return 'lac', {}, [float(confModel)]
+
+    def _predictWindow(self, mode: str, data: pd.DataFrame, shape: tuple, model, confModel,
+                       alpha: Union[float, list] = 0.1) -> np.ndarray:
+        """
+        Run the model on the pixels of one window.
+
+        With a calibrationArtifact or qHat as confModel, predict_proba is called once and the sets, the argmax
+        class and its probability are all computed from the probabilities (see localConformalFunctions).
+
+        Args:
+            mode (str): one of 'sets', 'predict', 'predict_proba' or 'all'
+            data (pd.DataFrame): pixels (rows) by bands (columns)
+            shape (tuple): (rows, cols) of the window
+            model: a model with a predict and predict_proba method
+            confModel (calibrationArtifact, float or mapie classifier): The calibration (artifact or lac qHat) or a
+             calibrated conformal predictor based on the MAPIE package.
+            alpha (float or list): tolerance level(s). Sets have n_classes bands per alpha (in alpha order)
+
+        Returns:
+            np.ndarray (bands, rows, cols)
+        """
+        alphas = list(alpha) if isinstance(alpha, (list, tuple)) else [alpha]
+        toBands = lambda array: array.reshape(shape[0], shape[1], -1).transpose(2, 0, 1)
+        if mode in ['sets', 'all'] and isinstance(confModel, (calibrationArtifact, float, int)):
+            probs = model.predict_proba(data)
+            score, params, qHats = self._setThresholds(confModel, alphas)
+            sets = np.concatenate([predictionSets(probs, qHat, score, **params) for qHat in qHats], axis = 1)
+            if mode == 'sets':
+                return toBands(sets).astype(np.float64)
+            pred = model.classes_[np.argmax(probs, axis = 1)]
+            return np.concatenate([toBands(pred), toBands(probs.max(axis = 1)), toBands(sets)]).astype(np.float64)
+
+        if mode == 'sets':
+            _, y_ps_score = confModel.predict(data, alpha = alpha)
+            # (pixels, classes, alphas) to alpha major bands
+            result = toBands(y_ps_score.transpose(0, 2, 1))
+        elif mode == 'predict':
+            result = model.predict(data).reshape(1, shape[0], shape[1])
+        elif mode == 'predict_proba':
+            # probability of the argmax class
+            result = model.predict_proba(data).max(axis = 1).reshape(1, shape[0], shape[1])
+        elif mode == 'all':
+            y_pred_score, y_ps_score = confModel.predict(data, alpha = alpha)
+            #  predict
+            pred = y_pred_score.reshape(1, shape[0], shape[1])
+            # predict_proba
+            probs = model.predict_proba(data).max(axis = 1).reshape(1, shape[0], shape[1])
+            #  sets
+            sets = toBands(y_ps_score.transpose(0, 2, 1))
+            # Combine results along the first axis as bands
+            result = np.concatenate([pred, probs, sets])
+        return result.astype(np.float64)
+
+    def _validPixels(self, pixels: np.ndarray, nodata: float = None, masks: np.ndarray = None) -> np.ndarray:
+        """
+        Find the pixels that have data in every band. A pixel is invalid if any band is missing: NaN, equal to the
+        nodata value of the input or masked.
+
+        Args:
+            pixels (np.ndarray): pixels (rows) by bands (columns)
+            nodata (float): the nodata value of the input (None or NaN if only NaN is missing)
+            masks (np.ndarray): The band masks of the pixels (same shape as pixels, 0 = masked) e.g. from read_masks
+
+        Returns:
+            np.ndarray (bool) with one value per pixel
+        """
+        missing = np.isnan(pixels) if np.issubdtype(pixels.dtype, np.floating) else np.zeros(pixels.shape, bool)
+        if nodata is not None and not np.isnan(nodata):
+            missing |= pixels == nodata
+        if masks is not None:
+            missing |= masks == 0
+        return ~missing.any(axis = 1)
+
+    def _journalMeta(self, mode: str, nbands: int, alpha, infile, model, confModel) -> dict:
+        """
+        Parameters and identity of an inference run for the journal: a journal is only resumed for the same input
+        (file path, mtime and size, or the tile spec and image graph of a tileDownloader), the same (pickled) model
+        and the same calibration.
+        """
+        if isinstance(infile, tileDownloader):
+            source = {'transform': list(infile.transform)[:6], 'crs': str(infile.crs), 'width': infile.width,
+                      'height': infile.height, 'patchSize': infile.patchSize, 'bandNames': list(infile.bandNames),
+                      'image': graphKey(infile.image) if infile.image is not None else None}
+        else:
+            source = fileIdentity(infile)
+        if isinstance(confModel, calibrationArtifact):
+            content = {'version': confModel.version, 'score': confModel.score, 'dataHash': confModel.dataHash,
+                       'qHats': {str(key): value for key, value in confModel.qHats.items()}, 'params': confModel.params}
+            calibration = hashlib.sha256(json.dumps(content, sort_keys = True).encode()).hexdigest()
+        elif isinstance(confModel, (float, int)) or confModel is None:
+            calibration = confModel
+        else:
+            calibration = fingerprint(confModel)
+        return {'mode': mode, 'count': nbands, 'alpha': alpha, 'input': source, 'model': fingerprint(model),
+                'calibration': calibration}
+
+    def inference(self, mode : str, infile: Union[str, tileDownloader], model, confModel, outfile : str, patchSize : int,
+                  num_workers : int = 4, memmap: Union[bool, str] = False, alpha: Union[float, list] = 0.1,
+                  resume: bool = False, checkpoint: int = 64):
         """
         Run inference on infile (Geotiff) using trained model.
 
         Args:
             mode (str): one of 'sets', 'predict', 'predict_proba' or all. Defaults to 'all'
-            infile (str):
+            infile (str or tileDownloader): File path of a GeoTIFF or a tileDownloader. With a tileDownloader,
+             windows are processed as soon as their tile has been downloaded.
             model: a model with a predict and predict_proba method
-            confModel (mapie classifier): Calibrated conformal predictor based on the MAPIE package.
+            confModel (calibrationArtifact, float or mapie classifier): The calibration applied to the probabilities
+             of model (a calibrationArtifact or the qHat of the lac score) or a calibrated conformal predictor based
+             on the MAPIE package.
             outfile (str): File path and file name to save output geoTiff files
-            patchSize (int): The height and width dimensions of the patch to process
+            patchSize (int): The height and width dimensions of the patch to process. Should match the
+             tileDownloader patchSize.
             num_workers (int): The number of core to utilise during parralel processing
+            memmap (bool or str): If True (or a file path), infile is cached as a memory-mapped NPY file
+             (see rasterCache) and windows are read from the cache without a lock. Recommended for large,
+             uncompressed inputs.
+            alpha (float or list): The tolerance level(s) of the sets. With several alphas the sets have n_classes
+             bands per alpha (in alpha order)
+            resume (bool): If True, completed windows are recorded in a journal next to outfile (see
+             inferenceJournal). A rerun after a crash updates the existing output and only processes the missing
+             windows. The output is checked against the journal at the end of the run
+            checkpoint (int): The number of windows between checkpoints (output flushed, journal saved) if resume
+
+        Only pixels with data in every band (see _validPixels) are passed to the model, windows without data are
+        skipped. Pixels with a missing or masked band are NaN (nodata) in the output.
 
         Returns:
             multiband (n_classes +2) geotiff in 'all' mode.
@@ -126,105 +396,150 @@ class prepareModel:
             3) A single band geotiff for the probability of the argmax class ('predict_proba')
 
         """
-
-        with rasterio.open(infile) as src:
-            
-            logger = logging.getLogger(__name__)
-
+        logger = logging.getLogger(__name__)
+        nSets = model.n_classes_ * (len(alpha) if isinstance(alpha, (list, tuple)) else 1)
+        nbands = {'sets': nSets, 'predict': 1, 'predict_proba': 1, 'all': nSets + 2}[mode]
+
+        with contextlib.ExitStack() as stack:
+            if isinstance(infile, tileDownloader):
+                profile = infile.profile
+                bandnames = infile.bandNames
+                readMasks = False
+            else:
+                src = stack.enter_context(rasterio.open(infile))
+                profile = src.profile
+                bandnames = list(src.descriptions)
+                if memmap:
+                    cache = rasterCache(infile, memmap if isinstance(memmap, str) else None)
+                # internal (per dataset) or alpha masks are read with the windows, nodata masks are the nodata values
+                readMasks = any(MaskFlags.per_dataset in flags or MaskFlags.alpha in flags
+                                for flags in src.mask_flag_enums)
+
+            nodata = profile.get('nodata')
             # Create a destination dataset based on source params. The
             # destination will be tiled, and the tiles will be processed
             # concurrently.
-            profile = src.profile
-            profile.update(blockxsize= patchSize, blockysize= patchSize, tiled=True, count=1)
-
-            with rasterio.open(Path(outfile), "w", **profile) as dst:
-                windows = [window for ij, window in dst.block_windows()]
-
-                # use a lock to protect the DatasetReader/Writer
-                read_lock = threading.Lock()
-                write_lock = threading.Lock()
-
-                def process(window):
+            profile.update(blockxsize= patchSize, blockysize= patchSize, tiled=True, count=nbands,
+                           dtype='float64', nodata=np.nan)
+            journal = None
+            if resume:
+                journal = inferenceJournal.open(outfile, profile['width'], profile['height'], patchSize,
+                                                self._journalMeta(mode, nbands, alpha, infile, model, confModel))
+                bad = journal.verify(outfile) if journal.resumable else []
+                if bad:
+                    logger.info(f'{len(bad)} windows of {outfile} do not match the journal and are processed again')
+            # a resumed run updates the partially written output
+            if journal is not None and journal.resumable:
+                state = {'dst': rasterio.open(Path(outfile), 'r+'), 'written': 0}
+            else:
+                state = {'dst': rasterio.open(Path(outfile), 'w', **profile), 'written': 0}
+            stack.callback(lambda: state['dst'].close())
+            pending = lambda window: journal is None or not journal.isDone(window)
+
+            if isinstance(infile, tileDownloader):
+                tiles = [tile for tile in infile.tiles if pending(tile['window'])]
+                # windows arrive (with their data) as tiles finish downloading
+                windows = infile.download(tiles)
+                total = len(tiles)
+            else:
+                windows = [(window, None) for ij, window in state['dst'].block_windows() if pending(window)]
+                total = len(windows)
+
+            # use a lock to protect the DatasetReader/Writer
+            read_lock = threading.Lock()
+            write_lock = threading.Lock()
+
+            def checkpointJournal():
+                """close (flush) the output before the journal records the windows written to it"""
+                state['dst'].close()
+                state['dst'] = rasterio.open(Path(outfile), 'r+')
+                journal.save()
+
+            def process(window, src_array):
+                if src_array is None and memmap:
+                    rows, cols = window.toslices()
+                    src_array = np.moveaxis(cache[rows, cols, :], -1, 0)
+                elif src_array is None:
                     with read_lock:
                         src_array = src.read(window=window)
-                        i_arr = reshape_as_image(src_array)
-
-                        #Format input_image for inference
-                        nPixels = i_arr.shape[0]*i_arr.shape[1]
-                        nBands = i_arr.shape[-1]
-                        # Take full image and reshape into long 2d array (nrow * ncol, nband) for classification
-                        new_arr = i_arr.reshape(nPixels, nBands)#reshape 3d array to 2d array that matches the training data table from earlier
-                        bandnames = list(src.descriptions)
-                        data = pd.DataFrame(new_arr, columns = bandnames).fillna(0)
-                        if mode == 'sets':
-                            _, y_ps_score = confModel.predict(data, alpha = 0.1)
-                            result = y_ps_score.reshape([i_arr.shape[0],i_arr.shape[1], model.n_classes_]).astype(np.float64)
-                            nbands = model.n_classes_
-                        elif mode == 'predict':
-                            result = model.predict(data)
-                            # # Reshape our classification map back into a 2D matrix so we can save it as an image
-                            result = result.reshape(i_arr[:, :, 0].shape).astype(np.float64)
-                            nbands = 1
-                        elif mode == 'predict_proba':
-                            result = model.predict_proba(data)
-                            result = result[~np.isnan(result)]
-                            # # Reshape our classification map back into a 2D matrix so we can save it as an image
-                            result = result.reshape(i_arr[:, :, 0].shape).astype(np.float64)
-                            nbands = 1
-                        elif mode == 'all':
-                            y_pred_score, y_ps_score = confModel.predict(data, alpha = 0.1)
-                            #  predict
-                            pred = y_pred_score.reshape(i_arr[:, :, 1].shape).astype(np.float64)
-                            print('preds', pred.shape)
-                            #  sets
-                            sets = y_ps_score.reshape([i_arr.shape[0],i_arr.shape[1], model.n_classes_]).astype(np.float64)
-                            print('sets',sets.shape) 
-                            # predict_proba
-                            result = model.predict_proba(data)
-                            result = result[~np.isnan(result)]
-                            probs = result.reshape(i_arr[:, :, 1].shape).astype(np.float64)
-                            print('probs',probs.shape)
-                            # Combine results along the third axis as bands
-                            result = np.dstack([pred[:,:, np.newaxis], probs[:,:, np.newaxis], sets])
-                            nbands = model.n_classes_+2
-
-                    with write_lock:
-                        dst.write(result, nbands, window=window)
-
-                # We map the process() function over the list of windows.
-                with tqdm(total=len(windows), desc = os.path.basename(outfile)) as pbar:
+
+                # Take full image and reshape into long 2d array (nrow * ncol, nband) for classification
+                shape = src_array.shape[1:]
+                new_arr = src_array.reshape(src_array.shape[0], -1).T
+                masks = None
+                if readMasks:
+                    with read_lock:
+                        masks = src.read_masks(window=window).reshape(src_array.shape[0], -1).T
+                valid = self._validPixels(new_arr, nodata, masks)
+                result = np.full((nbands,) + shape, np.nan)
+                # only the pixels with data are classified (as one dense batch) and scattered back into the window
+                if valid.any():
+                    data = pd.DataFrame(new_arr[valid], columns = bandnames)
+                    predictions = self._predictWindow(mode, data, (int(valid.sum()), 1), model, confModel, alpha)
+                    result.reshape(nbands, -1)[:, valid] = predictions.reshape(nbands, -1)
+
+                with write_lock:
+                    state['dst'].write(result, window=window)
+                    if journal is not None:
+                        journal.mark(window, result)
+                        state['written'] += 1
+                        if state['written'] % checkpoint == 0:
+                            checkpointJournal()
+
+            # We map the process() function over the windows.
+            try:
+                with tqdm(total=total, desc = os.path.basename(outfile)) as pbar:
                     with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-                        futures = {executor.submit(process, window): window for window in windows}
+                        futures = []
                         try:
+                            for window, src_array in windows:
+                                future = executor.submit(process, window, src_array)
+                                future.add_done_callback(lambda f: pbar.update(1))
+                                futures.append(future)
                             for future in concurrent.futures.as_completed(futures):
                                 future.result()
-                                pbar.update(1)
 
                         except Exception as ex:
                             logger.info('Cancelling...')
                             executor.shutdown(wait=False, cancel_futures=True)
                             raise ex
+            finally:
+                # the executor has finished the running windows, record them for a rerun
+                if journal is not None:
+                    checkpointJournal()
 
-    def _kFoldCV(self, fold: int, uq: bool = False):
-        """function to run k-fold cross validation
+            if journal is not None:
+                bad = journal.verify(outfile)
+                if bad:
+                    journal.save()
+                    raise RuntimeError(f'{len(bad)} windows of {outfile} do not match the journal. '
+                                       'Run again with resume=True to process them')
 
-        Args: 
+    def _foldSplit(self, fold: int, uq: bool = False) -> Union[ee.FeatureCollection, ee.FeatureCollection]:
+        """function to select the training and validation data for a fold
+
+        Args:
             fold (int): fold number
-        
-        Returns:
-            ee.Image: classified image with accuracy and confusion matrix as properties"""
-        
-        #number of classes:
-        classorder = self.dataset.aggregate_histogram(self.responseCol).keys().map(lambda number: ee.Number.parse(number))
+            uq (bool): if True, the calibration data is held out (see _UQ)
 
+        Returns:
+            training and validation dataset (ee.FeatureCollections)"""
         if uq:
             training, validation, _ = self._UQ(fold = fold)
         else:
             #choose a fold
             training = self.dataset.filter(ee.Filter.neq("cluster", fold))
             validation = self.dataset.filter(ee.Filter.eq("cluster", fold))
+        return training, validation
 
-        #train and apply classifier
+    def _trainClassifier(self, training: ee.FeatureCollection) -> ee.Classifier:
+        """function to train the earth engine random forest classifier
+
+        Args:
+            training (ee.FeatureCollection): training data
+
+        Returns:
+            ee.Classifier: trained random forest classifier"""
         classifier = ee.Classifier.smileRandomForest(**{
             'numberOfTrees':50,
             'maxNodes':None,
@@ -236,9 +551,29 @@ class prepareModel:
             'classProperty':self.responseCol,
             'inputProperties': self.bandNames
         })
+        return classifier
 
-        #make prediction for entire study area
-        classified = self.inferenceImage.classify(classifier)
+    def _classOrder(self) -> ee.List:
+        """function to get the (numeric) class values present in the dataset. With a cache, the class order is
+        fetched once and embedded in the graph as a constant list"""
+        classorder = self.dataset.aggregate_histogram(self.responseCol).keys().map(lambda number: ee.Number.parse(number))
+        if self.cache is not None:
+            return ee.List(self._fetch(classorder))
+        return classorder
+
+    def _foldAssessment(self, fold: int, classorder: ee.List, uq: bool = False):
+        """function to train a classifier on a fold and assess it on the held out (validation) data
+
+        Args:
+            fold (int): fold number
+            classorder (ee.List): class values used to order the error matrix
+            uq (bool): if True, the calibration data is held out (see _UQ)
+
+        Returns:
+            trained ee.Classifier and an ee.Dictionary with the accuracy (acc), error matrix (raw) and
+            number of validation samples (num)"""
+        training, validation = self._foldSplit(fold, uq = uq)
+        classifier = self._trainClassifier(training)
 
         #accuracy assessment
         assessment = validation.classify(classifier).errorMatrix(**{
@@ -247,17 +582,69 @@ class prepareModel:
             'order':classorder
         })
 
-        accuracy = assessment.accuracy()
-        raw = assessment.array()
-        num = validation.size()
+        metrics = ee.Dictionary({'acc': assessment.accuracy(),
+                                 'raw': assessment.array(),
+                                 'num': validation.size()})
+        return classifier, metrics
+
+    def _kFoldCV(self, fold: int, uq: bool = False):
+        """function to run k-fold cross validation
+
+        Args: 
+            fold (int): fold number
+        
+        Returns:
+            ee.Image: classified image with accuracy and confusion matrix as properties"""
+        
+        #number of classes:
+        classorder = self._classOrder()
+
+        classifier, metrics = self._foldAssessment(fold, classorder, uq = uq)
+
+        #make prediction for entire study area
+        classified = self.inferenceImage.classify(classifier)
 
         #set accuracy result as a property of classification raster
-        classified = classified.set({'acc':accuracy})
-        classified = classified.set({'raw':raw})
-        classified = classified.set({'num':num})
+        classified = classified.set(metrics)
 
         return classified
     
     def kFoldCV(self, nFolds: int, uq: bool = False) -> ee.ImageCollection:
         result = ee.ImageCollection(ee.List.sequence(0,nFolds-1).map(lambda fold: self._kFoldCV(fold, uq = uq)))
         return result
+
+    def kFoldMetrics(self, nFolds: int, uq: bool = False) -> ee.FeatureCollection:
+        """function to run k-fold cross validation without classifying the inference image.
+        Use ensembleInference to classify the inference image once.
+
+        Args:
+            nFolds (int): number of folds
+            uq (bool): if True, the calibration data is held out (see _UQ)
+
+        Returns:
+            ee.FeatureCollection: one (null geometry) feature per fold with the accuracy (acc), error matrix (raw)
+            and number of validation samples (num) as properties"""
+        # the class order is shared by all folds
+        classorder = self._classOrder()
+
+        def foldFeature(fold):
+            _, metrics = self._foldAssessment(fold, classorder, uq = uq)
+            return ee.Feature(None, metrics).set('fold', fold)
+
+        return ee.FeatureCollection(ee.List.sequence(0, nFolds-1).map(foldFeature))
+
+    def ensembleInference(self, uq: bool = False) -> ee.Image:
+        """function to train a classifier once on all the (non-calibration) data and classify the inference image
+
+        Args:
+            uq (bool): if True, the calibration data is held out (see _UQ)
+
+        Returns:
+            ee.Image: classified image"""
+        if uq:
+            training, validation, _ = self._UQ(fold = 1)
+            training = training.merge(validation)
+        else:
+            training = self.dataset
+        classifier = self._trainClassifier(training)
+        return self.inferenceImage.classify(classifier)
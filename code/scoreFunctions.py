@@ -0,0 +1,214 @@
+import ee
+from typing import Callable
+
+# Nonconformity score functions for conformal classifiers
+# lac: the probability of the reference class (higher is more conforming). Sets contain the classes with a
+#   probability >= qHat.
+# aps: adaptive prediction sets. The score of a class is the sum of the probabilities of all classes ranked
+#   above it plus its own probability. Sets contain the classes with a score <= qHat.
+# raps: regularised aps. Adds lam * max(0, rank - kReg) to the aps score to penalise large sets.
+SCORES = ('lac', 'aps', 'raps')
+
+def checkScore(score: str):
+    """Raise a ValueError for unsupported score functions"""
+    if score not in SCORES:
+        raise ValueError(f'score should be one of {SCORES}, not {score}')
+
+def classScoresImage(probs: ee.Image, nClasses: int, score: str = 'lac', lam: float = 0.01, kReg: int = 1) -> ee.Image:
+    """
+    Compute the score of every candidate class per pixel. Class probabilities are sorted per pixel (arraySort)
+    and accumulated (arrayAccum), then returned to the original class order.
+
+    Args:
+        probs (ee.Image): A 1-D array image with the probability of each class
+        nClasses (int): The number of classes
+        score (str): One of 'lac', 'aps' or 'raps'
+        lam (float): raps penalty per class beyond kReg
+        kReg (int): raps number of classes that are not penalised
+
+    Returns:
+        ee.Image: A 1-D array image with the score of each class
+    """
+    checkScore(score)
+    if score == 'lac':
+        return probs
+    # class indices (used to undo the sort)
+    order = ee.Image(ee.Array(list(range(nClasses))))
+    # sort descending by probability
+    keys = probs.multiply(-1)
+    sortedIndex = order.arraySort(keys)
+    cumulative = probs.arraySort(keys).arrayAccum(0, ee.Reducer.sum())
+    # back to class order
+    scores = cumulative.arraySort(sortedIndex)
+    if score == 'raps':
+        rank = order.arraySort(sortedIndex).add(1)
+        scores = scores.add(rank.subtract(kReg).max(0).multiply(lam))
+    return scores
+
+def classScoresArray(probs: ee.Array, nClasses: int, score: str = 'lac', lam: float = 0.01, kReg: int = 1) -> ee.Array:
+    """
+    Feature equivalent of classScoresImage.
+
+    Args:
+        probs (ee.Array): A 1-D array with the probability of each class
+
+    Returns:
+        ee.Array: A 1-D array with the score of each class
+    """
+    checkScore(score)
+    if score == 'lac':
+        return probs
+    order = ee.Array(list(range(nClasses)))
+    keys = probs.multiply(-1)
+    sortedIndex = order.sort(keys)
+    cumulative = probs.sort(keys).accum(0, ee.Reducer.sum())
+    scores = cumulative.sort(sortedIndex)
+    if score == 'raps':
+        rank = order.sort(sortedIndex).add(1)
+        scores = scores.add(rank.subtract(kReg).max(0).multiply(lam))
+    return scores
+
+def setsImage(image: ee.Image, bands: list, qHat, score: str = 'lac', lam: float = 0.01, kReg: int = 1) -> ee.Image:
+    """
+    Compute prediction sets for a probability image. A binary band is returned for each candidate class
+    (1 = included in set) with an additional band 'setLength'.
+
+    Args:
+        image (ee.Image): An image with one probability band per class
+        bands (list): The probability band names (in class order)
+        qHat (ee.Number or ee.Image): The calibrated threshold. An image with one band per class applies a
+         per-class threshold
+        score (str): One of 'lac', 'aps' or 'raps'
+
+    Returns:
+        ee.Image: int8 image with one band per class and a 'setLength' band
+    """
+    probs = ee.Image(image).select(bands)
+    if score == 'lac':
+        # Compare the probability bands directly
+        setMasks = probs.gte(ee.Image(qHat))
+    else:
+        scores = classScoresImage(probs.toArray(), len(bands), score, lam, kReg)
+        setMasks = scores.arrayFlatten([bands]).lte(ee.Image(qHat))
+    setLength = setMasks.reduce(ee.Reducer.sum()).rename('setLength')
+    return setMasks.rename(bands).addBands(setLength).toInt8().updateMask(1)
+
+def exactQuantile(scores: ee.List, alpha: float, lower: bool = False, bound = None, maxSort: int = 1000000) -> ee.Number:
+    """
+    Compute qHat as the exact ceil((n+1)(1-alpha))-th smallest calibration score (the ceil((n+1)(1-alpha))-th
+    largest if lower=True) by sorting the scores as an array and reading index k, instead of an interpolated
+    percentile. For n > maxSort the sort is replaced by a percentile reducer (fast path). The fast path is
+    approximate: the percentile is rounded to the conservative side of the rank (at or above the order statistic,
+    at or below it if lower=True), but beyond maxSort values the reducer works on a histogram.
+
+    Args:
+        scores (ee.List): calibration scores e.g. collection.aggregate_array('score')
+        alpha (float): The tolerance level between 0-1
+        lower (bool): True for scores where higher values are more conforming (lac)
+        bound (ee.Number): qHat returned when there are too few calibration samples for alpha i.e. a threshold that
+         includes every class/value. Defaults to 0 for lower scores, 1e30 otherwise
+        maxSort (int): The largest number of scores that are sorted
+
+    Returns:
+        ee.Number qHat
+    """
+    scores = ee.List(scores)
+    n = scores.size()
+    k = n.add(1).multiply(1 - alpha).ceil()
+    if bound is None:
+        bound = 0 if lower else 1e30
+    # index of the order statistic in ascending order (an integer array coordinate)
+    index = (n.subtract(k) if lower else k.subtract(1)).toInt()
+    exact = lambda: ee.Array(scores).sort().get([index])
+    # percentile p interpolates at position p(n-1)/100: (index+1)/n is at or after index, index/n at or before it
+    percentile = (index if lower else index.add(1)).divide(n.max(1)).multiply(100)
+    fast = lambda: scores.reduce(ee.Reducer.percentile([percentile], None, None, None, maxSort))
+    qHat = ee.Algorithms.If(k.gt(n), bound, ee.Algorithms.If(n.gt(maxSort), fast(), exact()))
+    return ee.Number(qHat)
+
+def scoreHistogram(images: ee.ImageCollection, scoreImage: Callable, minScore, maxScore, scale: float,
+                   nBins: int = 10000, groups: int = None) -> ee.Array:
+    """
+    Count the 'score' band pixels of all images in nBins bins of width (maxScore - minScore) / nBins with a
+    fixedHistogram reducer, one reduceRegion per image (pixels of overlapping images are all counted). The counts
+    are summed server side, the pixels are never sampled. Scores are clamped to [minScore, maxScore]. With groups,
+    the histogram is grouped by the (integer) 'class' band in the same reduction and counted per class.
+
+    Args:
+        images (ee.ImageCollection): The images, each is reduced over its geometry
+        scoreImage (Callable): Function (image) -> ee.Image with a 'score' band
+        minScore (ee.Number): The smallest score
+        maxScore (ee.Number): The largest score
+        scale (float): The scale of the reduction
+        nBins (int): The number of bins between minScore and maxScore
+        groups (int): The number of classes (class values 0 to groups - 1, other values are not counted). If None,
+         the histogram is not grouped
+
+    Returns:
+        ee.Array counts (nBins + 1), (groups, nBins + 1) with groups: bin i holds the scores in
+         [minScore + i * width, minScore + (i + 1) * width)
+    """
+    width = ee.Number(maxScore).subtract(minScore).max(1e-12).divide(nBins)
+    # one extra bin so that maxScore is counted (fixedHistogram ignores values >= max)
+    reducer = ee.Reducer.fixedHistogram(minScore, ee.Number(maxScore).add(width), nBins + 1)
+    zeros = ee.Array(ee.List.repeat(0, nBins + 1))
+    if groups is not None:
+        reducer = reducer.group(groupField = 1, groupName = 'class')
+        zeros = ee.Array(ee.List.repeat(ee.List.repeat(0, nBins + 1), groups))
+    def addGroup(group, total):
+        # add the counts of a class to its row: one hot class column (groups, 1) x counts row (1, nBins + 1)
+        group = ee.Dictionary(group)
+        oneHot = ee.Array.cat([ee.Array(ee.List.sequence(0, groups - 1)).eq(ee.Number(group.get('class')))], 1)
+        counts = ee.Array(group.get('histogram')).slice(1, 1, 2).transpose()
+        return ee.Array(total).add(oneHot.matrixMultiply(counts))
+    def countPixels(image):
+        image = ee.Image(image)
+        scores = ee.Image(scoreImage(image))
+        bands = scores.select('score').clamp(minScore, maxScore)
+        if groups is not None:
+            bands = bands.addBands(scores.select('class'))
+        stats = bands.reduceRegion(**{
+            'reducer': reducer,
+            'geometry': image.geometry(),
+            'scale': scale,
+            'tileScale': 16,
+            'maxPixels': 1e13})
+        if groups is not None:
+            return ee.Feature(None, {'counts': ee.List(stats.get('groups')).iterate(addGroup, zeros)})
+        # rows of [bin minimum, count]
+        histogram = stats.get('score')
+        counts = ee.Algorithms.If(histogram, ee.Array(histogram).slice(1, 1, 2).project([0]), zeros)
+        return ee.Feature(None, {'counts': counts})
+    histograms = ee.ImageCollection(images).map(countPixels).aggregate_array('counts')
+    return ee.Array(histograms.iterate(lambda counts, total: ee.Array(total).add(counts), zeros))
+
+def histogramQuantile(counts: ee.Array, minScore, maxScore, alpha: float, lower: bool = False,
+                      bound = None) -> ee.Number:
+    """
+    Conservative qHat from binned calibration scores (see scoreHistogram): the edge of the bin that holds the
+    ceil((n+1)(1-alpha))-th smallest score (the ceil((n+1)(1-alpha))-th largest if lower=True), on the side that gives
+    the larger sets or intervals. The error is at most one bin width.
+
+    Args:
+        counts (ee.Array): The output of scoreHistogram (nBins + 1)
+        minScore (ee.Number): The minScore of scoreHistogram
+        maxScore (ee.Number): The maxScore of scoreHistogram
+        alpha (float): The tolerance level between 0-1
+        lower (bool): True for scores where higher values are more conforming (lac)
+        bound (ee.Number): qHat returned when there are too few calibration samples for alpha (see exactQuantile)
+
+    Returns:
+        ee.Number qHat
+    """
+    counts = ee.Array(counts)
+    width = ee.Number(maxScore).subtract(minScore).max(1e-12).divide(counts.length().get([0]).subtract(1))
+    n = counts.reduce(ee.Reducer.sum(), [0]).get([0])
+    k = n.add(1).multiply(1 - alpha).ceil()
+    if bound is None:
+        bound = 0 if lower else 1e30
+    # bin of the order statistic: the number of bins before the rank is reached
+    rank = n.subtract(k).add(1) if lower else k
+    index = counts.accum(0).lt(rank).reduce(ee.Reducer.sum(), [0]).get([0])
+    # lower edge of the bin for lower scores, upper edge otherwise
+    edge = ee.Number(minScore).add(index.add(0 if lower else 1).multiply(width))
+    return ee.Number(ee.Algorithms.If(k.gt(n), bound, edge))
@@ -0,0 +1,141 @@
+import ee
+from typing import Callable
+
+# Increment between repeated splits (fractional part of the golden ratio) so that successive rotations of the
+# split key are spread evenly over [0, 1)
+GOLDEN = 0.6180339887498949
+
+def groupKey(groupId, seed: int = 42) -> ee.Number:
+    """
+    Deterministic pseudo-random number in [0, 1) for a (numeric) group id. All features/images of a group get the
+    same key, so groups are never divided between the calibration and test set.
+
+    Args:
+        groupId (ee.Number): e.g. the 'cluster' property from prepareTrainingData or a spatial block id
+        seed (int): Changes the keys of all groups
+
+    Returns:
+        ee.Number
+    """
+    x = ee.Number(groupId).multiply(12.9898).add(ee.Number(seed).multiply(78.233)).sin().multiply(43758.5453)
+    return x.subtract(x.floor())
+
+class calibrationSplitter:
+    """
+    Assigns a split key (uniform on [0, 1)) to every feature/image once. Calibration and test sets, including
+    repeated splits, are then range filters on the cached key column, so the data is not rescanned and the
+    dataset graph does not grow with every calibrate/evaluate call.
+
+    Splits can be random per feature/image, per group (e.g. the 'cluster' property added by prepareTrainingData) or
+    per spatial block. Group and block splits keep spatially autocorrelated samples on the same side of the split,
+    which avoids inflated coverage estimates.
+
+    # Example Usuage
+    splitter = calibrationSplitter(data, by = 'cluster')
+    calibration, test = splitter.split(0.5)
+    # Repeated splits (variance estimates)
+    splits = [splitter.split(0.5, repeat = r) for r in range(20)]
+    """
+    def __init__(self, data, seed: int = 42, by: str = None, blockSize: float = None, crs: str = 'EPSG:4326',
+                 column: str = 'splitKey'):
+        """
+        Args:
+            data (ee.FeatureCollection or ee.ImageCollection): The data to split
+            seed (int): The seed of the split key
+            by (str): A (numeric) property that defines groups e.g. 'cluster'. Groups are split as a whole
+            blockSize (float): Size of square spatial blocks in the units of crs. Features/images are grouped by the
+             block that contains their centroid. Ignored if by is provided
+            crs (str): The crs of the spatial blocks
+            column (str): Name of the split key property
+        """
+        self.source = data
+        self.seed = seed
+        self.by = by
+        self.blockSize = blockSize
+        self.crs = crs
+        self.column = column
+        if by is not None:
+            self.data = data.map(lambda element: element.set(column, groupKey(element.get(by), seed)))
+        elif blockSize is not None:
+            self.data = data.map(lambda element: element.set(column, groupKey(self._blockId(element), seed)))
+        else:
+            # randomColumn is typed as a FeatureCollection, keep the Python type of the input collection
+            self.data = type(data)(data.randomColumn(column, seed))
+
+    def _blockId(self, element) -> ee.Number:
+        """Numeric id of the spatial block that contains the centroid of a feature/image"""
+        coords = element.geometry().centroid(1, self.crs).coordinates()
+        col = coords.getNumber(0).divide(self.blockSize).floor()
+        row = coords.getNumber(1).divide(self.blockSize).floor()
+        return row.multiply(1000003).add(col)
+
+    def withSeed(self, seed: int):
+        """Return a splitter with the same grouping and a different seed (self if the seed is unchanged)"""
+        if seed == self.seed:
+            return self
+        return calibrationSplitter(self.source, seed, self.by, self.blockSize, self.crs, self.column)
+
+    def _rangeFilter(self, start: float, end: float) -> ee.Filter:
+        """Filter for start <= key < end on the circle [0, 1)"""
+        start, end = start % 1, end % 1
+        if start < end:
+            return ee.Filter.And(ee.Filter.gte(self.column, start), ee.Filter.lt(self.column, end))
+        return ee.Filter.Or(ee.Filter.gte(self.column, start), ee.Filter.lt(self.column, end))
+
+    def split(self, fraction: float, repeat: int = 0) -> tuple:
+        """
+        Split the data into a calibration and test set.
+
+        Args:
+            fraction (float): The proportion of the data (or groups) used for calibration
+            repeat (int): Index of a repeated split. Split r rotates the split key by r * 0.618 (mod 1), so each
+             repeat is a different calibration/test partition of the same keyed data
+
+        Returns:
+            calibration, test (ee.FeatureCollection or ee.ImageCollection)
+        """
+        if fraction <= 0 or fraction >= 1:
+            raise ValueError('fraction should be between 0 and 1')
+        start = (-repeat * GOLDEN) % 1
+        calibration = self.data.filter(self._rangeFilter(start, start + fraction))
+        test = self.data.filter(self._rangeFilter(start + fraction, start + 1))
+        return calibration, test
+
+def evaluateRepeatedSplits(keys: ee.Array, scores: ee.Array, fraction: float, alpha: float, repeats: int,
+                           size: Callable, lower: bool = False) -> ee.Dictionary:
+    """
+    Evaluate repeated calibration/test splits (see calibrationSplitter.split) of precomputed scores with array
+    operations. Split r is the mask (key + r * 0.618) mod 1 < fraction, qHat is the exact
+    ceil((nCal+1)(1-alpha))-th smallest calibration score.
+
+    Args:
+        keys (ee.Array): The split key of every sample (n)
+        scores (ee.Array): The nonconformity score of every sample (n)
+        fraction (float): The proportion of the data used for calibration
+        alpha (float): The tolerance level between 0-1
+        repeats (int): The number of splits
+        size (Callable): Function (qHat, testMask) -> ee.Number with the average set size/interval width of the
+         test samples
+        lower (bool): True for scores where higher values are more conforming (lac)
+
+    Returns:
+        ee.Dictionary with lists 'qHat', 'coverage' and 'size' (one value per split)
+    """
+    sign = -1 if lower else 1
+    signed = ee.Array(scores).multiply(sign)
+    # larger than any score, used when there are too few calibration samples for alpha
+    qMax = signed.reduce(ee.Reducer.max(), [0]).get([0]).add(1)
+    def evaluateSplit(repeat):
+        calMask = ee.Array(keys).add(ee.Number(repeat).multiply(GOLDEN)).mod(1).lt(fraction)
+        testMask = calMask.Not()
+        calScores = signed.mask(calMask).sort()
+        nCal = calScores.length().get([0])
+        k = nCal.add(1).multiply(1 - alpha).ceil()
+        qHat = ee.Number(ee.Algorithms.If(k.gt(nCal), qMax, calScores.get([k.subtract(1).max(0).toInt()])))
+        nTest = testMask.reduce(ee.Reducer.sum(), [0]).get([0]).max(1)
+        covered = signed.lte(qHat).And(testMask).reduce(ee.Reducer.sum(), [0]).get([0])
+        qHat = qHat.multiply(sign)
+        return ee.List([qHat, covered.divide(nTest), size(qHat, testMask)])
+    results = ee.Array(ee.List.sequence(0, repeats - 1).map(evaluateSplit))
+    column = lambda index: results.slice(1, index, index + 1).project([0]).toList()
+    return ee.Dictionary({'qHat': column(0), 'coverage': column(1), 'size': column(2)})
@@ -0,0 +1,80 @@
+import time
+import asyncio
+import threading
+import pytest
+from code.asyncFunctions import eeExecutor, evaluateAsync
+
+class fakeBackend:
+    """Local stand-in for getInfo with latency. Objects listed in failures raise that error n times"""
+    def __init__(self, latency: float = 0.01, failures: dict = None, error: str = '429 Too Many Requests'):
+        self.latency = latency
+        self.failures = dict(failures or {})
+        self.error = error
+        self.lock = threading.Lock()
+        self.inFlight = 0
+        self.maxInFlight = 0
+        self.calls = []
+
+    def __call__(self, obj):
+        with self.lock:
+            self.inFlight += 1
+            self.maxInFlight = max(self.maxInFlight, self.inFlight)
+            self.calls.append(obj)
+        try:
+            time.sleep(self.latency)
+            with self.lock:
+                if self.failures.get(obj, 0) > 0:
+                    self.failures[obj] -= 1
+                    raise Exception(self.error)
+            return obj * 2
+        finally:
+            with self.lock:
+                self.inFlight -= 1
+
+async def noSleep(seconds):
+    pass
+
+# Tests that results keep their order and the in-flight limit is respected
+def test_eeExecutor_limit():
+    backend = fakeBackend()
+    executor = eeExecutor(maxInFlight = 3, backend = backend, sleep = noSleep)
+    assert executor.run(list(range(20))) == [i * 2 for i in range(20)]
+    assert executor.run({'a': 1, 'b': 2}) == {'a': 2, 'b': 4}
+    assert 1 < backend.maxInFlight <= 3
+
+# Tests that rate limit errors are retried and other errors are raised
+def test_eeExecutor_retries():
+    backend = fakeBackend(failures = {1: 2})
+    executor = eeExecutor(backend = backend, sleep = noSleep)
+    assert executor.run([0, 1]) == [0, 2]
+    assert backend.calls.count(1) == 3 and executor.stats['retries'] == 2
+    executor = eeExecutor(backend = fakeBackend(failures = {1: 1}, error = 'Image.select: band not found'),
+                          sleep = noSleep)
+    with pytest.raises(Exception, match = 'band not found'):
+        executor.run([1])
+    executor = eeExecutor(maxRetries = 2, backend = fakeBackend(failures = {1: 5}), sleep = noSleep)
+    with pytest.raises(Exception, match = '429'):
+        executor.run([1])
+
+# Tests the awaitable evaluate computes the evaluation without printing
+def test_evaluateAsync():
+    class fakeConformal:
+        def evaluate(self, verbose = True):
+            assert verbose is False
+            return 21
+    executor = eeExecutor(backend = fakeBackend(), sleep = noSleep)
+    assert asyncio.run(evaluateAsync(fakeConformal(), executor)) == 42
+
+# Tests separate compute calls share the executor limit and the pool is shut down on exit
+def test_eeExecutor_sharedLimit():
+    backend = fakeBackend(latency = 0.02)
+    async def main():
+        async with eeExecutor(maxInFlight = 2, backend = backend, sleep = noSleep) as executor:
+            limit = executor._limit()
+            results = await asyncio.gather(*[executor.compute(i) for i in range(10)])
+            assert executor._limit() is limit
+        return executor, results
+    executor, results = asyncio.run(main())
+    assert results == [i * 2 for i in range(10)] and backend.maxInFlight == 2
+    with pytest.raises(RuntimeError):
+        executor.pool.submit(print)
@@ -0,0 +1,75 @@
+import time
+import pandas as pd
+from code.cacheFunctions import resultCache, graphKey
+from code.modelFitFunctions import prepareModel
+from code.asyncFunctions import eeExecutor
+
+class fakeObject:
+    """Local stand-in for an Earth Engine object: serialize() is the graph, getInfo() counts requests"""
+    calls = 0
+    def __init__(self, graph, value = None):
+        self.graph = graph
+        self.value = value if value is not None else graph
+
+    def serialize(self):
+        return f'{{"graph": "{self.graph}"}}'
+
+    def getInfo(self):
+        fakeObject.calls += 1
+        return self.value
+
+# Tests identical graphs share a key and namespaces separate fetches of the same graph
+def test_graphKey():
+    assert graphKey(fakeObject('a')) == graphKey(fakeObject('a'))
+    assert graphKey(fakeObject('a')) != graphKey(fakeObject('b'))
+    assert graphKey(fakeObject('a'), 'getInfo') != graphKey(fakeObject('a'), 'ee_to_df')
+
+# Tests repeated fetches are served from disk (also by a new cache on the same file) and counted in stats
+def test_resultCache_fetch(tmp_path):
+    fakeObject.calls = 0
+    cache = resultCache(str(tmp_path/'cache.sqlite'))
+    assert cache.fetch(fakeObject('a', {'x': [1, 2]})) == {'x': [1, 2]}
+    assert cache.fetch(fakeObject('a', 'other')) == {'x': [1, 2]}
+    assert fakeObject.calls == 1
+    assert cache.stats()['hitRate'] == 0.5 and cache.stats()['entries'] == 1
+    cache.close()
+    cache = resultCache(str(tmp_path/'cache.sqlite'))
+    assert cache.fetch(fakeObject('a')) == {'x': [1, 2]} and fakeObject.calls == 1
+
+# Tests expired entries are recomputed and least recently used entries are evicted above maxBytes
+def test_resultCache_eviction(tmp_path):
+    cache = resultCache(str(tmp_path/'cache.sqlite'), ttl = 0.05)
+    cache.set('a', 1)
+    time.sleep(0.1)
+    assert cache.get('a') == (False, None)
+    cache = resultCache(str(tmp_path/'lru.sqlite'), maxBytes = 2500)
+    for key in 'abc':
+        cache.set(key, b'x' * 1000)
+        time.sleep(0.01)
+    assert cache.get('a')[0] is False and cache.get('c')[0] is True
+    cache.get('b')
+    cache.set('d', b'x' * 1000)
+    assert cache.get('b')[0] is True and cache.get('c')[0] is False
+    assert cache.stats()['bytes'] <= 2500
+
+# Tests prepareModel fetches tables and band names through the cache
+def test_prepareModel_cache(tmp_path):
+    fakeObject.calls = 0
+    cache = resultCache(str(tmp_path/'cache.sqlite'))
+    pm = prepareModel(None, 'label', None, fakeObject('bands', ['b1', 'b2']), cache = cache)
+    downloads = []
+    table = lambda obj: downloads.append(obj) or pd.DataFrame({'b1': [1], 'b2': [2]})
+    for _ in range(3):
+        assert pm._fetch(fakeObject('table'), table, 'ee_to_df').shape == (1, 2)
+        assert pm._bandList() == ['b1', 'b2']
+    assert len(downloads) == 1 and fakeObject.calls == 1
+    assert prepareModel(None, 'label', None, ['b1'])._bandList() == ['b1']
+
+# Tests the executor serves cached results without requests and counts the hits
+def test_eeExecutor_cache(tmp_path):
+    fakeObject.calls = 0
+    executor = eeExecutor(cache = resultCache(str(tmp_path/'cache.sqlite')))
+    objs = [fakeObject(i) for i in range(5)]
+    assert executor.run(objs) == list(range(5))
+    assert executor.run(objs) == list(range(5))
+    assert fakeObject.calls == 5 and executor.stats['cacheHits'] == 5 and executor.stats['requests'] == 5
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from code.calibrationFunctions import calibrationArtifact, calibrationRegistry, sketchQuantile
+from code.localConformalFunctions import conformalQuantile
+
+scores = np.random.default_rng(0).random(500)
+edges = np.linspace(0, 1, 1001)
+
+# Tests that artifacts round trip through npz and json
+@pytest.mark.parametrize('suffix', ['npz', 'json'])
+def test_saveLoad(tmp_path, suffix):
+    artifact = calibrationArtifact.fromScores(scores, 'aps', 'v1', alphas = [0.1, 0.05], params = {'lam': 0.01},
+                                              edges = edges)
+    path = str(tmp_path/f'artifact.{suffix}')
+    artifact.save(path)
+    loaded = calibrationArtifact.load(path)
+    assert loaded.qHats == artifact.qHats and loaded.qHat(0.1) == conformalQuantile(scores, 0.1)
+    assert loaded.nCal == 500 and loaded.dataHash == artifact.dataHash and loaded.params == {'lam': 0.01}
+    assert np.array_equal(loaded.edges, edges) and loaded.counts.sum() == 500
+    assert not hasattr(loaded, 'scores')
+
+# Tests a path without extension is saved as npz and loaded from the same path
+def test_saveLoad_noSuffix(tmp_path):
+    artifact = calibrationArtifact.fromScores(scores, 'lac', 'v1')
+    assert artifact.save(str(tmp_path/'artifact')) == str(tmp_path/'artifact.npz')
+    assert calibrationArtifact.load(str(tmp_path/'artifact')).qHats == artifact.qHats
+
+# Tests the sketch quantile is on the conservative side of the exact quantile and within one bin
+def test_sketchQuantile():
+    counts = np.bincount(np.searchsorted(edges, scores), minlength = len(edges) + 1)
+    for alpha in [0.05, 0.1, 0.3]:
+        upper, lower = conformalQuantile(scores, alpha), conformalQuantile(scores, alpha, lower = True)
+        assert upper <= sketchQuantile(edges, counts, alpha) <= upper + 1e-3
+        assert lower - 1e-3 <= sketchQuantile(edges, counts, alpha, lower = True) <= lower
+    assert sketchQuantile(edges, counts, 0.001) == np.inf
+
+# Tests merged sketches equal the sketch of all the scores and the merged qHat is conservative
+def test_merge():
+    a = calibrationArtifact.fromScores(scores[:200], 'lac', 'a', edges = edges)
+    b = calibrationArtifact.fromScores(scores[200:], 'lac', 'b', alphas = [0.2], edges = edges)
+    merged = a.merge(b)
+    assert merged.nCal == 500 and merged.version == 'a+b'
+    combined = calibrationArtifact.fromScores(scores, 'lac', 'all', edges = edges)
+    assert np.array_equal(merged.counts, combined.counts)
+    for alpha in [0.1, 0.2]:
+        exact = conformalQuantile(scores, alpha, lower = True)
+        assert exact - 1e-3 <= merged.qHat(alpha) <= exact
+    with pytest.raises(ValueError):
+        a.merge(calibrationArtifact.fromScores(scores, 'aps', 'c', edges = edges))
+    with pytest.raises(ValueError):
+        a.merge(calibrationArtifact.fromScores(scores, 'lac', 'd'))
+
+# Tests apply raises instead of sending an infinite qHat to Earth Engine
+def test_apply_infinite():
+    artifact = calibrationArtifact.fromScores(scores[:5], 'aps', 'small', alphas = [0.1])
+    assert artifact.qHat() == np.inf
+    with pytest.raises(ValueError, match = 'not finite'):
+        artifact.apply(object())
+
+# Tests registering, loading, merging and finding versions
+def test_calibrationRegistry(tmp_path):
+    registry = calibrationRegistry(str(tmp_path))
+    registry.register(calibrationArtifact.fromScores(scores[:250], 'aps', 'batch1', edges = edges))
+    registry.register(calibrationArtifact.fromScores(scores[250:], 'aps', 'batch2', edges = edges))
+    with pytest.raises(ValueError):
+        registry.register(calibrationArtifact.fromScores(scores, 'aps', 'batch1'))
+    registry.merge(['batch1', 'batch2'], 'all')
+    # reopen from the index
+    registry = calibrationRegistry(str(tmp_path))
+    assert registry.versions() == ['batch1', 'batch2', 'all']
+    assert conformalQuantile(scores, 0.1) <= registry.load('all').qHat() <= conformalQuantile(scores, 0.1) + 1e-3
+    assert registry.find(registry.load('batch1').dataHash) == ['batch1']
@@ -0,0 +1,26 @@
+import ee
+import pytest
+from code.conformalRegressor import conformalFeatureRegressor, conformalImageRegressor, decodeFeatureIntervals
+
+def feature():
+    return ee.Feature(None, {'prediction': 10.0, 'lower': 9.0, 'upper': 12.0, 'sigma': 2.0, 'label': 10.5})
+
+# Tests compact feature intervals carry the encoding metadata and decode to the full intervals
+@pytest.mark.parametrize('regressor, method, bands', [
+    (conformalFeatureRegressor, 'residual', 'prediction'),
+    (conformalFeatureRegressor, 'normalized', 'prediction'),
+    (conformalImageRegressor, 'cqr', ['lower', 'upper'])])
+def test_compactFeature_roundTrip(regressor, method, bands):
+    conformal = regressor(ee.FeatureCollection([feature()]), bands, 0.1, 'label', 'test')
+    conformal.method, conformal.sigma, conformal.qhat = method, 'sigma', 0.37
+    full = conformal.predict(feature()).toDictionary(['lower', 'upper', 'width']).getInfo()
+    compact = conformal.predict(feature(), output = 'compact', widthScale = 0.01)
+    info = compact.toDictionary().getInfo()
+    assert info['intervalEncoding'] == ('constant' if method == 'residual' else 'band') and info['qHat'] == 0.37
+    if method != 'residual':
+        assert info['halfWidthScale'] == 0.01 and info['halfWidthOffset'] == 0
+    decoded = decodeFeatureIntervals(compact).toDictionary(['lower', 'upper', 'width']).getInfo()
+    for key in ['lower', 'upper', 'width']:
+        assert decoded[key] == pytest.approx(full[key], abs = 0.02)
+    # half-widths are rounded up, decoded intervals are never narrower
+    assert decoded['lower'] <= full['lower'] + 1e-9 and decoded['upper'] >= full['upper'] - 1e-9
@@ -0,0 +1,13 @@
+import numpy as np
+from code.diagnosticFunctions import stratifiedCoverage
+
+# Tests per stratum coverage and set size against hand computed values
+def test_stratifiedCoverage():
+    covered = np.array([1, 0, 1, 1, 1, 0])
+    size = np.array([1, 2, 3, 1, 1, 2])
+    frame = stratifiedCoverage(covered, size, {'label': [0, 0, 1, 1, 2, 2], 'cluster': [5, 5, 5, 7, 7, 7]})
+    assert frame.loc[('label', 0), 'coverage'] == 0.5
+    assert frame.loc[('label', 1), 'setSize'] == 2
+    assert frame.loc[('cluster', 7), 'n'] == 3
+    assert np.isclose(frame.loc[('cluster', 5), 'coverage'], 2/3)
+    assert len(frame) == 5
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+import rasterio
+import threading
+import time
+from code.downloadFunctions import tileDownloader, tableDownloader
+
+def fakeFetch(tile):
+    """Returns a two band tile filled with the tile row and column"""
+    window = tile['window']
+    return np.stack([np.full((window.height, window.width), tile['row']),
+                     np.full((window.height, window.width), tile['col'])])
+
+# Tests that the tiles match the patch size and cover the snapped area of interest
+def test_tiles():
+    downloader = tileDownloader(None, bounds = [0, 0, 400, 200], scale = 10, patchSize = 16,
+                                bandNames = ['a', 'b'], fetch = fakeFetch)
+    assert (downloader.width, downloader.height) == (40, 20)
+    assert len(downloader.tiles) == 6
+    assert sum(t['window'].width * t['window'].height for t in downloader.tiles) == 800
+
+# Tests that all tiles are yielded and written to the mosaic
+def test_download(tmp_path):
+    outfile = str(tmp_path/'mosaic.tif')
+    downloader = tileDownloader(None, bounds = [0, 0, 400, 200], scale = 10, patchSize = 16,
+                                outfile = outfile, bandNames = ['a', 'b'], fetch = fakeFetch)
+    assert len(list(downloader)) == 6
+    with rasterio.open(outfile) as src:
+        data = src.read()
+    assert data.shape == (2, 20, 40)
+    assert data[0, 19, 0] == 1 and data[1, 0, 39] == 2
+
+class fakePages:
+    """Returns the properties of the features with a (random) page key in [start, end), at most count. Values of 'x'
+    are whole numbers (integers) for keys below 0.2, 'label' is always an integer, 'flag' is missing on odd features,
+    'name' is null for keys below 0.2 and 'note' only exists for keys above 0.8"""
+    def __init__(self, size: int):
+        self.keys = np.random.default_rng(0).random(size)
+        self.lock = threading.Lock()
+        self.inFlight = 0
+        self.maxInFlight = 0
+        self.requests = 0
+
+    def __call__(self, start, end, count):
+        with self.lock:
+            self.inFlight += 1
+            self.requests += 1
+            self.maxInFlight = max(self.maxInFlight, self.inFlight)
+        time.sleep(0.01)
+        with self.lock:
+            self.inFlight -= 1
+        ids = [i for i, key in enumerate(self.keys) if start <= key < end][:count]
+        return [dict({'id': i, 'x': i if self.keys[i] < 0.2 else i + 0.5, 'label': i % 3, 'pageKey': self.keys[i],
+                      'name': None if self.keys[i] < 0.2 else str(i)},
+                     **({'flag': 1} if i % 2 == 0 else {}), **({'note': 'late'} if self.keys[i] > 0.8 else {}))
+                for i in ids]
+
+# Tests key range pages are downloaded concurrently, full pages are split and pages share one schema
+def test_tableDownloader():
+    fetch = fakePages(95)
+    table = tableDownloader(None, pageSize = 10, num_workers = 4, size = 95, fetch = fetch).download()
+    assert table.num_rows == 95 and sorted(table.column('id').to_pylist()) == list(range(95))
+    assert 'pageKey' not in table.column_names
+    assert str(table.schema.field('x').type) == 'double'
+    x = dict(zip(table.column('id').to_pylist(), table.column('x').to_pylist()))
+    assert all(x[i] == (i if fetch.keys[i] < 0.2 else i + 0.5) for i in range(95))
+    assert table.column('flag').null_count == 47
+    # integers stay integers, the types of later pages are kept and properties of later pages are not dropped
+    assert str(table.schema.field('label').type) == 'int64'
+    assert str(table.schema.field('name').type) == 'string'
+    assert table.column('note').null_count == int((fetch.keys <= 0.8).sum())
+    assert fetch.requests > 12 and 1 < fetch.maxInFlight <= 4
+    table = tableDownloader(None, pageSize = 10, size = 5, columns = ['x'], fetch = fakePages(5)).download()
+    assert table.column_names == ['x'] and table.num_rows == 5
+
+# Tests that a property with different (non numeric) types on different pages raises
+def test_tableDownloader_types():
+    fetch = lambda start, end, count: [{'a': 1 if start < 0.5 else 'b', 'pageKey': start}]
+    with pytest.raises(TypeError):
+        tableDownloader(None, pageSize = 10, size = 10, fetch = fetch).download()
+
+# Tests downloading a subset of tiles (a resumed run) keeps the tiles already in the mosaic
+def test_download_resume(tmp_path):
+    outfile = str(tmp_path/'mosaic.tif')
+    downloader = tileDownloader(None, bounds = [0, 0, 400, 200], scale = 10, patchSize = 16,
+                                outfile = outfile, bandNames = ['a', 'b'], fetch = fakeFetch)
+    list(downloader.download(downloader.tiles[:3]))
+    list(downloader.download(downloader.tiles[3:]))
+    with rasterio.open(outfile) as src:
+        data = src.read()
+    for tile in downloader.tiles:
+        rows, cols = tile['window'].toslices()
+        assert (data[0, rows, cols] == tile['row']).all() and (data[1, rows, cols] == tile['col']).all()
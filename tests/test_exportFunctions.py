@@ -0,0 +1,61 @@
+import json
+from code.exportFunctions import gridTiles, exportScheduler
+
+class fakeTaskService:
+    """Local stand-in for eeTaskService. Each task runs for one poll. Tiles listed in failures fail that many times"""
+    def __init__(self, failures: dict = None):
+        self.failures = dict(failures or {})
+        self.running = {}
+        self.submitted = []
+        self.maxRunning = 0
+
+    def submit(self, tile):
+        taskId = f"task{len(self.submitted)}"
+        self.submitted.append(tile['id'])
+        self.running[taskId] = tile['id']
+        self.maxRunning = max(self.maxRunning, len(self.running))
+        return taskId
+
+    def status(self, taskIds):
+        result = {}
+        for taskId in taskIds:
+            tileId = self.running.pop(taskId)
+            if self.failures.get(tileId, 0) > 0:
+                self.failures[tileId] -= 1
+                result[taskId] = ('FAILED', 'Computation timed out.')
+            else:
+                result[taskId] = ('COMPLETED', None)
+        return result
+
+# Tests that the grid covers the bounds and edge tiles are clipped
+def test_gridTiles():
+    tiles = gridTiles([0, 0, 25, 10], 10)
+    assert len(tiles) == 3
+    assert tiles[0]['bounds'] == [0, 0, 10, 10]
+    assert tiles[-1]['bounds'] == [20, 0, 25, 10]
+
+# Tests the concurrency cap and that failed tiles are retried
+def test_exportScheduler(tmp_path):
+    service = fakeTaskService(failures = {'r0c1': 1})
+    tiles = gridTiles([0, 0, 40, 20], 10)
+    manifest = exportScheduler(service, tiles, str(tmp_path/'manifest.json'), maxConcurrent = 3,
+                               sleep = lambda s: None).run()
+    assert all(entry['state'] == 'COMPLETED' for entry in manifest.values())
+    assert manifest['r0c1']['attempts'] == 2
+    assert service.maxRunning <= 3
+
+# Tests that tiles exceeding the number of retries are marked as failed
+def test_exportScheduler_maxRetries(tmp_path):
+    service = fakeTaskService(failures = {'r0c0': 5})
+    manifest = exportScheduler(service, gridTiles([0, 0, 10, 10], 10), str(tmp_path/'manifest.json'),
+                               maxRetries = 2, sleep = lambda s: None).run()
+    assert manifest['r0c0']['state'] == 'FAILED'
+    assert service.submitted == ['r0c0', 'r0c0']
+
+# Tests that completed tiles in the manifest are not exported again
+def test_exportScheduler_resume(tmp_path):
+    path = tmp_path/'manifest.json'
+    path.write_text(json.dumps({'r0c0': {'state': 'COMPLETED', 'taskId': 'old', 'attempts': 1, 'error': None}}))
+    service = fakeTaskService()
+    exportScheduler(service, gridTiles([0, 0, 20, 10], 10), str(path), sleep = lambda s: None).run()
+    assert service.submitted == ['r0c1']
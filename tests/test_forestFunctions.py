@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.tree import DecisionTreeClassifier
+from code.forestFunctions import compiledForest, forestToStrings, batchStrings, classifyForest
+
+def fitData(n = 500, features = 6):
+    rng = np.random.default_rng(0)
+    X = rng.random((n, features))
+    y = (X[:, 0] * 3 + X[:, 1] + rng.random(n)).astype(int) * 10
+    return X, y
+
+# Tests the compiled forest probabilities are identical to sklearn (including missing values and 1 tree)
+def test_compiledForest():
+    pytest.importorskip('numba')
+    X, y = fitData()
+    X[:20, 2] = np.nan
+    pixels = pd.DataFrame(np.random.default_rng(1).random((1000, 6)))
+    pixels.iloc[:30, 0] = np.nan
+    for model in [RandomForestClassifier(n_estimators = 10, random_state = 0, n_jobs = 1).fit(X, y),
+                  DecisionTreeClassifier(random_state = 0).fit(X, y)]:
+        compiled = compiledForest(model, backend = 'numba')
+        assert np.array_equal(compiled.predict_proba(pixels), model.predict_proba(pixels))
+        assert np.array_equal(compiled.predict(pixels), model.predict(pixels))
+        assert compiled.n_classes_ == model.n_classes_
+
+# Tests the sklearn fallback and the input checks
+def test_compiledForest_sklearn():
+    X, y = fitData()
+    model = RandomForestClassifier(n_estimators = 5, random_state = 0).fit(X, y)
+    compiled = compiledForest(model, backend = 'sklearn')
+    assert np.array_equal(compiled.predict(X), model.predict(X))
+    with pytest.raises(ValueError):
+        compiled.predict_proba(X[:, :3])
+    with pytest.raises(ValueError):
+        compiledForest(model, backend = 'gpu')
+
+# ee.Classifier.decisionTree string of smallTree() (geemap.ml.tree_to_string layout, exact thresholds)
+SMALL_TREE = """1) root 8 9999 9999 (0.84375)
+  2) b2 <= 2.5 4 0.3750 0
+    4) b1 <= 0.550000011920929 3 0.0000 0 *
+    5) b1 > 0.550000011920929 1 0.0000 1 *
+  3) b2 > 2.5 4 0.0000 1 *
+"""
+
+def smallTree():
+    X = np.array([[0.1, 1], [0.2, 2], [0.3, 3], [0.4, 4], [0.5, 1], [0.6, 2], [0.7, 3], [0.8, 4]])
+    return DecisionTreeClassifier(max_depth = 3, random_state = 0).fit(X, [0, 0, 1, 1, 0, 1, 1, 1])
+
+def parseLines(string):
+    """(id, indent, feature, sign, threshold, leaf) of the node lines and (n, value) of the leaves"""
+    nodes, leaves = [], []
+    for line in string.rstrip('\n').split('\n')[1:]:
+        nodeId, feature, sign, threshold, n, loss, value = line.replace(' *', '').split()
+        nodes.append((nodeId, len(line) - len(line.lstrip()), feature, sign, round(float(threshold), 6),
+                      line.endswith(' *')))
+        if line.endswith(' *'):
+            leaves.append((int(n), float(value)))
+    return nodes, leaves
+
+# Tests the tree string of a fixed tree matches the fixture
+def test_treeToString_fixture():
+    assert forestToStrings(smallTree(), ['b1', 'b2'])[0] == SMALL_TREE
+
+# Tests the node layout, thresholds and leaves match geemap.ml.tree_to_string
+def test_treeToString_geemap():
+    ml = pytest.importorskip('geemap.ml')
+    X, y = fitData(200, 3)
+    features = ['b1', 'b2', 'b3']
+    tree = DecisionTreeClassifier(max_depth = 4, random_state = 0).fit(X, y)
+    ours, geemap = forestToStrings(tree, features)[0], ml.tree_to_string(tree, features, output_mode = 'CLASSIFICATION')
+    assert ours.split('\n')[0] == geemap.split('\n')[0]
+    assert parseLines(ours)[0] == parseLines(geemap)[0]
+    # geemap writes class indices
+    leaves = [(n, float(tree.classes_[int(value)])) for n, value in parseLines(geemap)[1]]
+    assert parseLines(ours)[1] == leaves
+
+# Tests one-vs-rest leaf values are the sklearn leaf probabilities of each class, in leaf order
+def test_forestToStrings_probabilities():
+    X, y = fitData(200, 3)
+    model = RandomForestClassifier(n_estimators = 3, max_depth = 4, random_state = 0).fit(X, y)
+    for classIndex in range(model.n_classes_):
+        for string, estimator in zip(forestToStrings(model, ['b1', 'b2', 'b3'], classIndex), model.estimators_):
+            value = estimator.tree_.value[:, 0, :]
+            leaves = np.flatnonzero(estimator.tree_.children_left == -1)
+            probability = value[leaves, classIndex] / value[leaves].sum(axis = 1)
+            assert np.allclose([value for n, value in parseLines(string)[1]], probability, rtol = 0, atol = 1e-15)
+
+# Tests tree strings are batched in order below the byte budget
+def test_batchStrings():
+    strings = ['a' * 40, 'b' * 40, 'c' * 40, 'd' * 90]
+    assert batchStrings(strings, maxBytes = 100) == [strings[:2], strings[2:3], strings[3:]]
+    with pytest.raises(ValueError):
+        batchStrings(strings, maxBytes = 50)
+
+# Tests trees deeper than maxDepth and requests larger than maxTotalBytes are rejected before any request is built
+def test_classifyForest_limits():
+    X, y = fitData()
+    forest = RandomForestClassifier(n_estimators = 5, random_state = 0).fit(X, y)
+    names = [f'b{i}' for i in range(X.shape[1])]
+    depth = max(estimator.tree_.max_depth for estimator in forest.estimators_)
+    with pytest.raises(ValueError, match = 'max_depth'):
+        forestToStrings(forest, names, maxDepth = depth - 1)
+    total = sum(len(string.encode()) for classIndex in range(forest.n_classes_)
+                for string in forestToStrings(forest, names, classIndex))
+    with pytest.raises(ValueError, match = 'maxTotalBytes'):
+        classifyForest(None, forest, names, maxTotalBytes = total - 1)
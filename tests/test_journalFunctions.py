@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.windows import Window
+from code.journalFunctions import inferenceJournal
+from code.modelFitFunctions import prepareModel
+from tests.test_modelFitFunctions import fitModel, writeRaster, expected, bandNames
+
+class crashingModel:
+    """Wraps a model and raises after a number of predict calls"""
+    def __init__(self, model, crashAfter = None):
+        self.model = model
+        self.n_classes_ = model.n_classes_
+        self.crashAfter = crashAfter
+        self.calls = 0
+
+    def __getstate__(self):
+        # the model fingerprint of the journal is the wrapped model, not the call counter
+        return {'model': self.model}
+
+    def predict(self, data):
+        self.calls += 1
+        if self.crashAfter is not None and self.calls > self.crashAfter:
+            raise RuntimeError('crash')
+        return self.model.predict(data)
+
+def run(tmp_path, model, **kwargs):
+    prepareModel(None, 'label', None, bandNames).inference('predict', str(tmp_path/'in.tif'), model, None,
+                                                           str(tmp_path/'out.tif'), patchSize = 16, num_workers = 1,
+                                                           resume = True, **kwargs)
+
+# Tests a crashed run is resumed from the journal and only the missing windows are processed
+def test_resume(tmp_path):
+    model = fitModel()
+    data = np.random.default_rng(1).random((2, 48, 48)).astype(np.float32)
+    writeRaster(tmp_path/'in.tif', data)
+    with pytest.raises(RuntimeError, match = 'crash'):
+        run(tmp_path, crashingModel(model, crashAfter = 4), checkpoint = 2)
+    assert inferenceJournal.read(str(tmp_path/'out.tif')).done.sum() == 4
+    resumed = crashingModel(model)
+    run(tmp_path, resumed, checkpoint = 2)
+    assert resumed.calls == 5
+    with rasterio.open(tmp_path/'out.tif') as src:
+        assert np.array_equal(src.read(1), expected(model, data))
+
+# Tests verify finds windows that do not match their checksum and a changed run starts again
+def test_verify(tmp_path):
+    model = fitModel()
+    data = np.random.default_rng(1).random((2, 32, 32)).astype(np.float32)
+    writeRaster(tmp_path/'in.tif', data)
+    run(tmp_path, model)
+    journal = inferenceJournal.read(str(tmp_path/'out.tif'))
+    meta = {key: journal.meta[key] for key in journal.meta if key not in ['width', 'height', 'patchSize']}
+    assert journal.done.all() and journal.verify(str(tmp_path/'out.tif')) == []
+    assert journal.meta['input']['size'] == (tmp_path/'in.tif').stat().st_size
+    assert inferenceJournal.open(str(tmp_path/'out.tif'), 32, 32, 16, meta).resumable
+    with rasterio.open(tmp_path/'out.tif', 'r+') as dst:
+        dst.write(np.full((1, 16, 16), -1.0), window = Window(16, 0, 16, 16))
+    assert journal.verify(str(tmp_path/'out.tif')) == [(0, 1)] and journal.done.sum() == 3
+    assert not inferenceJournal.open(str(tmp_path/'out.tif'), 32, 32, 16, dict(meta, mode = 'all')).resumable
+
+# Tests a journal is not resumed with another model or a rewritten input
+def test_journal_identity(tmp_path):
+    model = fitModel()
+    data = np.random.default_rng(1).random((2, 32, 32)).astype(np.float32)
+    writeRaster(tmp_path/'in.tif', data)
+    with pytest.raises(RuntimeError, match = 'crash'):
+        run(tmp_path, crashingModel(model, crashAfter = 2), checkpoint = 1)
+    other = crashingModel(fitModel().set_params(random_state = 1))
+    run(tmp_path, other)
+    assert other.calls == 4
+    # same model, rewritten input
+    with pytest.raises(RuntimeError, match = 'crash'):
+        run(tmp_path, crashingModel(model, crashAfter = 2), checkpoint = 1)
+    writeRaster(tmp_path/'in.tif', data)
+    resumed = crashingModel(model)
+    run(tmp_path, resumed)
+    assert resumed.calls == 4
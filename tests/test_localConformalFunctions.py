@@ -0,0 +1,72 @@
+import numpy as np
+from code.localConformalFunctions import classScores, labelScores, conformalQuantile, predictionSets, \
+    residualScores, predictionIntervals, repeatedSplitCoverage, encodeHalfWidth, decodeIntervals
+
+probs = np.array([[0.5, 0.2, 0.3],
+                  [0.1, 0.6, 0.3]])
+
+# Tests aps scores: sum of probabilities ranked above a class plus its own probability
+def test_classScores_aps():
+    assert np.allclose(classScores(probs, 'aps'), [[0.5, 1.0, 0.8], [1.0, 0.6, 0.9]])
+
+# Tests the raps penalty is added to classes ranked beyond kReg
+def test_classScores_raps():
+    assert np.allclose(classScores(probs, 'raps', lam = 0.1, kReg = 1), [[0.5, 1.2, 0.9], [1.2, 0.6, 1.0]])
+
+# Tests the finite-sample corrected quantile for both score directions
+def test_conformalQuantile():
+    scores = np.arange(1, 20)
+    # ceil(20 * 0.9) = 18th smallest (largest for lac)
+    assert conformalQuantile(scores, 0.1) == 18
+    assert conformalQuantile(scores, 0.1, lower = True) == 2
+    assert conformalQuantile(scores[:5], 0.1) == np.inf
+
+# Tests that calibrated sets reach the requested coverage on exchangeable data
+def test_predictionSets_coverage():
+    rng = np.random.default_rng(0)
+    p = rng.dirichlet(np.ones(5), size = 4000)
+    y = np.array([rng.choice(5, p = row) for row in p])
+    for score, lower in [('lac', True), ('aps', False), ('raps', False)]:
+        qHat = conformalQuantile(labelScores(p[:2000], y[:2000], score), 0.1, lower = lower)
+        sets = predictionSets(p[2000:], qHat, score)
+        assert sets[np.arange(2000), y[2000:]].mean() >= 0.88
+
+# Tests normalised residual intervals adapt to sigma and reach the requested coverage
+def test_predictionIntervals_normalized():
+    rng = np.random.default_rng(0)
+    sigma = rng.uniform(0.1, 2, size = 4000)
+    yhat = rng.normal(size = 4000)
+    y = yhat + rng.normal(scale = sigma)
+    qHat = conformalQuantile(residualScores(y[:2000], yhat[:2000], sigma[:2000]), 0.1)
+    lower, upper = predictionIntervals(yhat[2000:], qHat, sigma[2000:])
+    assert np.mean((y[2000:] >= lower) & (y[2000:] <= upper)) >= 0.88
+    assert np.allclose(upper - lower, 2 * qHat * sigma[2000:])
+
+# Tests that repeated splits are centred on the requested coverage and do not depend on chunking
+def test_repeatedSplitCoverage():
+    rng = np.random.default_rng(0)
+    p = rng.dirichlet(np.ones(4), size = 2000)
+    y = np.array([rng.choice(4, p = row) for row in p])
+    for score, lower in [('lac', True), ('aps', False)]:
+        args = dict(scores = labelScores(p, y, score), alpha = 0.1, repeats = 200, lower = lower,
+                    classScores = classScores(p, score))
+        result = repeatedSplitCoverage(**args)
+        assert 0.89 <= result['summary']['coverage']['mean'] <= 0.92
+        assert result['summary']['coverage']['q0.05'] < result['summary']['coverage']['q0.95']
+        chunked = repeatedSplitCoverage(chunkSize = 10000, **args)
+        assert np.array_equal(result['coverage'], chunked['coverage'])
+        assert np.allclose(result['setSize'], chunked['setSize'])
+    # residual intervals have a constant width of 2 * qHat
+    result = repeatedSplitCoverage(np.abs(rng.normal(size = 2000)), 0.1, repeats = 50)
+    assert np.allclose(result['width'], 2 * result['qHat'])
+
+# Tests that int16 encoded half-widths decode to intervals at least as wide as the originals
+def test_encodeHalfWidth():
+    rng = np.random.default_rng(0)
+    yhat = rng.uniform(0, 40, size = 1000)
+    halfWidth = 1.7 * rng.uniform(0.1, 5, size = 1000)
+    encoded = encodeHalfWidth(halfWidth, 0.01)
+    assert encoded.dtype == np.int16
+    lower, upper = decodeIntervals(yhat, encoded, widthScale = 0.01)
+    assert np.all(upper - yhat >= halfWidth) and np.all(upper - yhat - halfWidth < 0.01)
+    assert np.allclose(decodeIntervals(yhat, qHat = 2.0)[1], yhat + 2)
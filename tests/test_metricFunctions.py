@@ -1,5 +1,7 @@
+import warnings
 import ee
-from code.metricFunctions import prepareMetrics
+import numpy as np
+from code.metricFunctions import prepareMetrics, foldMetrics
 import pytest
 
 # Test the initialisation with dummy inputs
@@ -15,3 +17,21 @@ def test_init():
         pytest.fail("Could not initialise prep metrics")
         
 
+
+# Test the local (NumPy) fold metrics against hand computed values
+def test_foldMetrics():
+    raw = np.array([[[4, 1], [0, 5]],
+                    [[3, 0], [2, 5]]])
+    result = foldMetrics(raw, acc = [0.9, 0.8], num = [10, 10])
+    assert np.isclose(result['acc'], 0.85)
+    assert np.array_equal(result['confusion'], [[7, 1], [2, 10]])
+    assert np.allclose(result['pa'], [7/8, 10/12])
+    assert np.allclose(result['ca'], [7/9, 10/11])
+    # po = 17/20, pe = (8*9 + 12*11)/400
+    assert np.isclose(result['kappa'], (17/20 - 204/400)/(1 - 204/400))
+    assert np.allclose(result['f1'], [2 * (7/8) * (7/9) / (7/8 + 7/9), 2 * (10/12) * (10/11) / (10/12 + 10/11)])
+    # a single class: kappa is 0 and absent classes have 0 pa, ca and f1 (no warnings)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        single = foldMetrics(np.array([[[6, 0], [0, 0]]]), acc = [1.0], num = [6])
+    assert single['kappa'] == 0.0 and np.array_equal(single['f1'], [1.0, 0.0])
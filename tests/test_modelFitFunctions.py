@@ -0,0 +1,168 @@
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.transform import from_origin
+from sklearn.ensemble import RandomForestClassifier
+from code.modelFitFunctions import prepareModel
+from code.downloadFunctions import tileDownloader
+from code.calibrationFunctions import calibrationArtifact
+
+bandNames = ['b1', 'b2']
+
+def fitModel():
+    """Fit a small random forest on random pixels"""
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.random((200, 2)), columns = bandNames)
+    y = (X['b1'] > X['b2']).astype(int) + (X['b1'] > 0.8)
+    return RandomForestClassifier(n_estimators = 5, random_state = 0).fit(X, y)
+
+def writeRaster(path, data):
+    profile = {'driver': 'GTiff', 'dtype': 'float32', 'width': data.shape[2], 'height': data.shape[1],
+               'count': data.shape[0], 'crs': 'EPSG:4326', 'transform': from_origin(0, 32, 1, 1)}
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(data)
+        dst.descriptions = tuple(bandNames)
+
+def expected(model, data):
+    pixels = pd.DataFrame(data.reshape(2, -1).T, columns = bandNames)
+    return model.predict(pixels).reshape(data.shape[1:])
+
+# Tests inference on a GeoTIFF matches the model predictions
+def test_inference(tmp_path):
+    model = fitModel()
+    data = np.random.default_rng(1).random((2, 32, 32)).astype(np.float32)
+    writeRaster(tmp_path/'in.tif', data)
+    prepareModel(None, 'label', None, bandNames).inference('predict', str(tmp_path/'in.tif'), model, None,
+                                                           str(tmp_path/'out.tif'), patchSize = 16)
+    with rasterio.open(tmp_path/'out.tif') as src:
+        assert np.array_equal(src.read(1), expected(model, data))
+
+# Tests inference on tiles streamed from a tileDownloader
+def test_inference_downloader(tmp_path):
+    model = fitModel()
+    data = np.random.default_rng(1).random((2, 32, 48)).astype(np.float32)
+    def fetch(tile):
+        window = tile['window']
+        return data[:, window.row_off:window.row_off + window.height, window.col_off:window.col_off + window.width]
+    downloader = tileDownloader(None, bounds = [0, 0, 48, 32], scale = 1, patchSize = 16,
+                                bandNames = bandNames, fetch = fetch)
+    prepareModel(None, 'label', None, bandNames).inference('predict', downloader, model, None,
+                                                           str(tmp_path/'out.tif'), patchSize = 16)
+    with rasterio.open(tmp_path/'out.tif') as src:
+        assert np.array_equal(src.read(1), expected(model, data))
+
+# Tests inference from a memory-mapped cache of the input matches the model predictions
+def test_inference_memmap(tmp_path):
+    model = fitModel()
+    data = np.random.default_rng(1).random((2, 32, 32)).astype(np.float32)
+    writeRaster(tmp_path/'in.tif', data)
+    prepareModel(None, 'label', None, bandNames).inference('predict', str(tmp_path/'in.tif'), model, None,
+                                                           str(tmp_path/'out.tif'), patchSize = 16, memmap = True)
+    assert np.array_equal(np.load(tmp_path/'in.npy'), np.moveaxis(data, 0, -1))
+    with rasterio.open(tmp_path/'out.tif') as src:
+        assert np.array_equal(src.read(1), expected(model, data))
+
+# Tests nodata pixels are not classified, are nodata in the output and windows without data are skipped
+def test_inference_nodata(tmp_path):
+    model = fitModel()
+    windows = []
+    predict = model.predict
+    model.predict = lambda data: windows.append(len(data)) or predict(data)
+    data = np.random.default_rng(1).random((2, 32, 32)).astype(np.float32)
+    data[:, :16, :16] = np.nan
+    data[:, 16:, :8] = np.nan
+    data[0, 20, 20] = np.nan
+    writeRaster(tmp_path/'in.tif', data)
+    prepareModel(None, 'label', None, bandNames).inference('predict', str(tmp_path/'in.tif'), model, None,
+                                                           str(tmp_path/'out.tif'), patchSize = 16)
+    with rasterio.open(tmp_path/'out.tif') as src:
+        result = src.read(1)
+    assert sorted(windows) == [128, 255, 256]
+    # a pixel with one missing band is not classified
+    valid = ~np.isnan(data).any(axis = 0)
+    assert np.isnan(result[~valid]).all() and np.isnan(result[20, 20])
+    assert np.array_equal(result[valid], expected(model, np.nan_to_num(data))[valid])
+
+# Tests pixels masked by an internal mask (with finite values) are not classified
+def test_inference_mask(tmp_path):
+    model = fitModel()
+    data = np.random.default_rng(1).random((2, 32, 32)).astype(np.float32)
+    writeRaster(tmp_path/'in.tif', data)
+    mask = np.full((32, 32), 255, np.uint8)
+    mask[:4, :] = 0
+    with rasterio.open(tmp_path/'in.tif', 'r+') as dst:
+        dst.write_mask(mask)
+    prepareModel(None, 'label', None, bandNames).inference('predict', str(tmp_path/'in.tif'), model, None,
+                                                           str(tmp_path/'out.tif'), patchSize = 16)
+    with rasterio.open(tmp_path/'out.tif') as src:
+        result = src.read(1)
+    assert np.isnan(result[:4]).all()
+    assert np.array_equal(result[4:], expected(model, data)[4:])
+
+# Tests sets, class and probability are computed from one predict_proba call per window with several alphas
+def test_inference_sets(tmp_path):
+    model = fitModel()
+    calls = []
+    predict_proba = model.predict_proba
+    model.predict_proba = lambda data: calls.append(len(data)) or predict_proba(data)
+    data = np.random.default_rng(1).random((2, 32, 32)).astype(np.float32)
+    writeRaster(tmp_path/'in.tif', data)
+    pixels = pd.DataFrame(data.reshape(2, -1).T, columns = bandNames)
+    probs = predict_proba(pixels)
+    artifact = calibrationArtifact.fromScores(np.random.default_rng(2).random(100), 'lac', 'test',
+                                              alphas = [0.1, 0.2])
+    prepareModel(None, 'label', None, bandNames).inference('all', str(tmp_path/'in.tif'), model, artifact,
+                                                           str(tmp_path/'out.tif'), patchSize = 16, alpha = [0.1, 0.2])
+    assert len(calls) == 4
+    with rasterio.open(tmp_path/'out.tif') as src:
+        result = src.read().reshape(src.count, -1)
+    assert result.shape[0] == 2 + 2 * model.n_classes_
+    assert np.array_equal(result[0], model.predict(pixels))
+    assert np.array_equal(result[1], probs.max(axis = 1))
+    for index, alpha in enumerate([0.1, 0.2]):
+        sets = result[2 + index * model.n_classes_:2 + (index + 1) * model.n_classes_].T
+        assert np.array_equal(sets, probs >= artifact.qHat(alpha))
+    # a lac qHat
+    prepareModel(None, 'label', None, bandNames).inference('sets', str(tmp_path/'in.tif'), model, 0.3,
+                                                           str(tmp_path/'sets.tif'), patchSize = 16)
+    with rasterio.open(tmp_path/'sets.tif') as src:
+        assert np.array_equal(src.read().reshape(src.count, -1).T, probs >= 0.3)
+
+class fakeCollection:
+    """Local stand-in for an Earth Engine collection, serialize() is its graph"""
+    def __init__(self, graph):
+        self.graph = graph
+
+    def serialize(self):
+        return self.graph
+
+def splitModel(tmp_path, monkeypatch, dataset = 'data'):
+    """prepareModel with _UQ and downloadTable replaced by local tables. Returns the model and the downloads"""
+    downloads = []
+    rng = np.random.default_rng(0)
+    def download(collection):
+        downloads.append(collection.graph)
+        X = pd.DataFrame(rng.random((60, 20)), columns = [f'b{i}' for i in range(20)])
+        return X.assign(label = (X['b0'] > 0.5).astype(np.int64))
+    monkeypatch.setattr('code.modelFitFunctions.downloadTable', download)
+    pm = prepareModel(fakeCollection(dataset), 'label', None, [f'b{i}' for i in range(20)], tableDir = str(tmp_path))
+    pm._UQ = lambda fold: tuple(fakeCollection(f'{dataset}{fold}{name}') for name in ['t', 'v', 'c'])
+    return pm, downloads
+
+# Tests tables are downloaded once, downcast, reloaded from the Arrow files and the model is fitted once
+def test_splitTables(tmp_path, monkeypatch):
+    pm, downloads = splitModel(tmp_path, monkeypatch)
+    X_cal, y_cal = pm.calibrationData
+    assert X_cal.dtype == np.float32 and y_cal.dtype == np.int8
+    assert pm.fittedClassifier is pm.fittedClassifier
+    pm.calibrationData
+    assert len(downloads) == 3
+    # a new session reads the stored tables
+    pm, downloads = splitModel(tmp_path, monkeypatch)
+    assert np.array_equal(pm.calibrationData[0], X_cal) and downloads == []
+    # another dataset or seed is downloaded again
+    pm, downloads = splitModel(tmp_path, monkeypatch, dataset = 'other')
+    pm.calibrationData
+    pm.seed = 1
+    pm.calibrationData
+    assert len(downloads) == 6
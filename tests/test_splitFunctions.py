@@ -0,0 +1,20 @@
+import ee
+from code.splitFunctions import calibrationSplitter
+
+def clusteredPoints():
+    return ee.FeatureCollection([ee.Feature(None, {'cluster': i % 5, 'value': i}) for i in range(100)])
+
+# Tests that calibration and test sets partition the data for repeated splits
+def test_split_partition():
+    splitter = calibrationSplitter(clusteredPoints(), seed = 1)
+    for repeat in range(3):
+        calibration, test = splitter.split(0.3, repeat = repeat)
+        assert calibration.size().add(test.size()).getInfo() == 100
+
+# Tests that groups are never divided between the calibration and test set
+def test_split_groups():
+    calibration, test = calibrationSplitter(clusteredPoints(), by = 'cluster').split(0.5)
+    calClusters = set(calibration.aggregate_array('cluster').getInfo())
+    testClusters = set(test.aggregate_array('cluster').getInfo())
+    assert calClusters.isdisjoint(testClusters)
+    assert calClusters | testClusters == set(range(5))